@@ -0,0 +1,142 @@
+# Finding Ghosts in Your Data
+# Admission control for detection requests
+# Several of our detectors have super-linear memory or CPU costs, so we estimate
+# the cost of a request before running any tests and either downgrade or reject
+# requests which would blow through the budget.
+
+import os
+
+# Budgets are per request.  Mode is either "downgrade" (try cheaper detector
+# settings first and reject only if those are still too expensive) or "reject".
+memory_budget_mb = float(os.environ.get("ANOMALY_MEMORY_BUDGET_MB", 2048))
+cpu_budget_seconds = float(os.environ.get("ANOMALY_CPU_BUDGET_SECONDS", 300))
+admission_mode = os.environ.get("ANOMALY_ADMISSION_MODE", "downgrade")
+
+MB = 1024.0 * 1024.0
+
+# Cost coefficients are rough, deliberately conservative estimates taken from
+# timing the detectors on a single core.  They only need to be good enough to
+# tell a 10-second request from a 10-hour one.
+# Pandas frames, copies, and per-row Python objects:  bytes per cell.
+FRAME_BYTES_PER_CELL = 200
+# Univariate:  most tests are linear.  GESD removes up to n/3 points, one at a time.
+UNIVARIATE_SECONDS_PER_RECORD = 6e-5
+GESD_SECONDS_PER_RECORD_SQUARED = 5e-9
+# Multivariate:  COF (fast method) holds the full pairwise distance matrix in memory
+# and is re-run for each neighbor count in the sweep.  LOCI is cubic in the number of rows.
+COF_SECONDS_PER_RECORD_SQUARED = 5e-7
+COF_MEMORY_METHOD_SLOWDOWN = 3.0
+LOCI_SECONDS_PER_RECORD_CUBED = 2e-6
+LOCI_MAX_RECORDS = 1000
+COPOD_SECONDS_PER_CELL = 1e-6
+# Single time series:  each kernel runs PELT across every penalty.  The rbf kernel
+# also builds a Gram matrix (pdist, squareform, and exp) when fitting.
+KERNEL_SECONDS_PER_RECORD_SQUARED = { "linear": 3.5e-8, "cosine": 7e-8, "rbf": 1.4e-7 }
+RBF_GRAM_BYTES_PER_RECORD_SQUARED = 20
+# Multiple time series:  SAX compares every series against every other series, word by word,
+# until there are more series than possible words (256), after which it compares against word histograms.
+SAX_SECONDS_PER_COMPARISON = 7e-8
+SAX_POSSIBLE_WORDS = 256
+
+def estimate_resources(method, num_records, num_dimensions=1, num_series=1, settings=None):
+    settings = settings or {}
+    n = float(num_records)
+    components = {}
+
+    if method == "univariate":
+        components["Base tests"] = (n * 12 * FRAME_BYTES_PER_CELL, n * UNIVARIATE_SECONDS_PER_RECORD)
+        if "gesd" not in settings.get("disabled_tests", []) and num_records >= 15:
+            components["GESD"] = (0.0, n * n * GESD_SECONDS_PER_RECORD_SQUARED)
+    elif method == "multivariate":
+        disabled = settings.get("disabled_tests", [])
+        components["Base tests"] = (n * (num_dimensions + 8) * FRAME_BYTES_PER_CELL, n * num_dimensions * COPOD_SECONDS_PER_CELL)
+        if "cof" not in disabled:
+            # Mirror the n_neighbors sweep in multivariate.run_tests:  up to 20 runs.
+            n_neighbors = settings.get("n_neighbors", 10)
+            num_sweeps = max(len(range(n_neighbors, min(num_records - 5, n_neighbors + 100), 5)), 1)
+            if settings.get("cof_method", "fast") == "fast":
+                components["COF"] = (n * n * 8.0, num_sweeps * n * n * COF_SECONDS_PER_RECORD_SQUARED)
+            else:
+                components["COF"] = (n * 8.0 * num_dimensions, num_sweeps * n * n * COF_SECONDS_PER_RECORD_SQUARED * COF_MEMORY_METHOD_SLOWDOWN)
+        if "loci" not in disabled and num_records <= LOCI_MAX_RECORDS:
+            components["LOCI"] = (n * n * 8.0, n * n * n * LOCI_SECONDS_PER_RECORD_CUBED)
+    elif method == "single_timeseries":
+        kernels = settings.get("kernels", list(KERNEL_SECONDS_PER_RECORD_SQUARED.keys()))
+        components["Base tests"] = (n * 4 * FRAME_BYTES_PER_CELL, 0.0)
+        for k in kernels:
+            memory = n * n * RBF_GRAM_BYTES_PER_RECORD_SQUARED if k == "rbf" else n * 8.0
+            components[f"KernelCPD ({k})"] = (memory, n * n * KERNEL_SECONDS_PER_RECORD_SQUARED[k])
+    elif method == "multi_timeseries":
+        series_length = n / max(num_series, 1)
+        segment_split = 2 if series_length < 100 else (3 if series_length < 1000 else 5)
+        num_words = (series_length // segment_split) // 4
+        components["Base tests"] = (n * 10 * FRAME_BYTES_PER_CELL, 0.0)
+        comparisons_per_series = num_series if num_series <= SAX_POSSIBLE_WORDS else SAX_POSSIBLE_WORDS
+        components["SAX"] = (0.0, float(num_series) * comparisons_per_series * num_words * SAX_SECONDS_PER_COMPARISON)
+    else:
+        raise ValueError(f"Unknown detection method {method}.")
+
+    # Detectors run one after another and release their working memory in between,
+    # so peak memory is the base footprint plus the largest single detector.
+    base_memory = components["Base tests"][0]
+    detector_memory = max([m for (c, (m, t)) in components.items() if c != "Base tests"], default=0.0)
+    return {
+        "Peak memory (MB)": (base_memory + detector_memory) / MB,
+        "CPU time (s)": sum([t for (m, t) in components.values()]),
+        "Components": { c: { "Memory (MB)": m / MB, "CPU time (s)": t } for (c, (m, t)) in components.items() }
+    }
+
+def get_downgrades(method):
+    # Candidate settings, ordered from least to most disruptive.  We use the first
+    # candidate which fits within the budget.  Each comes back as a (description, settings) pair.
+    if method == "univariate":
+        return [("Disabled GESD, which is quadratic in the number of records.", { "disabled_tests": ["gesd"] })]
+    elif method == "multivariate":
+        return [
+            ("Disabled LOCI, which is cubic in the number of records.", { "disabled_tests": ["loci"] }),
+            ("Switched COF to its memory-efficient method.", { "cof_method": "memory" }),
+            ("Disabled LOCI and switched COF to its memory-efficient method.", { "cof_method": "memory", "disabled_tests": ["loci"] }),
+            ("Disabled COF and LOCI, leaving COPOD.", { "disabled_tests": ["loci", "cof"] })
+        ]
+    elif method == "single_timeseries":
+        return [
+            ("Dropped the rbf kernel, which requires a full Gram matrix.", { "kernels": ["cosine", "linear"] }),
+            ("Kept only the linear kernel.", { "kernels": ["linear"] })
+        ]
+    else:
+        return []
+
+def is_within_budget(estimate):
+    return estimate["Peak memory (MB)"] <= memory_budget_mb and estimate["CPU time (s)"] <= cpu_budget_seconds
+
+def admit(method, num_records, num_dimensions=1, num_series=1, settings=None, mode=None):
+    # The resulting Settings are passed along as keyword arguments to the detector.
+    # Settings the detector needs to know about but which we never change (such as n_neighbors)
+    # can be passed in so that the estimate reflects them.
+    mode = mode or admission_mode
+    base_settings = dict(settings or {})
+    estimate = estimate_resources(method, num_records, num_dimensions, num_series, base_settings)
+    decision = {
+        "Decision": "accepted",
+        "Budget": { "Peak memory (MB)": memory_budget_mb, "CPU time (s)": cpu_budget_seconds },
+        "Original estimate": estimate,
+        "Estimate": estimate,
+        "Downgrade": None,
+        "Settings": {}
+    }
+    if is_within_budget(estimate):
+        return decision
+
+    if mode == "downgrade":
+        for (description, candidate_settings) in get_downgrades(method):
+            estimate = estimate_resources(method, num_records, num_dimensions, num_series, { **base_settings, **candidate_settings })
+            if is_within_budget(estimate):
+                decision["Decision"] = "downgraded"
+                decision["Downgrade"] = description
+                decision["Estimate"] = estimate
+                decision["Settings"] = candidate_settings
+                return decision
+
+    decision["Decision"] = "rejected"
+    decision["Estimate"] = estimate
+    return decision
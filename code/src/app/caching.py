@@ -0,0 +1,69 @@
+# Finding Ghosts in Your Data
+# Least-recently-used cache bounded by number of entries and by memory size
+
+import threading
+from collections import OrderedDict
+
+class SizedLRUCache:
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Key -> (value, size in bytes).  Most recently used entries are at the end.
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key][0]
+
+    def put(self, key, value, size_bytes):
+        with self._lock:
+            if key in self._entries:
+                self.total_bytes -= self._entries.pop(key)[1]
+            # An entry larger than the whole cache would only evict everything else.
+            if size_bytes > self.max_bytes or self.max_entries <= 0:
+                return False
+            self._entries[key] = (value, size_bytes)
+            self.total_bytes += size_bytes
+            while len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                (evicted_key, (evicted_value, evicted_size)) = self._entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+                self.evictions += 1
+            return True
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            (value, size_bytes) = self._entries.pop(key)
+            self.total_bytes -= size_bytes
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        return {
+            "Entries": len(self._entries),
+            "Bytes": self.total_bytes,
+            "Hits": self.hits,
+            "Misses": self.misses,
+            "Evictions": self.evictions
+        }
@@ -0,0 +1,290 @@
+# Finding Ghosts in Your Data
+# Process pool for running detectors outside of the API process
+
+import os
+import time
+import atexit
+import asyncio
+import hashlib
+import importlib
+import threading
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from . import timing, profiling, warmup
+from .models import parallel
+
+def parse_method_limits(setting):
+    # "multivariate=1,single_timeseries=2" becomes { "multivariate": 1, "single_timeseries": 2 }
+    limits = {}
+    for item in setting.split(","):
+        if item.strip() != "":
+            (method, limit) = item.split("=")
+            limits[method.strip()] = int(limit)
+    return limits
+
+def default_pool_sizes(cpu_count):
+    # Detection runs in parallel at two levels:  requests across our workers, and the parts of one
+    # large request (kernel fits, SAX shards) across that worker's model pool (see models/parallel.py).
+    # By default we split the CPUs between the two:  half as many workers as CPUs, each with a model
+    # pool of its share of the CPUs.  That gives up some throughput on many small requests so that a
+    # large time series request still runs in parallel, without starting more processes than CPUs.
+    # With only two or three CPUs, there is not enough to split:  we keep two workers, so that detection
+    # still runs outside the API process, and give the model pools whatever is left over.
+    api_workers = max(2, cpu_count // 2) if cpu_count >= 2 else 1
+    return (api_workers, max(1, cpu_count // api_workers))
+
+# Number of worker processes for detection work.  Set ANOMALY_API_WORKERS to 1
+# to run everything in the API process instead.
+max_workers = int(os.environ.get("ANOMALY_API_WORKERS", default_pool_sizes(os.cpu_count() or 1)[0]))
+# Requests allowed to wait for a worker on top of those running.  Past this point,
+# we turn requests away (with a 503) rather than build up a backlog.
+max_queued = int(os.environ.get("ANOMALY_MAX_QUEUED_REQUESTS", max_workers * 4))
+# Optional limits on how many requests of a given method may run at once, e.g.
+# "multivariate=1" keeps a few large multivariate requests from taking every worker.
+method_limits = parse_method_limits(os.environ.get("ANOMALY_METHOD_CONCURRENCY", ""))
+# Each worker may in turn start its own pool for the models, which on its own would have one process
+# per CPU, so that N workers could run N * N processes between them.  Unless ANOMALY_MODEL_WORKERS sets
+# the model pool size, each worker gets its share of the CPUs instead.
+model_workers = int(os.environ.get("ANOMALY_MODEL_WORKERS", max(1, (os.cpu_count() or 1) // max_workers)))
+# How long we ask clients to wait before retrying when we are too busy.
+retry_after_seconds = int(os.environ.get("ANOMALY_RETRY_AFTER_SECONDS", 5))
+
+class PoolBusy(Exception):
+    def __init__(self, retry_after, message="The anomaly detector service is too busy to take this request.  Please try again later."):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class WorkerFailed(PoolBusy):
+    # A worker process stopped while running the request.  We replace the worker, so the client may try again.
+    def __init__(self, retry_after):
+        super().__init__(retry_after, "A worker process stopped while running this request.  Please try again later.")
+
+_workers = None
+_in_flight = None
+_lock = threading.Lock()
+
+def get_workers():
+    # One single-process executor per worker rather than one shared pool, so that we can
+    # choose which process runs each task.
+    global _workers, _in_flight
+    if _workers is None:
+        _workers = [start_worker() for i in range(max_workers)]
+        _in_flight = [0 for w in _workers]
+    return _workers
+
+def start_worker():
+    # Spawn rather than fork, as the API process runs threads.
+    worker = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"), initializer=init_worker, initargs=(model_workers,))
+    atexit.register(worker.shutdown)
+    return worker
+
+def replace_worker(index, worker):
+    # A worker process which exits (say, killed for running out of memory) breaks its executor for good,
+    # and every later task for that worker would fail, including every series_id or group_id which hashes to it.
+    # So we start a new one in its place.  Tasks sent to the old worker count against it, not the new one.
+    with _lock:
+        if _workers[index] is not worker:
+            return
+        _workers[index] = start_worker()
+        _in_flight[index] = 0
+    worker.shutdown(wait=False)
+
+def init_worker(num_model_workers):
+    # Runs in each worker as it starts, before the models create their pool.
+    parallel.max_workers = num_model_workers
+
+def choose_worker(affinity=None):
+    # Tasks with an affinity key (a series_id or group_id) always go to the same worker so that
+    # they find the state which that worker cached for them.  Everything else goes to the
+    # worker with the fewest tasks in flight.
+    if affinity is not None:
+        return int(hashlib.blake2b(str(affinity).encode("utf-8"), digest_size=8).hexdigest(), 16) % max_workers
+    return _in_flight.index(min(_in_flight))
+
+def submit(fn, *args, affinity=None):
+    get_workers()
+    with _lock:
+        index = choose_worker(affinity)
+        worker = _workers[index]
+        _in_flight[index] += 1
+    try:
+        future = worker.submit(fn, *args)
+    except BrokenProcessPool:
+        # The worker died since its last task finished.  Replace it and try once more.
+        release_worker(index, worker)
+        replace_worker(index, worker)
+        return submit(fn, *args, affinity=affinity)
+    future.add_done_callback(lambda f: finish_task(f, index, worker))
+    return future
+
+def finish_task(future, index, worker):
+    release_worker(index, worker)
+    if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+        replace_worker(index, worker)
+
+def release_worker(index, worker):
+    with _lock:
+        if _workers[index] is worker:
+            _in_flight[index] -= 1
+
+def get_result(future):
+    # Tasks on a worker which died fail with BrokenProcessPool.  That is not the request's fault,
+    # and the worker has been replaced, so we ask the client to try again (a 503) rather than fail (a 500).
+    try:
+        return future.result()
+    except BrokenProcessPool:
+        raise WorkerFailed(retry_after_seconds)
+
+async def wait_for_result(future):
+    try:
+        return await asyncio.wrap_future(future)
+    except BrokenProcessPool:
+        raise WorkerFailed(retry_after_seconds)
+
+def get_detector(module_name, function_name):
+    # Look detectors up by name (e.g. "single_timeseries", "detect_single_timeseries")
+    # so that callers never need to pickle function references.
+    module = importlib.import_module("." + module_name, package=__package__ + ".models")
+    return getattr(module, function_name)
+
+def run_detector_many(module_name, function_name, calls):
+    # Runs inside a worker.  Each call is a tuple of (args, kwargs).  Running several
+    # small calls per task means one round trip to the worker instead of one per call.
+    f = get_detector(module_name, function_name)
+    return [f(*args, **kwargs) for (args, kwargs) in calls]
+
+def run_detector_instrumented(module_name, function_name, args, kwargs, profiler=None):
+    # Runs inside a worker.  Same as run_detector_many() for one call, but also returns how long
+    # each stage took and, if the caller asked for one, a profile (see profiling.py), as neither
+    # the caller's timings nor its profiler reach into the worker process.
+    f = get_detector(module_name, function_name)
+    with timing.collect() as timings, profiling.profile(profiler) as profile:
+        with timing.stage("Detect in worker"):
+            result = f(*args, **kwargs)
+    return (result, timings, profile)
+
+def warm_up_worker(module_names, run_detectors=True):
+    # Runs inside a worker.  Importing the detectors (and with them pandas, scikit-learn,
+    # ruptures, and tslearn) takes several seconds, and the first call to each detector costs more
+    # than later ones, so we do both before the first request.  Returns the time each detector took.
+    seconds = {}
+    for module_name in module_names:
+        start = time.perf_counter()
+        importlib.import_module("." + module_name, package=__package__ + ".models")
+        if run_detectors:
+            (function_name, args, kwargs) = warmup.make_call(module_name)
+            get_detector(module_name, function_name)(*args, **kwargs)
+        seconds[module_name] = time.perf_counter() - start
+    return { "pid": os.getpid(), "seconds": seconds }
+
+def warm_up(module_names):
+    # Start every worker process and wait until each has loaded and run the detectors.  The API
+    # process applies thresholds and summarizes segments itself, so it imports the detectors as well.
+    if max_workers <= 1:
+        return [warm_up_worker(module_names)]
+    futures = [w.submit(warm_up_worker, module_names) for w in get_workers()]
+    local = warm_up_worker(module_names, run_detectors=False)
+    return [local] + [f.result() for f in futures]
+
+def map_detector(module_name, function_name, calls, chunk_size=None, max_in_flight=None):
+    # Run many independent detector calls across the pool and return the results
+    # in the same order as the calls.  We keep at most max_in_flight chunks queued
+    # at any point so that one large batch cannot flood the pool.
+    calls = list(calls)
+    if len(calls) == 0:
+        return []
+    if max_workers <= 1:
+        return run_detector_many(module_name, function_name, calls)
+
+    max_in_flight = max_in_flight or max_workers * 2
+    # Aim for a few chunks per worker:  enough to balance uneven series, few enough
+    # that tiny series are packed together rather than sent one at a time.
+    chunk_size = chunk_size or max(1, len(calls) // (max_workers * 4))
+    chunks = [calls[i:i + chunk_size] for i in range(0, len(calls), chunk_size)]
+
+    results = [None] * len(chunks)
+    pending = {}
+    next_chunk = 0
+    while next_chunk < len(chunks) or pending:
+        while next_chunk < len(chunks) and len(pending) < max_in_flight:
+            future = submit(run_detector_many, module_name, function_name, chunks[next_chunk])
+            pending[future] = next_chunk
+            next_chunk += 1
+        (done, not_done) = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            results[pending.pop(future)] = get_result(future)
+    return [r for chunk_results in results for r in chunk_results]
+
+# Requests which are waiting for or holding a worker.  Only the event loop changes these.
+queued_requests = 0
+_slots_loop = None
+_slots = None
+_method_slots = {}
+_multiple_slots_lock = None
+
+def get_slots(method):
+    # Semaphores belong to an event loop, so we create them on first use in the running loop.
+    global _slots_loop, _slots, _method_slots, _multiple_slots_lock
+    loop = asyncio.get_running_loop()
+    if _slots_loop is not loop:
+        _slots_loop = loop
+        _slots = asyncio.Semaphore(max_workers)
+        _method_slots = {}
+        _multiple_slots_lock = asyncio.Lock()
+    if method not in _method_slots:
+        _method_slots[method] = asyncio.Semaphore(method_limits.get(method, max_workers))
+    return (_slots, _method_slots[method])
+
+@contextlib.asynccontextmanager
+async def reserve(method, count=1):
+    # Hold a place in line for one request.  At most max_workers requests run at once
+    # (fewer for a method with its own limit), at most max_queued more wait their turn,
+    # and past that we raise PoolBusy right away.  A request which runs on several workers
+    # at once, such as a batch, asks for count places, up to the method's limit, and gets
+    # back the number it holds.
+    global queued_requests
+    count = max(1, min(count, max_workers, method_limits.get(method, max_workers)))
+    if queued_requests + count > max_workers + max_queued:
+        raise PoolBusy(retry_after_seconds)
+    queued_requests += count
+    acquired = []
+    try:
+        (slots, method_slots) = get_slots(method)
+        # Requests which need several places take them one request at a time.  Otherwise two of them
+        # could each hold some of the places and wait forever for the rest.
+        async with (_multiple_slots_lock if count > 1 else contextlib.nullcontext()):
+            # Wait on the method's limit first so that a request held back by its
+            # method's limit does not also hold up requests for other methods.
+            for semaphore in [method_slots] * count + [slots] * count:
+                await semaphore.acquire()
+                acquired.append(semaphore)
+        yield count
+    finally:
+        for semaphore in acquired:
+            semaphore.release()
+        queued_requests -= count
+
+async def run_detector(module_name, function_name, args, kwargs=None, affinity=None):
+    # Run one detector call without blocking the event loop.  Callers hold a reserve() first.
+    # If the caller is collecting timings (see timing.py) or profiling, we bring back the worker's timings
+    # and profile as well.
+    kwargs = kwargs or {}
+    profiler = profiling.current_profiler()
+    instrumented = timing.enabled() or profiler is not None
+    if instrumented:
+        (fn, fn_args) = (run_detector_instrumented, (module_name, function_name, args, kwargs, profiler))
+    else:
+        (fn, fn_args) = (run_detector_many, (module_name, function_name, [(args, kwargs)]))
+    if max_workers <= 1:
+        # No pool, so run in a thread.  Detection still holds the GIL, but the API keeps answering.
+        results = await asyncio.get_running_loop().run_in_executor(None, fn, *fn_args)
+    else:
+        results = await wait_for_result(submit(fn, *fn_args, affinity=affinity))
+    if instrumented:
+        (result, timings, profile) = results
+        timing.merge(timings)
+        profiling.add_profile(profile)
+        return result
+    return results[0]
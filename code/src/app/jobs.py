@@ -0,0 +1,158 @@
+# Finding Ghosts in Your Data
+# Job store for detection requests which run in the background
+# Clients submit a job, get back its id right away, and poll for status.  Job status,
+# diagnostics, and results live in a local SQLite database, so that a client can page
+# through a large result set without one huge response.  Jobs expire after a while.
+# Several API processes may share the database (uvicorn --workers, or containers sharing a volume),
+# and jobs run inside the process which took them.  So each job records its owner, each process
+# records a heartbeat every so often, and we fail only unfinished jobs whose owner has stopped.
+
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import tempfile
+import threading
+from .serialization import encode_value
+
+database_path = os.environ.get("ANOMALY_JOB_DATABASE", os.path.join(tempfile.gettempdir(), "anomaly_jobs.sqlite3"))
+job_ttl_seconds = float(os.environ.get("ANOMALY_JOB_TTL_SECONDS", 24 * 60 * 60))
+# How often we delete expired jobs.
+cleanup_interval_seconds = float(os.environ.get("ANOMALY_JOB_CLEANUP_SECONDS", 5 * 60))
+# How often each process records that it is still running.  After missing three heartbeats,
+# a process has stopped, and its unfinished jobs have failed.
+heartbeat_seconds = float(os.environ.get("ANOMALY_JOB_HEARTBEAT_SECONDS", 30))
+MISSED_HEARTBEATS = 3
+
+# This process, which owns the jobs it takes.  The process id alone may be reused after a restart.
+instance_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+# Results are stored in chunks of this many rows, so that reading one page
+# only has to read and parse the chunks which overlap with it.
+RESULT_CHUNK_ROWS = 1000
+# Largest page of results a client may ask for at once.
+MAX_PAGE_ROWS = 10000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    method TEXT NOT NULL,
+    status TEXT NOT NULL,
+    stage TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    expires REAL NOT NULL,
+    result_key TEXT,
+    num_results INTEGER,
+    weights TEXT,
+    details TEXT,
+    owner TEXT
+);
+CREATE TABLE IF NOT EXISTS job_results (
+    job_id TEXT NOT NULL,
+    chunk INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (job_id, chunk)
+);
+CREATE INDEX IF NOT EXISTS jobs_expires ON jobs (expires);
+CREATE TABLE IF NOT EXISTS instances (
+    owner TEXT PRIMARY KEY,
+    heartbeat REAL NOT NULL
+);
+"""
+
+_initialized_path = None
+_lock = threading.Lock()
+
+def connect():
+    # One connection per call:  jobs are updated from the event loop and from worker threads.
+    global _initialized_path
+    connection = sqlite3.connect(database_path, timeout=30)
+    with _lock:
+        if _initialized_path != database_path:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(SCHEMA)
+            # Databases created before jobs had owners.
+            if "owner" not in [r[1] for r in connection.execute("PRAGMA table_info(jobs)").fetchall()]:
+                connection.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+            _initialized_path = database_path
+    return connection
+
+def create_job(method):
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    with connect() as connection:
+        connection.execute(
+            "INSERT INTO jobs (job_id, method, status, stage, created, updated, expires, owner) VALUES (?, ?, 'queued', 'Waiting for a worker', ?, ?, ?, ?)",
+            (job_id, method, now, now, now + job_ttl_seconds, instance_id))
+    return job_id
+
+def set_status(job_id, status, stage=None, error=None):
+    now = time.time()
+    with connect() as connection:
+        connection.execute(
+            "UPDATE jobs SET status = ?, stage = ?, error = ?, updated = ?, expires = ? WHERE job_id = ?",
+            (status, stage, error, now, now + job_ttl_seconds, job_id))
+
+def store_results(job_id, result_key, df, weights, details):
+    chunks = [(job_id, i // RESULT_CHUNK_ROWS, df.iloc[i:i + RESULT_CHUNK_ROWS].to_json(orient="records", date_format="iso"))
+        for i in range(0, df.shape[0], RESULT_CHUNK_ROWS)]
+    now = time.time()
+    with connect() as connection:
+        connection.execute("DELETE FROM job_results WHERE job_id = ?", (job_id,))
+        connection.executemany("INSERT INTO job_results (job_id, chunk, data) VALUES (?, ?, ?)", chunks)
+        connection.execute(
+            "UPDATE jobs SET status = 'succeeded', stage = 'Done', result_key = ?, num_results = ?, weights = ?, details = ?, updated = ?, expires = ? WHERE job_id = ?",
+            (result_key, df.shape[0], encode_value(weights), encode_value(details), now, now + job_ttl_seconds, job_id))
+
+def get_job(job_id):
+    with connect() as connection:
+        connection.row_factory = sqlite3.Row
+        row = connection.execute("SELECT * FROM jobs WHERE job_id = ? AND expires > ?", (job_id, time.time())).fetchone()
+    if row is None:
+        return None
+    job = dict(row)
+    job["weights"] = json.loads(job["weights"]) if job["weights"] is not None else None
+    job["details"] = json.loads(job["details"]) if job["details"] is not None else None
+    return job
+
+def get_results(job_id, offset, limit):
+    # Returns the rows in [offset, offset + limit).
+    if limit <= 0:
+        return []
+    first_chunk = offset // RESULT_CHUNK_ROWS
+    last_chunk = (offset + limit - 1) // RESULT_CHUNK_ROWS
+    with connect() as connection:
+        chunks = connection.execute(
+            "SELECT chunk, data FROM job_results WHERE job_id = ? AND chunk BETWEEN ? AND ? ORDER BY chunk",
+            (job_id, first_chunk, last_chunk)).fetchall()
+    rows = [r for (chunk, data) in chunks for r in json.loads(data)]
+    start = offset - first_chunk * RESULT_CHUNK_ROWS
+    return rows[start:start + limit]
+
+def delete_expired():
+    with connect() as connection:
+        expired = [r[0] for r in connection.execute("SELECT job_id FROM jobs WHERE expires <= ?", (time.time(),)).fetchall()]
+        connection.executemany("DELETE FROM job_results WHERE job_id = ?", [(j,) for j in expired])
+        connection.executemany("DELETE FROM jobs WHERE job_id = ?", [(j,) for j in expired])
+    return len(expired)
+
+def heartbeat(connection):
+    connection.execute("INSERT OR REPLACE INTO instances (owner, heartbeat) VALUES (?, ?)", (instance_id, time.time()))
+
+def fail_unfinished_jobs():
+    # Jobs run inside the API process which took them, so any job still queued or running after its
+    # process has stopped was lost.  We run this at startup and with every heartbeat.
+    now = time.time()
+    cutoff = now - heartbeat_seconds * MISSED_HEARTBEATS
+    with connect() as connection:
+        heartbeat(connection)
+        connection.execute("DELETE FROM instances WHERE heartbeat <= ?", (cutoff,))
+        cursor = connection.execute(
+            "UPDATE jobs SET status = 'failed', stage = NULL, error = 'The service restarted before this job finished.', updated = ? " +
+            "WHERE status IN ('queued', 'running') AND (owner IS NULL OR owner NOT IN (SELECT owner FROM instances))",
+            (now,))
+        return cursor.rowcount
@@ -1,13 +1,405 @@
 # Finding Ghosts in Your Data
-from typing import Optional, List
-from fastapi import FastAPI
-from pydantic import BaseModel
+from typing import Optional, List, Dict, Union
+from contextlib import asynccontextmanager, suppress, nullcontext
+from fastapi import FastAPI, HTTPException, Request, Header, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, Response, PlainTextResponse, FileResponse
+from starlette.datastructures import Headers
+from pydantic import BaseModel, model_validator
 import pandas as pd
-import json
 import datetime
-from app.models import univariate, multivariate, single_timeseries, multi_timeseries
+import asyncio
+import logging
+import os
+import hmac
+import time
+import urllib.parse
+import sqlite3
+from app.models import thresholds
+from app import admission, executor, warmup, serialization, jobs, tables, result_cache, scores, timing, metrics, profiling
 
-app = FastAPI()
+# Detection runs on a pool of worker processes (see executor.py).  We load detectors only when
+# we need them (see warmup.py), so the server starts quickly, and then start the workers and warm up
+# each enabled detector in the background.  GET /ready reports 503 until warmup finishes.
+# Jobs (see jobs.py) run inside the process which took them, so any job left unfinished by a process
+# which has stopped, including this one before a restart, has failed.
+@asynccontextmanager
+async def lifespan(app):
+    await run_in_threadpool(jobs.fail_unfinished_jobs)
+    tasks = [asyncio.create_task(clean_up_jobs()), asyncio.create_task(check_jobs()), asyncio.create_task(warm_up())]
+    yield
+    for task in tasks:
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+
+async def warm_up():
+    if not warmup.warm_up_enabled:
+        warmup.state.update({ "status": "ready", "seconds": 0.0 })
+        return
+    warmup.state.update({ "status": "warming up" })
+    start = time.perf_counter()
+    try:
+        processes = await run_in_threadpool(executor.warm_up, warmup.enabled_detectors)
+    except Exception as e:
+        logging.exception("Could not warm up the detectors.")
+        warmup.state.update({ "status": "failed", "error": str(e) })
+        return
+    warmup.state.update({
+        "status": "ready",
+        "seconds": time.perf_counter() - start,
+        "detectors": { d: max([p["seconds"][d] for p in processes]) for d in warmup.enabled_detectors }
+    })
+
+app = FastAPI(lifespan=lifespan)
+
+# When every worker is busy and the queue is full, or a worker stopped partway through the request, ask the client to come back later.
+@app.exception_handler(executor.PoolBusy)
+async def pool_busy_handler(request: Request, exc: executor.PoolBusy):
+    return JSONResponse(status_code=503, content={ "message": str(exc) }, headers={ "Retry-After": str(exc.retry_after) })
+
+# Requests collect per-stage timings (see timing.py) for requests with debug = true, for profiles of slow
+# and sampled requests (see profiling.py), and, if stage timings are turned on, for the service metrics
+# at /metrics (see metrics.py).  Otherwise, the metrics only count and time each request as a whole.
+# Debug details include the timings under "Timings", and the Server-Timing header has them as well,
+# along with the time to encode the response.
+# A response from the response cache keeps the timings of the run which produced it, while its
+# Server-Timing header describes the request which got it from the cache.
+def wants_timings(scope):
+    debug = urllib.parse.parse_qs(scope.get("query_string", b"").decode("latin-1")).get("debug", ["false"])[-1]
+    return debug.lower() in ("true", "1", "yes", "on", "t", "y")
+
+def get_endpoint(scope):
+    # The route's path template, e.g. /jobs/{job_id}, so that each endpoint is one label value.
+    route = scope.get("route")
+    return getattr(route, "path", "unmatched")
+
+def instrumentation_middleware(app):
+    async def middleware(scope, receive, send):
+        if scope["type"] != "http":
+            return await app(scope, receive, send)
+        debug = wants_timings(scope)
+        if not debug and not metrics.enabled and not profiling.enabled:
+            return await app(scope, receive, send)
+        request_start = time.perf_counter()
+        collect_timings = debug or profiling.enabled or metrics.stage_timings
+        # Anything which fails before sending a response becomes a 500.
+        status = 500
+        with (timing.collect(request_start=request_start) if collect_timings else nullcontext({})) as timings, metrics.track_request() as request, profiling.track_request() as profile:
+            async def send_with_timings(message):
+                nonlocal status
+                if message["type"] == "http.response.start":
+                    status = message["status"]
+                    if debug:
+                        message["headers"] = [*message.get("headers", []), (b"server-timing", timing.server_timing(timings).encode("utf-8"))]
+                await send(message)
+            try:
+                await app(scope, receive, send_with_timings)
+            finally:
+                seconds = time.perf_counter() - request_start
+                if metrics.enabled:
+                    metrics.observe_request(get_endpoint(scope), scope["method"], status, seconds, timings, request["method"])
+                if profiling.should_keep(profile, seconds):
+                    await keep_profile(scope, status, seconds, timings, request, profile)
+    return middleware
+
+async def keep_profile(scope, status, seconds, timings, request, profile):
+    # We keep the request's parameters and input size, but not its data.
+    metadata = {
+        "endpoint": get_endpoint(scope),
+        "http_method": scope["method"],
+        "path": scope["path"],
+        "parameters": urllib.parse.parse_qs(scope.get("query_string", b"").decode("latin-1")),
+        "method": request["method"],
+        "num_records": request["num_records"],
+        "status": status,
+        "seconds": seconds,
+        "timings": timing.report(timings)
+    }
+    # The response has gone out already, so a profile we cannot write should not fail the request.
+    try:
+        await run_in_threadpool(profiling.write_profile, profile, metadata)
+    except OSError:
+        logging.exception("Could not write a request profile.")
+
+# A request which repeats one we have answered, byte for byte, gets the cached response before we
+# parse it (see result_cache.py).  Anything else goes on to the endpoint, which hashes the prepared call.
+# We add this before instrumentation_middleware, so that instrumentation wraps it and sees those hits too.
+CACHED_PATHS = ["/detect/univariate", "/detect/multivariate", "/detect/timeseries/single", "/detect/timeseries/multiple", "/detect/timeseries/multiple/wide"]
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            return b"".join(chunks)
+
+def raw_cache_middleware(app):
+    async def middleware(scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in CACHED_PATHS:
+            return await app(scope, receive, send)
+        headers = Headers(scope=scope)
+        if serialization.wants_ndjson(headers.get("accept")):
+            return await app(scope, receive, send)
+        body = await read_body(receive)
+        if body is None:
+            return
+        with timing.stage("Hash request body"):
+            raw_key = await run_in_threadpool(result_cache.hash_raw_request, scope["path"], scope.get("query_string", b""), headers.get("content-type", ""), body)
+        (key, cached_body, keep_scores) = await run_in_threadpool(result_cache.get_raw, raw_key)
+        if cached_body is not None and (not keep_scores or await run_in_threadpool(scores.get, key) is not None):
+            scope["route"] = next((r for r in scope["app"].routes if getattr(r, "path", None) == scope["path"]), None)
+            return await cached_response(key, cached_body, headers.get("if-none-match"))(scope, receive, send)
+
+        body_sent = False
+        async def receive_body():
+            nonlocal body_sent
+            if body_sent:
+                return await receive()
+            body_sent = True
+            return { "type": "http.request", "body": body, "more_body": False }
+        with result_cache.track_raw_request(raw_key):
+            await app(scope, receive_body, send)
+    return middleware
+
+app.add_middleware(raw_cache_middleware)
+app.add_middleware(instrumentation_middleware)
+
+# Encoding a large response takes long enough that we do it off the event loop.
+# Clients which accept application/x-ndjson get results streamed one row per line instead, with
+# weights and diagnostics (if any) on the last line.  orient does not apply to NDJSON.
+async def respond(results, orient, accept=None):
+    if serialization.wants_ndjson(accept):
+        return serialization.ndjson_response(results)
+    with timing.stage("Encode response"):
+        return await run_in_threadpool(serialization.json_response, results, orient)
+
+# Estimate the resources a request needs before running any tests.
+# Requests over budget may be downgraded to cheaper detector settings; if
+# that is not enough (or downgrades are turned off), reject the request.
+# Servers may run only some of the detectors (see warmup.py).
+def check_detector(method):
+    if method not in warmup.enabled_detectors:
+        raise HTTPException(status_code=404, detail=f"The {method} detector is not enabled on this server.")
+
+@timing.timed("Admission control")
+def admit_request(method, num_records, num_dimensions=1, num_series=1, settings=None):
+    check_detector(method)
+    metrics.describe_request(method, num_records)
+    metrics.observe("anomaly_input_records", { "method": method }, num_records)
+    decision = admission.admit(method, num_records, num_dimensions, num_series, settings)
+    if decision["Decision"] == "rejected":
+        raise HTTPException(status_code=413, detail={
+            "message": "The request is too large to process within the configured resource budget.",
+            "Admission control": decision
+        })
+    return decision
+
+# Every endpoint takes an orient option for results:  records (the default, one object per row)
+# or columns (one array per column).  See serialization.py.
+def check_option(name, value, options):
+    if value not in options:
+        raise HTTPException(status_code=400, detail=f"{name} must be one of {', '.join(options)}.")
+
+def add_admission_details(details, decision):
+    # Validation failures come back as a string message, in which case no tests ran.
+    if isinstance(details, dict):
+        details["Admission control"] = decision
+    return details
+
+# Every endpoint accepts either a list of records (one object per data point) or a columnar body
+# with one list per field, e.g. { "key": [...], "value": [...] }.  Columnar bodies are validated
+# a whole column at a time and go straight into pandas without creating an object per data point.
+class Columnar_Input(BaseModel):
+    @model_validator(mode="after")
+    def check_column_lengths(self):
+        lengths = set([len(v) for v in self.__dict__.values()])
+        if len(lengths) > 1:
+            raise ValueError("All columns must have the same number of values.")
+        return self
+
+def build_input_frame(input_data):
+    timing.since_request_start("Parse request")
+    with timing.stage("Build input frame"):
+        return build_frame(input_data)
+
+def build_frame(input_data):
+    # Arrow and Parquet uploads arrive as a DataFrame already.
+    if isinstance(input_data, pd.DataFrame):
+        return input_data
+    if isinstance(input_data, list):
+        return pd.DataFrame(i.__dict__ for i in input_data)
+    return pd.DataFrame(input_data.__dict__)
+
+# Each endpoint prepares a detector call:  which detector to run and with what, the admission decision,
+# and how to shape the output.  /detect endpoints run the call and wait for it, while /jobs endpoints
+# run the same call in the background.  Building the input frame takes a while for large requests, so
+# endpoints prepare calls in the threadpool rather than hold up the event loop.
+# The call keeps the detector as prepared, in case we need to score without applying settings (see keep_scores).
+# With output_mode = "segments", the worker summarizes its results and sends back only the segment rows.
+def prepare_call(method, function, args, kwargs, decision, affinity=None, output_mode="points", include_keys=False):
+    call = {
+        "method": method,
+        "module": method,
+        "function": function,
+        "args": args,
+        "kwargs": kwargs,
+        "detector": (method, function, args, kwargs),
+        "decision": decision,
+        "affinity": affinity,
+        "output_mode": output_mode,
+        "include_keys": include_keys
+    }
+    if output_mode == "segments":
+        call.update({ "module": "thresholds", "function": "detect_segments", "args": (method, function, args, kwargs, include_keys), "kwargs": {} })
+    return call
+
+async def run_call(call, on_start=None):
+    queued = time.perf_counter()
+    async with executor.reserve(call["method"]):
+        timing.add("Wait for a worker", time.perf_counter() - queued)
+        if on_start is not None:
+            await on_start()
+        # Includes sending the call to a worker and its results back, on top of the worker's own time.
+        with timing.stage("Run detector"):
+            (results, weights, details) = await executor.run_detector(call["module"], call["function"], call["args"], call["kwargs"], affinity=call["affinity"])
+    metrics.count_tests(call["method"], details)
+    return (results, weights, details)
+
+# The main detection endpoints accept several values of sensitivity_score and max_fraction_anomalies,
+# e.g. ?sensitivity_score=40&sensitivity_score=60, and apply every combination of the two.
+# We score the input once and apply each setting to the same scores (see models/thresholds.py).
+def get_settings(sensitivity_scores, max_fraction_anomalies, always_check=False):
+    settings = [(s, m) for s in sensitivity_scores for m in max_fraction_anomalies]
+    # With a single setting, the detector checks the values itself as it always has.
+    if (len(settings) > 1 or always_check) and not all([0 < s <= 100 and 0 < m <= 1.0 for (s, m) in settings]):
+        raise HTTPException(status_code=400, detail="Each sensitivity_score must be in (0, 100] and each max_fraction_anomalies in (0, 1.0].")
+    return settings
+
+def check_settings_output(settings, output_mode):
+    if len(settings) > 1 and output_mode == "segments":
+        raise HTTPException(status_code=400, detail="output_mode segments supports only one sensitivity_score and max_fraction_anomalies.")
+
+def with_settings(call, settings):
+    call = { **call, "settings": settings }
+    if len(settings) <= 1:
+        return call
+    check_settings_output(settings, call["output_mode"])
+    return {
+        **call,
+        "module": "thresholds",
+        "function": "detect_settings",
+        "args": (*call["detector"], settings),
+        "kwargs": {}
+    }
+
+# Identical requests get identical responses, so we cache encoded JSON responses by a hash of the
+# prepared call and output options (see result_cache.py).  The hash is also the response's ETag:
+# a client which sends it back in If-None-Match gets a 304 with no body while the response is cached.
+# NDJSON responses are streamed and never cached.
+async def respond_to_call(call, debug, orient, accept=None, if_none_match=None, keep_scores=False):
+    if keep_scores:
+        return await respond_with_scores(call, debug, orient, accept, if_none_match)
+    if not is_cacheable(call, accept):
+        (df, weights, details) = await run_call(call)
+        return await respond(build_results(call, df, weights, details, debug), orient, accept)
+
+    with timing.stage("Hash request"):
+        key = await run_in_threadpool(result_cache.hash_request, call, { "debug": debug, "orient": orient })
+    result_cache.remember_raw_key(key)
+    body = await run_in_threadpool(result_cache.get, key)
+    if body is not None:
+        return cached_response(key, body, if_none_match)
+
+    (df, weights, details) = await run_call(call)
+    response = await respond(build_results(call, df, weights, details, debug), orient)
+    return await cache_response(key, response)
+
+# Calls with a series_id or group_id depend on what their worker has already seen of that series or
+# group (see run_tests_stateful() in multi_timeseries.py), not on the request alone, so we never cache them.
+def is_cacheable(call, accept):
+    return call["affinity"] is None and not serialization.wants_ndjson(accept)
+
+def cached_response(key, body, if_none_match):
+    etag = f'"{key}"'
+    if if_none_match is not None and any([t.strip().removeprefix("W/") in (etag, "*") for t in if_none_match.split(",")]):
+        return Response(status_code=304, headers={ "ETag": etag })
+    return Response(content=body, media_type="application/json", headers={ "ETag": etag, "X-Cache": "hit" })
+
+async def cache_response(key, response):
+    await run_in_threadpool(result_cache.put, key, response.body)
+    response.headers["ETag"] = f'"{key}"'
+    response.headers["X-Cache"] = "miss"
+    return response
+
+# With keep_scores = true, we score the input, keep the scores under a score_id (see scores.py),
+# and then apply the settings.  GET /rethreshold/{score_id} applies other settings to the same scores
+# without running the detectors again.  The score_id is the request hash, so a repeated request
+# gets the same score_id and, while those scores are still kept, the cached response.
+async def respond_with_scores(call, debug, orient, accept=None, if_none_match=None):
+    cache = is_cacheable(call, accept)
+    if cache:
+        with timing.stage("Hash request"):
+            key = await run_in_threadpool(result_cache.hash_request, call, { "debug": debug, "orient": orient, "keep_scores": True })
+        result_cache.remember_raw_key(key, keep_scores=True)
+        body = await run_in_threadpool(result_cache.get, key)
+        if body is not None and await run_in_threadpool(scores.get, key) is not None:
+            return cached_response(key, body, if_none_match)
+
+    (module, function, args, kwargs) = call["detector"]
+    (scored, weights, details) = await run_call({ **call, "module": "thresholds", "function": "score_input", "args": (module, function, args, kwargs), "kwargs": {} })
+    if isinstance(details, str):
+        df = await run_in_threadpool(thresholds.shape_output, module, scored["df"], call["output_mode"], call["include_keys"])
+        return await respond(build_results(call, df, weights, details, debug), orient, accept)
+
+    score_id = await run_in_threadpool(scores.put, {
+        "module": module,
+        "scored": scored,
+        "weights": weights,
+        "details": details,
+        "decision": call["decision"],
+        "output_mode": call["output_mode"],
+        "include_keys": call["include_keys"]
+    }, key if cache else None)
+    (df, weights, details) = await run_in_threadpool(thresholds.apply_settings, module, scored, weights, details, call["settings"], call["output_mode"], call["include_keys"])
+    results = { "score_id": score_id, **build_results(call, df, weights, details, debug) }
+    response = await respond(results, orient, accept)
+    if cache:
+        return await cache_response(key, response)
+    return response
+
+def build_results(call, df, weights, details, debug):
+    # output_mode = "segments" (multiple time series only) returns one record per series segment instead of one per data point.
+    # By this point, df holds the segments (see thresholds.detect_segments() and apply_settings()).
+    if call["output_mode"] == "segments":
+        results = { "segments": df }
+    else:
+        results = { "anomalies": df }
+
+    # Incremental single time series results can differ from a full solve of the same series.
+    if isinstance(details, dict) and details.get("Approximate"):
+        results["approximate"] = True
+
+    # With several settings, threshold columns such as is_anomaly come once per setting:  is_anomaly_0 for the first, and so on.
+    if len(call.get("settings") or []) > 1 and isinstance(details, dict):
+        results.update({ "settings": [{
+            "sensitivity_score": s,
+            "max_fraction_anomalies": m,
+            "num_anomalies": int(df[f"is_anomaly_{i}"].sum())
+        } for (i, (s, m)) in enumerate(call["settings"])] })
+
+    if (debug):
+        results.update({ "debug_weights": weights })
+        results.update({ "debug_details": add_timings(add_admission_details(details, call["decision"])) })
+    return results
+
+def add_timings(details):
+    if isinstance(details, dict) and timing.enabled():
+        details["Timings"] = timing.report(timing.current())
+    return details
 
 @app.get("/")
 def doc():
@@ -16,31 +408,89 @@ def doc():
         "documentation": "If you want to see the OpenAPI specification, navigate to the /redoc/ path on this server."
     }
 
+# Readiness for load balancers and orchestrators:  200 once every enabled detector has warmed up, 503 until then or if warmup failed.
+@app.get("/ready")
+def get_ready():
+    return JSONResponse(status_code=200 if warmup.state["status"] == "ready" else 503, content=warmup.state)
+
+# Hit and miss counts for the response cache.
+@app.get("/cache/stats")
+def get_cache_stats():
+    return result_cache.stats()
+
+# Service metrics in the Prometheus text format.  Gauges and cache counts are read as of the scrape.
+@app.get("/metrics")
+def get_metrics():
+    metrics.set_value("anomaly_queued_requests", {}, executor.queued_requests)
+    metrics.set_value("anomaly_queue_capacity", {}, executor.max_workers + executor.max_queued)
+    metrics.set_value("anomaly_running_jobs", {}, len(running_jobs))
+    metrics.set_cache_stats("response", result_cache.memory_cache.stats())
+    metrics.set_cache_stats("scores", scores.score_cache.stats())
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# Profiles of slow and sampled requests (see profiling.py).  These endpoints require ANOMALY_ADMIN_TOKEN
+# in the X-Admin-Token header, and do not exist (a 404) unless ANOMALY_ADMIN_TOKEN is set.
+def check_admin_token(x_admin_token):
+    if profiling.admin_token == "":
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not hmac.compare_digest((x_admin_token or "").encode("utf-8"), profiling.admin_token.encode("utf-8")):
+        raise HTTPException(status_code=403, detail="This endpoint requires a valid X-Admin-Token header.")
+
+@app.get("/admin/profiles")
+async def get_profiles(x_admin_token: Optional[str] = Header(default=None)):
+    check_admin_token(x_admin_token)
+    return { "profiles": await run_in_threadpool(profiling.list_profiles) }
+
+@app.get("/admin/profiles/{profile_id}")
+async def get_profile(profile_id: str, x_admin_token: Optional[str] = Header(default=None)):
+    check_admin_token(x_admin_token)
+    metadata = await run_in_threadpool(profiling.get_profile, profile_id)
+    if metadata is None:
+        raise HTTPException(status_code=404, detail=f"Profile {profile_id} does not exist or has been deleted.")
+    return metadata
+
+# Downloads the profile itself:  a .prof file for pstats or snakeviz, or a .folded file of sampled stacks for flamegraph.pl or speedscope.
+@app.get("/admin/profiles/{profile_id}/download")
+async def download_profile(profile_id: str, x_admin_token: Optional[str] = Header(default=None)):
+    check_admin_token(x_admin_token)
+    file_name = await run_in_threadpool(profiling.get_profile_file, profile_id)
+    if file_name is None or not os.path.exists(file_name):
+        raise HTTPException(status_code=404, detail=f"Profile {profile_id} has no profile data or does not exist.")
+    return FileResponse(file_name, media_type="application/octet-stream", filename=os.path.basename(file_name))
+
 # Univariate statistical anomaly detection
 # For more information on this, review chapters 6-8
 class Univariate_Statistical_Input(BaseModel):
     key: str
     value: float
 
+class Univariate_Statistical_Columnar_Input(Columnar_Input):
+    key: List[str]
+    value: List[float]
+
     
 @app.post("/detect/univariate")
-def post_univariate(
-    input_data: List[Univariate_Statistical_Input],
-    sensitivity_score: float = 50,
-    max_fraction_anomalies: float = 1.0,
-    debug: bool = False
+async def post_univariate(
+    input_data: Union[List[Univariate_Statistical_Input], Univariate_Statistical_Columnar_Input],
+    sensitivity_score: List[float] = Query(default=[50]),
+    max_fraction_anomalies: List[float] = Query(default=[1.0]),
+    orient: str = "records",
+    debug: bool = False,
+    keep_scores: bool = False,
+    accept: Optional[str] = Header(default=None),
+    if_none_match: Optional[str] = Header(default=None)
 ):
-    df = pd.DataFrame(i.__dict__ for i in input_data)
-
-    (df, weights, details) = univariate.detect_univariate_statistical(df, sensitivity_score, max_fraction_anomalies)
+    check_option("orient", orient, serialization.ORIENTS)
+    settings = get_settings(sensitivity_score, max_fraction_anomalies)
+    call = with_settings(await run_in_threadpool(prepare_univariate, input_data, *settings[0]), settings)
     
     # If debug = False, include only key, value, is_anomaly, and anomaly_score.  Remove other values
-    results = { "anomalies": json.loads(df.to_json(orient='records')) }
-    
-    if (debug):
-        results.update({ "debug_weights": weights })
-        results.update({ "debug_details": details })
-    return results
+    return await respond_to_call(call, debug, orient, accept, if_none_match, keep_scores)
+
+def prepare_univariate(input_data, sensitivity_score, max_fraction_anomalies):
+    df = build_input_frame(input_data)
+    decision = admit_request("univariate", df.shape[0])
+    return prepare_call("univariate", "detect_univariate_statistical", (df, sensitivity_score, max_fraction_anomalies), decision["Settings"], decision)
     
     
 # Multivariate anomaly detection with clustering and COPOD
@@ -48,25 +498,33 @@ def post_univariate(
 class Multivariate_Input(BaseModel):
     key: str
     vals: list = []
+
+class Multivariate_Columnar_Input(Columnar_Input):
+    key: List[str]
+    vals: List[list]
     
 @app.post("/detect/multivariate")
-def post_multivariate(
-    input_data: List[Multivariate_Input],
-    sensitivity_score: float = 50,
-    max_fraction_anomalies: float = 1.0,
+async def post_multivariate(
+    input_data: Union[List[Multivariate_Input], Multivariate_Columnar_Input],
+    sensitivity_score: List[float] = Query(default=[50]),
+    max_fraction_anomalies: List[float] = Query(default=[1.0]),
     n_neighbors: int = 10,
-    debug: bool = False
+    orient: str = "records",
+    debug: bool = False,
+    keep_scores: bool = False,
+    accept: Optional[str] = Header(default=None),
+    if_none_match: Optional[str] = Header(default=None)
 ):
-    df = pd.DataFrame(i.__dict__ for i in input_data)
-    
-    (df, weights, details) = multivariate.detect_multivariate_statistical(df, sensitivity_score, max_fraction_anomalies, n_neighbors)
-    
-    results = { "anomalies": json.loads(df.to_json(orient='records')) }
-    
-    if (debug):
-        results.update({ "debug_weights": weights })
-        results.update({ "debug_details": details })
-    return results
+    check_option("orient", orient, serialization.ORIENTS)
+    settings = get_settings(sensitivity_score, max_fraction_anomalies)
+    call = with_settings(await run_in_threadpool(prepare_multivariate, input_data, *settings[0], n_neighbors), settings)
+    return await respond_to_call(call, debug, orient, accept, if_none_match, keep_scores)
+
+def prepare_multivariate(input_data, sensitivity_score, max_fraction_anomalies, n_neighbors):
+    df = build_input_frame(input_data)
+    num_dimensions = max([len(v) for v in df['vals']]) if df.shape[0] > 0 else 0
+    decision = admit_request("multivariate", df.shape[0], num_dimensions, settings={ "n_neighbors": n_neighbors })
+    return prepare_call("multivariate", "detect_multivariate_statistical", (df, sensitivity_score, max_fraction_anomalies, n_neighbors), decision["Settings"], decision)
     
 
 # Time series anomaly detection
@@ -75,25 +533,96 @@ class Single_TimeSeries_Input(BaseModel):
     key: str
     dt: datetime.datetime
     value: float
+
+class Single_TimeSeries_Columnar_Input(Columnar_Input):
+    key: List[str]
+    dt: List[datetime.datetime]
+    value: List[float]
     
 @app.post("/detect/timeseries/single")
-def post_time_series_single(
-    input_data: List[Single_TimeSeries_Input],
+async def post_time_series_single(
+    input_data: Union[List[Single_TimeSeries_Input], Single_TimeSeries_Columnar_Input],
+    sensitivity_score: List[float] = Query(default=[50]),
+    max_fraction_anomalies: List[float] = Query(default=[1.0]),
+    series_id: Optional[str] = None,
+    incremental: bool = False,
+    orient: str = "records",
+    debug: bool = False,
+    keep_scores: bool = False,
+    accept: Optional[str] = Header(default=None),
+    if_none_match: Optional[str] = Header(default=None)
+):
+    check_option("orient", orient, serialization.ORIENTS)
+    # If the client passes a series_id and later re-posts exactly the same series, we reuse the changepoints
+    # we found before.  With incremental = true, a series with new points appended only has its changepoints
+    # re-solved near the end.  That is faster, but approximate:  the response says so with approximate = true.
+    settings = get_settings(sensitivity_score, max_fraction_anomalies)
+    call = with_settings(await run_in_threadpool(prepare_time_series_single, input_data, *settings[0], series_id, incremental), settings)
+    return await respond_to_call(call, debug, orient, accept, if_none_match, keep_scores)
+
+def prepare_time_series_single(input_data, sensitivity_score, max_fraction_anomalies, series_id, incremental=False):
+    df = build_input_frame(input_data)
+    decision = admit_request("single_timeseries", df.shape[0])
+    # Requests for the same series_id go to the same worker, which holds that series' cached changepoints.
+    return prepare_call("single_timeseries", "detect_single_timeseries", (df, sensitivity_score, max_fraction_anomalies), { "series_id": series_id, "incremental": incremental, **decision["Settings"] }, decision, affinity=series_id)
+    
+# Many independent single time series in one request.  Each series is checked and
+# scored on its own, exactly as with /detect/timeseries/single, but the series are
+# packed together onto the worker pool rather than sent one request at a time.
+class Single_TimeSeries_Batch_Input(BaseModel):
+    series: Dict[str, Union[List[Single_TimeSeries_Input], Single_TimeSeries_Columnar_Input]]
+
+@app.post("/detect/timeseries/single/batch")
+async def post_time_series_single_batch(
+    input_data: Single_TimeSeries_Batch_Input,
     sensitivity_score: float = 50,
     max_fraction_anomalies: float = 1.0,
+    max_concurrency: Optional[int] = None,
+    orient: str = "records",
     debug: bool = False
 ):
-    df = pd.DataFrame(i.__dict__ for i in input_data)
-    
-    (df, weights, details) = single_timeseries.detect_single_timeseries(df, sensitivity_score, max_fraction_anomalies)
-    
-    results = { "anomalies": json.loads(df.to_json(orient='records', date_format='iso')) }
-    
-    if (debug):
-        results.update({ "debug_weights": weights })
-        results.update({ "debug_details": details })
-    return results
-    
+    check_option("orient", orient, serialization.ORIENTS)
+    check_detector("single_timeseries")
+    (admitted, calls, results) = await run_in_threadpool(prepare_batch, input_data, sensitivity_score, max_fraction_anomalies)
+
+    # The batch takes one place in line for each worker it may use at once, and map_detector() keeps
+    # no more chunks in flight than that, so that batches count against the same limits as other requests.
+    metrics.describe_request("single_timeseries", sum([args[0].shape[0] for (args, kwargs) in calls]))
+    async with executor.reserve("single_timeseries", min(len(calls), max_concurrency or executor.max_workers)) as num_slots:
+        with timing.stage("Run detector"):
+            outputs = await run_in_threadpool(executor.map_detector, "single_timeseries", "detect_single_timeseries", calls, None, num_slots)
+    for (df, weights, details) in outputs:
+        metrics.count_tests("single_timeseries", details)
+
+    for ((series_id, decision), (df, weights, details)) in zip(admitted, outputs):
+        series_results = { "anomalies": df }
+        if (debug):
+            series_results.update({ "debug_weights": weights })
+            series_results.update({ "debug_details": add_admission_details(details, decision) })
+        results["series"][series_id] = series_results
+    return await respond(results, orient)
+
+def prepare_batch(input_data, sensitivity_score, max_fraction_anomalies):
+    admitted = []
+    calls = []
+    results = { "series": {} }
+    for (series_id, points) in input_data.series.items():
+        df = build_input_frame(points)
+        decision = admission.admit("single_timeseries", df.shape[0])
+        metrics.observe("anomaly_input_records", { "method": "single_timeseries" }, df.shape[0])
+        # A series over budget should not fail the rest of the batch.
+        if decision["Decision"] == "rejected":
+            results["series"][series_id] = {
+                "error": "The series is too large to process within the configured resource budget.",
+                "Admission control": decision
+            }
+            continue
+        # Hold the series' place so that results come back in input order.
+        results["series"][series_id] = None
+        admitted.append((series_id, decision))
+        calls.append(((df, sensitivity_score, max_fraction_anomalies), decision["Settings"]))
+    return (admitted, calls, results)
+
 
 # Multiple time series anomaly detection
 # For more information on this, review chapters 15-17
@@ -102,21 +631,357 @@ class Multi_TimeSeries_Input(BaseModel):
     series_key: str
     dt: datetime.datetime
     value: float
+
+class Multi_TimeSeries_Columnar_Input(Columnar_Input):
+    key: List[str]
+    series_key: List[str]
+    dt: List[datetime.datetime]
+    value: List[float]
     
 @app.post("/detect/timeseries/multiple")
-def post_time_series_multiple(
-    input_data: List[Multi_TimeSeries_Input],
+async def post_time_series_multiple(
+    input_data: Union[List[Multi_TimeSeries_Input], Multi_TimeSeries_Columnar_Input],
+    sensitivity_score: List[float] = Query(default=[50]),
+    max_fraction_anomalies: List[float] = Query(default=[1.0]),
+    sax_mode: str = "auto",
+    group_id: Optional[str] = None,
+    output_mode: str = "points",
+    include_keys: bool = False,
+    orient: str = "records",
+    debug: bool = False,
+    keep_scores: bool = False,
+    accept: Optional[str] = Header(default=None),
+    if_none_match: Optional[str] = Header(default=None)
+):
+    # sax_mode controls how we compare SAX words across series:  pairwise (every series against
+    # every other), histogram (same results, linear in the number of series), sampled (compare
+    # against a random sample of series), or auto (pairwise for small requests, else histogram).
+    # If the client passes a group_id and later re-posts the same group with new time steps
+    # appended, we only compute segments and SAX words near the end of the series.
+    # output_mode = "segments" returns one record per series segment instead of one per data point;
+    # include_keys adds the keys of anomalous data points to each anomalous segment.
+    check_option("orient", orient, serialization.ORIENTS)
+    settings = get_settings(sensitivity_score, max_fraction_anomalies)
+    call = with_settings(await run_in_threadpool(prepare_time_series_multiple, input_data, *settings[0], sax_mode, group_id, output_mode, include_keys), settings)
+    return await respond_to_call(call, debug, orient, accept, if_none_match, keep_scores)
+
+def prepare_time_series_multiple(input_data, sensitivity_score, max_fraction_anomalies, sax_mode, group_id, output_mode, include_keys):
+    check_option("sax_mode", sax_mode, ["auto", "pairwise", "histogram", "sampled"])
+    check_option("output_mode", output_mode, ["points", "segments"])
+    df = build_input_frame(input_data)
+    num_series = df['series_key'].nunique() if df.shape[0] > 0 else 0
+    decision = admit_request("multi_timeseries", df.shape[0], num_series=num_series)
+    # Requests for the same group_id go to the same worker, which holds that group's cached results.
+    return prepare_call("multi_timeseries", "detect_multi_timeseries", (df, sensitivity_score, max_fraction_anomalies, sax_mode, group_id), decision["Settings"], decision,
+        affinity=group_id, output_mode=output_mode, include_keys=include_keys)
+
+# Aligned series in wide form:  one list of timestamps shared by every series,
+# plus one list of values per series key, in the same order as dt.
+# Data points do not have their own keys; each point's key is its position in dt.
+class Multi_TimeSeries_Wide_Input(BaseModel):
+    dt: List[datetime.datetime]
+    series: Dict[str, List[float]]
+
+@app.post("/detect/timeseries/multiple/wide")
+async def post_time_series_multiple_wide(
+    input_data: Multi_TimeSeries_Wide_Input,
+    sensitivity_score: List[float] = Query(default=[50]),
+    max_fraction_anomalies: List[float] = Query(default=[1.0]),
+    sax_mode: str = "auto",
+    group_id: Optional[str] = None,
+    output_mode: str = "points",
+    include_keys: bool = False,
+    orient: str = "records",
+    debug: bool = False,
+    keep_scores: bool = False,
+    accept: Optional[str] = Header(default=None),
+    if_none_match: Optional[str] = Header(default=None)
+):
+    # Same options as /detect/timeseries/multiple.
+    check_option("orient", orient, serialization.ORIENTS)
+    settings = get_settings(sensitivity_score, max_fraction_anomalies)
+    call = with_settings(await run_in_threadpool(prepare_time_series_multiple_wide, input_data, *settings[0], sax_mode, group_id, output_mode, include_keys), settings)
+    return await respond_to_call(call, debug, orient, accept, if_none_match, keep_scores)
+
+def prepare_time_series_multiple_wide(input_data, sensitivity_score, max_fraction_anomalies, sax_mode, group_id, output_mode, include_keys):
+    check_option("sax_mode", sax_mode, ["auto", "pairwise", "histogram", "sampled"])
+    check_option("output_mode", output_mode, ["points", "segments"])
+    timing.since_request_start("Parse request")
+    num_series = len(input_data.series)
+    decision = admit_request("multi_timeseries", num_series * len(input_data.dt), num_series=num_series)
+    return prepare_call("multi_timeseries", "detect_multi_timeseries_wide", (input_data.dt, input_data.series, sensitivity_score, max_fraction_anomalies, sax_mode, group_id), decision["Settings"], decision,
+        affinity=group_id, output_mode=output_mode, include_keys=include_keys)
+
+
+# Apply new sensitivity settings to scores kept by a detection request with keep_scores = true.
+# Takes the same sensitivity_score, max_fraction_anomalies, orient, and debug options as /detect.
+@app.get("/rethreshold/{score_id}")
+async def get_rethreshold(
+    score_id: str,
+    sensitivity_score: List[float] = Query(default=[50]),
+    max_fraction_anomalies: List[float] = Query(default=[1.0]),
+    orient: str = "records",
+    debug: bool = False,
+    accept: Optional[str] = Header(default=None)
+):
+    check_option("orient", orient, serialization.ORIENTS)
+    settings = get_settings(sensitivity_score, max_fraction_anomalies, always_check=True)
+    entry = await run_in_threadpool(scores.get, score_id)
+    if entry is not None:
+        metrics.describe_request(entry["module"], entry["scored"]["df"].shape[0])
+    if entry is None:
+        raise HTTPException(status_code=404, detail=f"Scores {score_id} do not exist or have expired.  Run detection again with keep_scores = true.")
+    check_settings_output(settings, entry["output_mode"])
+    (df, weights, details) = await run_in_threadpool(thresholds.apply_settings, entry["module"], entry["scored"], entry["weights"], entry["details"], settings, entry["output_mode"], entry["include_keys"])
+    call = { "settings": settings, "decision": entry["decision"], "output_mode": entry["output_mode"], "include_keys": entry["include_keys"] }
+    results = { "score_id": score_id, **build_results(call, df, weights, details, debug) }
+    return await respond(results, orient, accept)
+
+
+# Arrow and Parquet uploads
+# POST /detect/{method}/upload takes the same options as /detect/{method}, but the body is an Arrow IPC
+# stream or file, or a Parquet file, with the content type set to match (see tables.py).  Results come
+# back in the same format; with debug = true, weights and diagnostics are in the schema metadata as JSON.
+async def read_upload(request, columns):
+    timing.since_request_start("Parse request")
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    if content_type not in tables.FORMATS:
+        raise HTTPException(status_code=415, detail=f"Content-Type must be one of {', '.join(tables.FORMATS)}.")
+    format = tables.FORMATS[content_type]
+    try:
+        with timing.stage("Read upload"):
+            body = await request.body()
+            df = await run_in_threadpool(tables.read_frame, body, format, columns)
+    except ImportError:
+        raise HTTPException(status_code=501, detail="Arrow and Parquet uploads require pyarrow, which is not installed.")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return (df, format)
+
+async def respond_table(results, format):
+    result_key = "segments" if "segments" in results else "anomalies"
+    metadata = { k: v for (k, v) in results.items() if k != result_key }
+    with timing.stage("Encode response"):
+        content = await run_in_threadpool(tables.write_frame, results[result_key], format, metadata)
+    return Response(content=content, media_type=tables.MEDIA_TYPES[format])
+
+@app.post("/detect/univariate/upload")
+async def post_univariate_upload(
+    request: Request,
     sensitivity_score: float = 50,
     max_fraction_anomalies: float = 1.0,
     debug: bool = False
 ):
-    df = pd.DataFrame(i.__dict__ for i in input_data)
+    check_detector("univariate")
+    (df, format) = await read_upload(request, ["key", "value"])
+    call = await run_in_threadpool(prepare_univariate, df, sensitivity_score, max_fraction_anomalies)
+    (df, weights, details) = await run_call(call)
+    return await respond_table(build_results(call, df, weights, details, debug), format)
 
-    (df, weights, details) = multi_timeseries.detect_multi_timeseries(df, sensitivity_score, max_fraction_anomalies)
-    
-    results = { "anomalies": json.loads(df.to_json(orient='records', date_format='iso')) }
-    
+@app.post("/detect/multivariate/upload")
+async def post_multivariate_upload(
+    request: Request,
+    sensitivity_score: float = 50,
+    max_fraction_anomalies: float = 1.0,
+    n_neighbors: int = 10,
+    debug: bool = False
+):
+    check_detector("multivariate")
+    (df, format) = await read_upload(request, ["key", "vals"])
+    call = await run_in_threadpool(prepare_multivariate, df, sensitivity_score, max_fraction_anomalies, n_neighbors)
+    (df, weights, details) = await run_call(call)
+    return await respond_table(build_results(call, df, weights, details, debug), format)
+
+@app.post("/detect/timeseries/single/upload")
+async def post_time_series_single_upload(
+    request: Request,
+    sensitivity_score: float = 50,
+    max_fraction_anomalies: float = 1.0,
+    series_id: Optional[str] = None,
+    incremental: bool = False,
+    debug: bool = False
+):
+    check_detector("single_timeseries")
+    (df, format) = await read_upload(request, ["key", "dt", "value"])
+    call = await run_in_threadpool(prepare_time_series_single, df, sensitivity_score, max_fraction_anomalies, series_id, incremental)
+    (df, weights, details) = await run_call(call)
+    return await respond_table(build_results(call, df, weights, details, debug), format)
+
+@app.post("/detect/timeseries/multiple/upload")
+async def post_time_series_multiple_upload(
+    request: Request,
+    sensitivity_score: float = 50,
+    max_fraction_anomalies: float = 1.0,
+    sax_mode: str = "auto",
+    group_id: Optional[str] = None,
+    output_mode: str = "points",
+    include_keys: bool = False,
+    debug: bool = False
+):
+    check_detector("multi_timeseries")
+    check_option("sax_mode", sax_mode, ["auto", "pairwise", "histogram", "sampled"])
+    check_option("output_mode", output_mode, ["points", "segments"])
+    (df, format) = await read_upload(request, ["key", "series_key", "dt", "value"])
+    call = await run_in_threadpool(prepare_time_series_multiple, df, sensitivity_score, max_fraction_anomalies, sax_mode, group_id, output_mode, include_keys)
+    (df, weights, details) = await run_call(call)
+    return await respond_table(build_results(call, df, weights, details, debug), format)
+
+
+# Detection jobs
+# Large requests can take minutes, longer than many clients and proxies will hold a connection open.
+# POST /jobs/{method} takes the same input and options as /detect/{method}, but returns a job id right away
+# and runs detection in the background.  Poll GET /jobs/{job_id} for status, then page through the results
+# with GET /jobs/{job_id}/results.  Jobs and their results expire after ANOMALY_JOB_TTL_SECONDS.
+running_jobs = set()
+
+async def run_job(job_id, call):
+    async def on_start():
+        await run_in_threadpool(jobs.set_status, job_id, "running", "Detecting anomalies")
+    # Jobs always keep their timings, which come back with debug details from GET /jobs/{job_id}.
+    with timing.collect() as timings:
+        try:
+            # Jobs wait for a place in line rather than being turned away when the service is busy.
+            # A job whose worker stopped (perhaps because the job ran it out of memory) fails instead,
+            # so that one job cannot keep bringing down workers.
+            while True:
+                try:
+                    (df, weights, details) = await run_call(call, on_start)
+                    break
+                except executor.WorkerFailed:
+                    raise
+                except executor.PoolBusy as e:
+                    await asyncio.sleep(e.retry_after)
+            await run_in_threadpool(jobs.set_status, job_id, "running", "Storing results")
+            results = build_results(call, df, weights, details, True)
+            result_key = "segments" if call["output_mode"] == "segments" else "anomalies"
+            await run_in_threadpool(jobs.store_results, job_id, result_key, results[result_key], weights, results["debug_details"])
+            if metrics.stage_timings:
+                metrics.observe_stages(call["method"], timings)
+        except Exception as e:
+            logging.exception(f"Job {job_id} failed.")
+            await run_in_threadpool(jobs.set_status, job_id, "failed", None, str(e))
+
+async def start_job(call):
+    job_id = await run_in_threadpool(jobs.create_job, call["method"])
+    # Hold on to the task so that it is not garbage collected while it runs.
+    task = asyncio.create_task(run_job(job_id, call))
+    running_jobs.add(task)
+    task.add_done_callback(running_jobs.discard)
+    return JSONResponse(status_code=202, content={
+        "job_id": job_id,
+        "status": "queued",
+        "status_url": f"/jobs/{job_id}",
+        "results_url": f"/jobs/{job_id}/results"
+    })
+
+async def clean_up_jobs():
+    while True:
+        await run_in_threadpool(jobs.delete_expired)
+        await asyncio.sleep(jobs.cleanup_interval_seconds)
+
+async def check_jobs():
+    # Record that this process is still running its jobs, and fail the jobs of any process which has stopped.
+    while True:
+        await asyncio.sleep(jobs.heartbeat_seconds)
+        try:
+            await run_in_threadpool(jobs.fail_unfinished_jobs)
+        except sqlite3.Error:
+            logging.exception("Could not check for unfinished jobs.")
+
+def format_timestamp(t):
+    return datetime.datetime.fromtimestamp(t, tz=datetime.timezone.utc).isoformat()
+
+async def get_job_or_404(job_id):
+    job = await run_in_threadpool(jobs.get_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} does not exist or has expired.")
+    return job
+
+@app.post("/jobs/univariate")
+async def post_job_univariate(
+    input_data: Union[List[Univariate_Statistical_Input], Univariate_Statistical_Columnar_Input],
+    sensitivity_score: float = 50,
+    max_fraction_anomalies: float = 1.0
+):
+    return await start_job(await run_in_threadpool(prepare_univariate, input_data, sensitivity_score, max_fraction_anomalies))
+
+@app.post("/jobs/multivariate")
+async def post_job_multivariate(
+    input_data: Union[List[Multivariate_Input], Multivariate_Columnar_Input],
+    sensitivity_score: float = 50,
+    max_fraction_anomalies: float = 1.0,
+    n_neighbors: int = 10
+):
+    return await start_job(await run_in_threadpool(prepare_multivariate, input_data, sensitivity_score, max_fraction_anomalies, n_neighbors))
+
+@app.post("/jobs/timeseries/single")
+async def post_job_time_series_single(
+    input_data: Union[List[Single_TimeSeries_Input], Single_TimeSeries_Columnar_Input],
+    sensitivity_score: float = 50,
+    max_fraction_anomalies: float = 1.0,
+    series_id: Optional[str] = None,
+    incremental: bool = False
+):
+    return await start_job(await run_in_threadpool(prepare_time_series_single, input_data, sensitivity_score, max_fraction_anomalies, series_id, incremental))
+
+@app.post("/jobs/timeseries/multiple")
+async def post_job_time_series_multiple(
+    input_data: Union[List[Multi_TimeSeries_Input], Multi_TimeSeries_Columnar_Input],
+    sensitivity_score: float = 50,
+    max_fraction_anomalies: float = 1.0,
+    sax_mode: str = "auto",
+    group_id: Optional[str] = None,
+    output_mode: str = "points",
+    include_keys: bool = False
+):
+    return await start_job(await run_in_threadpool(prepare_time_series_multiple, input_data, sensitivity_score, max_fraction_anomalies, sax_mode, group_id, output_mode, include_keys))
+
+@app.post("/jobs/timeseries/multiple/wide")
+async def post_job_time_series_multiple_wide(
+    input_data: Multi_TimeSeries_Wide_Input,
+    sensitivity_score: float = 50,
+    max_fraction_anomalies: float = 1.0,
+    sax_mode: str = "auto",
+    group_id: Optional[str] = None,
+    output_mode: str = "points",
+    include_keys: bool = False
+):
+    return await start_job(await run_in_threadpool(prepare_time_series_multiple_wide, input_data, sensitivity_score, max_fraction_anomalies, sax_mode, group_id, output_mode, include_keys))
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, debug: bool = False):
+    job = await get_job_or_404(job_id)
+    results = {
+        "job_id": job["job_id"],
+        "method": job["method"],
+        "status": job["status"],
+        "stage": job["stage"],
+        "error": job["error"],
+        "created": format_timestamp(job["created"]),
+        "updated": format_timestamp(job["updated"]),
+        "expires": format_timestamp(job["expires"]),
+        "num_results": job["num_results"]
+    }
     if (debug):
-        results.update({ "debug_weights": weights })
-        results.update({ "debug_details": details })
+        results.update({ "debug_weights": job["weights"] })
+        results.update({ "debug_details": job["details"] })
     return results
+
+@app.get("/jobs/{job_id}/results")
+async def get_job_results(job_id: str, offset: int = 0, limit: int = 1000, orient: str = "records", accept: Optional[str] = Header(default=None)):
+    check_option("orient", orient, serialization.ORIENTS)
+    if offset < 0 or limit < 1 or limit > jobs.MAX_PAGE_ROWS:
+        raise HTTPException(status_code=400, detail=f"offset must be at least 0 and limit must be between 1 and {jobs.MAX_PAGE_ROWS}.")
+    job = await get_job_or_404(job_id)
+    if job["status"] != "succeeded":
+        raise HTTPException(status_code=409, detail=f"Job {job_id} has no results because its status is {job['status']}.")
+    rows = await run_in_threadpool(jobs.get_results, job_id, offset, limit)
+    results = {
+        "job_id": job_id,
+        "offset": offset,
+        "limit": limit,
+        "num_results": job["num_results"],
+        "next_offset": offset + limit if offset + limit < job["num_results"] else None,
+        job["result_key"]: pd.DataFrame(rows)
+    }
+    return await respond(results, orient, accept)
@@ -0,0 +1,155 @@
+# Finding Ghosts in Your Data
+# Service metrics in the Prometheus text format
+# GET /metrics returns counters, gauges, and histograms kept in this process:  requests per endpoint,
+# input sizes, time spent in each stage of a request (see timing.py), tests run and skipped, queue
+# depth, and cache hits.  Prometheus scrapes the endpoint directly, so there is no collector to run.
+# Detection runs in worker processes, but workers send their stage timings back with each result,
+# so one scrape of the API process covers its workers as well.
+# Stage timings are off by default (see stage_timings below), as collecting them times every stage of
+# every request, down to each COF run.  Without them, requests cost a few counter and histogram updates.
+
+import os
+import bisect
+import threading
+import contextlib
+import contextvars
+
+# Set ANOMALY_METRICS to false to stop collecting metrics.
+enabled = os.environ.get("ANOMALY_METRICS", "true").lower() not in ("false", "0", "no", "off")
+# Set ANOMALY_METRICS_STAGE_TIMINGS to true to collect timings for every request and export anomaly_stage_duration_seconds.
+# Otherwise, timings are only collected for debug requests, profiled requests, and jobs.
+stage_timings = enabled and os.environ.get("ANOMALY_METRICS_STAGE_TIMINGS", "false").lower() in ("true", "1", "yes", "on")
+
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+SIZE_BUCKETS = [10, 100, 1000, 10000, 100000, 1000000, 10000000]
+
+# Every metric we export:  its type, help text, and histogram buckets.
+METRICS = {
+    "anomaly_requests_total": ("counter", "Requests by endpoint, HTTP method, and status code.", None),
+    "anomaly_request_duration_seconds": ("histogram", "Time to handle a request, from receiving it to sending the last of the response, by endpoint.", LATENCY_BUCKETS),
+    "anomaly_input_records": ("histogram", "Data points per detection request, by detection method.", SIZE_BUCKETS),
+    "anomaly_stage_duration_seconds": ("histogram", "Time spent in each stage of handling a request, by detection method and stage.", LATENCY_BUCKETS),
+    "anomaly_tests_total": ("counter", "Detector tests by detection method and test, and whether each test ran or was skipped.", None),
+    "anomaly_queued_requests": ("gauge", "Detection requests waiting for or holding a worker.", None),
+    "anomaly_queue_capacity": ("gauge", "Detection requests which may wait for or hold a worker before we turn requests away.", None),
+    "anomaly_running_jobs": ("gauge", "Background detection jobs in this process.", None),
+    "anomaly_cache_hits_total": ("counter", "Cache hits by cache.", None),
+    "anomaly_cache_misses_total": ("counter", "Cache misses by cache.", None),
+    "anomaly_cache_evictions_total": ("counter", "Cache evictions by cache.", None),
+    "anomaly_cache_entries": ("gauge", "Entries by cache.", None),
+    "anomaly_cache_bytes": ("gauge", "Approximate size in bytes by cache.", None)
+}
+
+# For each metric, values by label set.  A label set is a tuple of (label, value) pairs.
+# Histogram values are [count per bucket..., count above the last bucket, sum].
+_values = {}
+_lock = threading.Lock()
+_request = contextvars.ContextVar("request", default=None)
+
+def get_labels(labels):
+    return tuple(labels.items())
+
+def inc(name, labels, value=1):
+    with _lock:
+        series = _values.setdefault(name, {})
+        key = get_labels(labels)
+        series[key] = series.get(key, 0) + value
+
+def set_value(name, labels, value):
+    # For gauges, and for counters which something else keeps, such as cache hits.
+    with _lock:
+        _values.setdefault(name, {})[get_labels(labels)] = value
+
+def observe(name, labels, value):
+    buckets = METRICS[name][2]
+    with _lock:
+        series = _values.setdefault(name, {})
+        key = get_labels(labels)
+        if key not in series:
+            series[key] = [0 for b in buckets] + [0, 0.0]
+        # bisect_left puts a value equal to a bucket's upper bound in that bucket, as Prometheus expects.
+        series[key][bisect.bisect_left(buckets, value)] += 1
+        series[key][-1] += value
+
+def reset():
+    with _lock:
+        _values.clear()
+
+@contextlib.contextmanager
+def track_request():
+    # Once the endpoint knows them, request holds the detection method the request runs and its number of data points.
+    request = { "method": None, "num_records": None }
+    token = _request.set(request)
+    try:
+        yield request
+    finally:
+        _request.reset(token)
+
+def describe_request(method, num_records=None):
+    request = _request.get()
+    if request is not None:
+        request["method"] = method
+        request["num_records"] = num_records
+
+def observe_request(endpoint, http_method, status, seconds, timings, method):
+    inc("anomaly_requests_total", { "endpoint": endpoint, "http_method": http_method, "status": str(status) })
+    observe("anomaly_request_duration_seconds", { "endpoint": endpoint }, seconds)
+    if method is not None:
+        observe_stages(method, timings)
+
+def observe_stages(method, timings):
+    # timings as collected by timing.py:  stage name to [seconds, calls].
+    for (stage, (seconds, calls)) in timings.items():
+        observe("anomaly_stage_duration_seconds", { "method": method, "stage": stage }, seconds)
+
+def count_tests(method, details):
+    # Detectors list the tests they ran as 1 and those they skipped (e.g. LOCI above 1000 records) as 0.
+    # Validation failures come back as a string message, in which case no tests ran.
+    if not isinstance(details, dict):
+        return
+    tests_run = details.get("Tests run") or details.get("Test diagnostics", {}).get("Tests Run") or {}
+    for (test, run) in tests_run.items():
+        inc("anomaly_tests_total", { "method": method, "test": test, "status": "run" if run else "skipped" })
+
+def set_cache_stats(cache, stats):
+    # stats as returned by SizedLRUCache.stats().
+    labels = { "cache": cache }
+    set_value("anomaly_cache_hits_total", labels, stats["Hits"])
+    set_value("anomaly_cache_misses_total", labels, stats["Misses"])
+    set_value("anomaly_cache_evictions_total", labels, stats["Evictions"])
+    set_value("anomaly_cache_entries", labels, stats["Entries"])
+    set_value("anomaly_cache_bytes", labels, stats["Bytes"])
+
+def format_labels(labels, extra=()):
+    pairs = [*labels, *extra]
+    if len(pairs) == 0:
+        return ""
+    escaped = [(k, str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")) for (k, v) in pairs]
+    return "{" + ",".join([f'{k}="{v}"' for (k, v) in escaped]) + "}"
+
+def format_number(value):
+    if isinstance(value, float) and value == float("inf"):
+        return "+Inf"
+    return repr(value)
+
+def render():
+    # The Prometheus text exposition format, version 0.0.4.
+    lines = []
+    with _lock:
+        values = { name: { k: (list(v) if isinstance(v, list) else v) for (k, v) in series.items() } for (name, series) in _values.items() }
+    for (name, (metric_type, help_text, buckets)) in METRICS.items():
+        if name not in values:
+            continue
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for (labels, value) in values[name].items():
+            if metric_type == "histogram":
+                cumulative = 0
+                for (bucket, count) in zip([*buckets, float("inf")], value[:-1]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{format_labels(labels, [('le', format_number(float(bucket)))])} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {format_number(value[-1])}")
+                lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+            else:
+                lines.append(f"{name}{format_labels(labels)} {format_number(value)}")
+    return "\n".join(lines) + "\n"
@@ -2,129 +2,547 @@
 # Multiple time series anomaly detection
 # For more information on this, review chapters 16-17
 
+import os
+import hashlib
 import pandas as pd
 import numpy as np
 from pandas.core import base
+from scipy.stats import norm
 from tslearn.piecewise import SymbolicAggregateApproximation
+from . import parallel
+from ..caching import SizedLRUCache
+from .. import timing
+
+# In sampled SAX mode, we compare each series against this many randomly chosen reference series.
+SAX_SAMPLE_SIZE = 256
+
+# Below this many data points, the cost of handing shards of series to other processes
+# outweighs the savings from transforming them in parallel.
+MIN_PARALLEL_RECORDS = 1000000
+
+# When a client identifies a group of series, DIFFSTD segments are exactly this many data points wide
+# (the final segment picks up any remainder) so that segment boundaries do not move as new data arrives.
+STATEFUL_SEGMENT_SIZE = 7
+
+# Per-segment and per-word results by series group id.  See run_tests_stateful() for how we use this.
+group_cache = SizedLRUCache(
+    max_entries=int(os.environ.get("ANOMALY_GROUP_CACHE_ENTRIES", 1000)),
+    max_bytes=int(os.environ.get("ANOMALY_GROUP_CACHE_MB", 256)) * 1024 * 1024
+)
+
+# Sensitivity-dependent columns of the output.  See thresholds.py.
+THRESHOLD_COLUMNS = ["diffstd_score", "sax_score", "anomaly_score", "is_anomaly"]
 
 def detect_multi_timeseries(
     df,
     sensitivity_score,
-    max_fraction_anomalies
+    max_fraction_anomalies,
+    sax_mode="auto",
+    group_id=None
+):
+    # SAX and DIFFSTD distances do not depend on the sensitivity settings, so we find them first and score after.
+    (scored, weights, details) = score_multi_timeseries(df, sensitivity_score, max_fraction_anomalies, sax_mode, group_id)
+    return apply_detection_threshold(scored, weights, details, sensitivity_score, max_fraction_anomalies)
+
+def score_multi_timeseries(
+    df,
+    sensitivity_score,
+    max_fraction_anomalies,
+    sax_mode="auto",
+    group_id=None
 ):
     weights = { "DIFFSTD": 1.0, "SAX": 1.0 }
 
-    # Ensure that everything is sorted by dt and series key
-    df = df.sort_values(["dt", "series_key"], axis=0, ascending=True)
-    
-    num_series = len(df["series_key"].unique())
+    # Ensure that everything is sorted by series key and then by dt.  With every series the
+    # same length, this lays the values out as one series after another, which lets us
+    # treat them as a (series x time) matrix without splitting up the DataFrame.
+    df = df.sort_values(["series_key", "dt"], axis=0, ascending=True)
+
+    # Because we sorted by series key, each series starts wherever the key changes.
+    series_keys = df["series_key"].to_numpy()
+    series_starts = np.flatnonzero(np.concatenate([[True], series_keys[1:] != series_keys[:-1]]))
+    series_lengths = np.diff(np.append(series_starts, len(series_keys)))
+    num_series = len(series_starts)
     num_data_points = df['value'].count()
-    if (num_data_points / num_series < 15):
-        return (df.assign(is_anomaly=False, anomaly_score=0.0), weights, f"Must have a minimum of at least fifteen data points per time series for anomaly detection.  You sent {num_data_points} per series.")
+    message = validate_inputs(num_series, num_data_points, len(np.unique(series_lengths)) == 1, sensitivity_score, max_fraction_anomalies)
+    if message is not None:
+        return ({ "df": df.assign(is_anomaly=False, anomaly_score=0.0) }, weights, message)
+
+    values = df['value'].to_numpy(dtype=float).reshape((num_series, series_lengths[0]))
+    return score_values(df, values, series_keys[series_starts], weights, sax_mode, group_id)
+
+def detect_multi_timeseries_wide(
+    dt,
+    series,
+    sensitivity_score,
+    max_fraction_anomalies,
+    sax_mode="auto",
+    group_id=None
+):
+    (scored, weights, details) = score_multi_timeseries_wide(dt, series, sensitivity_score, max_fraction_anomalies, sax_mode, group_id)
+    return apply_detection_threshold(scored, weights, details, sensitivity_score, max_fraction_anomalies)
+
+def score_multi_timeseries_wide(
+    dt,
+    series,
+    sensitivity_score,
+    max_fraction_anomalies,
+    sax_mode="auto",
+    group_id=None
+):
+    # Aligned series in wide form:  dt is a single list of timestamps shared by every series, and series
+    # maps each series key to a list of values in the same order as dt.  This goes straight into the
+    # (series x time) matrix without building, validating, and sorting one record per data point.
+    # There are no per-point keys, so each point's key is its position in dt.
+    weights = { "DIFFSTD": 1.0, "SAX": 1.0 }
+
+    dt = pd.DatetimeIndex(dt)
+    series_keys = np.array(sorted(series.keys()), dtype=object)
+    num_series = len(series_keys)
+    lengths_equal = all([len(series[k]) == len(dt) for k in series_keys])
+    if not lengths_equal:
+        df = pd.DataFrame({ "key": pd.Series(dtype=int), "series_key": pd.Series(dtype=object), "dt": pd.Series(dtype="datetime64[ns]"), "value": pd.Series(dtype=float) })
+        return ({ "df": df.assign(is_anomaly=False, anomaly_score=0.0) }, weights, "All time series must have one value per timestamp.")
+
+    # Sort by dt once for every series.
+    l = len(dt)
+    order = np.argsort(dt, kind="stable")
+    values = np.array([series[k] for k in series_keys], dtype=float).reshape((num_series, l))[:, order]
+    df = pd.DataFrame({
+        "key": np.tile(order, num_series),
+        "series_key": np.repeat(series_keys, l),
+        "dt": dt[np.tile(order, num_series)],
+        "value": values.reshape(-1)
+    })
+    message = validate_inputs(num_series, values.size, True, sensitivity_score, max_fraction_anomalies)
+    if message is not None:
+        return ({ "df": df.assign(is_anomaly=False, anomaly_score=0.0) }, weights, message)
+
+    return score_values(df, values, series_keys, weights, sax_mode, group_id)
+
+def validate_inputs(num_series, num_data_points, lengths_equal, sensitivity_score, max_fraction_anomalies):
+    # Returns a message explaining why we cannot run the tests, or None if the inputs are valid.
+    if (num_series == 0 or num_data_points / num_series < 15):
+        return f"Must have a minimum of at least fifteen data points per time series for anomaly detection.  You sent {num_data_points} per series."
     elif (num_series < 2):
-        return (df.assign(is_anomaly=False, anomaly_score=0.0), weights, f"Must have a minimum of at least two time series for anomaly detection.  You sent {num_series} series.")
+        return f"Must have a minimum of at least two time series for anomaly detection.  You sent {num_series} series."
+    elif (not lengths_equal):
+        return "All time series must have the same number of data points."
     elif (max_fraction_anomalies <= 0.0 or max_fraction_anomalies > 1.0):
-        return (df.assign(is_anomaly=False, anomaly_score=0.0), weights, "Must have a valid max fraction of anomalies, 0 < x <= 1.0.")
+        return "Must have a valid max fraction of anomalies, 0 < x <= 1.0."
     elif (sensitivity_score <= 0 or sensitivity_score > 100 ):
-        return (df.assign(is_anomaly=False, anomaly_score=0.0), weights, "Must have a valid sensitivity score, 0 < x <= 100.")
+        return "Must have a valid sensitivity score, 0 < x <= 100."
     else:
-        (df_tested, tests_run, diagnostics) = run_tests(df)
-        (df_scored, diag_scored) = score_results(df_tested, tests_run, sensitivity_score)
-        (df_out, diag_outliers) = determine_outliers(df_scored, max_fraction_anomalies)
-        return (df_out, weights, { "message": "Result of single time series statistical tests.", "Tests run": tests_run, "Test diagnostics": diagnostics, "Outlier scoring": diag_scored, "Outlier determination": diag_outliers})
+        return None
 
-def run_tests(df):
+def score_values(df, values, series_keys, weights, sax_mode="auto", group_id=None):
+    # df has one row per data point, sorted by series key and then by dt, and values holds
+    # the same data as a (series x time) matrix with one row per series key.
+    if group_id is None:
+        (results, tests_run, diagnostics) = run_tests(values, sax_mode)
+    else:
+        (results, tests_run, diagnostics) = run_tests_stateful(values, series_keys, group_id, sax_mode)
+    scored = { "df": df, "results": results, "tests_run": tests_run }
+    return (scored, weights, { "message": "Result of single time series statistical tests.", "Tests run": tests_run, "Test diagnostics": diagnostics })
+
+def apply_detection_threshold(scored, weights, details, sensitivity_score, max_fraction_anomalies):
+    if isinstance(details, str):
+        return (scored["df"], weights, details)
+    (df_out, threshold_details) = apply_threshold(scored, sensitivity_score, max_fraction_anomalies)
+    return (df_out, weights, { **details, **threshold_details })
+
+@timing.timed("Apply threshold")
+def apply_threshold(scored, sensitivity_score, max_fraction_anomalies):
+    # Scoring adds new result arrays rather than changing the test results, so a shallow copy
+    # of the results (and of the frame we add columns to) leaves scored as it was.
+    (results, diag_scored) = score_results(dict(scored["results"]), scored["tests_run"], sensitivity_score)
+    (results, diag_outliers) = determine_outliers(results, max_fraction_anomalies)
+    df_out = build_output(scored["df"].copy(deep=False), results)
+    return (df_out, { "Outlier scoring": diag_scored, "Outlier determination": diag_outliers })
+
+def run_tests(values, sax_mode="auto"):
+    # values is a (series x time) matrix with one row per series.  Each test returns
+    # (series x time) results as well, and we only turn them back into DataFrame
+    # columns once we have scored everything.
     tests_run = {
         "DIFFSTD": 1,
         "SAX": 1
     }
 
-    # Break out each series to operate on individually.
-    series = [y for x, y in df.groupby("series_key", as_index=False)]
     # Grab basic information:  number of series, length of series.
-    num_series = len(series)
-    l = len(series[0])
+    (num_series, l) = values.shape
 
     diagnostics = {
         "Number of time series": num_series,
         "Time series length": l
     }
 
-    # Perform SAX first while everything is still in individual series.
-    # This will add sax_distance to each point in each series.
-    (series, diag_sax) = check_sax(series, num_series, l)
-    diagnostics["SAX"] = diag_sax    
-
     # Break out the series into segments of approximately 7 data points.
     # 7 data points allows us to have at least 2 segments given our 15-point minimum.
     # We use integer math here to ensure no segment has just 1-2 records and no segment
     # is wildly unbalanced in size compared to the others.  At a minimum,
     # we should have 6 data points per segment.  At a maximum, we can end up with 10.
-    series_segments = [np.array_split(series[x], (l // 7)) for x in range(num_series)]
-    num_segments = len(series_segments[0])
-    num_records = df['key'].shape[0]
+    num_segments = l // 7
+    (segment_starts, segment_sizes) = get_segment_bounds(l, num_segments)
+    num_records = values.size
+
+    # SAX letters and DIFFSTD distances for each series depend only on that series plus a few
+    # statistics across all series, so for larger requests we split the series into shards
+    # and transform each shard on a separate worker.
+    segment_split = get_sax_segment_split(l)
+    if (parallel.is_enabled() and num_records >= MIN_PARALLEL_RECORDS):
+        (sax_data, breakpoints, segment_means, distances) = transform_series_parallel(values, segment_split, segment_starts, segment_sizes, parallel.max_workers)
+        diagnostics["Series transformation"] = "Parallel"
+    else:
+        (sax_data, breakpoints, segment_means, distances) = transform_series(values, segment_split, segment_starts, segment_sizes)
+        diagnostics["Series transformation"] = "Serial"
+
+    # This will give us the SAX distance for each point in each series.
+    (sax_distances, diag_sax) = check_sax(sax_data, breakpoints, l, segment_split, sax_mode)
+    diagnostics["SAX"] = diag_sax
 
     diagnostics["Number of records"] = num_records
     diagnostics["Number of segments per time series"] = num_segments
+    diagnostics["Segment means"] = [segment_means[start:start + size].tolist() for (start, size) in zip(segment_starts, segment_sizes)]
 
-    segment_means = generate_segment_means(series_segments, num_series, num_segments)
-    diagnostics["Segment means"] = segment_means
-    segments_diffstd = check_diffstd(series_segments, segment_means, num_series, num_segments)
-    # Merge segments together as df.  Segments comes in as a list of lists, each of which contains a DataFrame.
-    # First, flatten out the list of lists, giving us a list of DataFrames.
-    flattened = [item for sublist in segments_diffstd for item in sublist]
-    # Next, concatenate the DataFrames together.
-    df = pd.concat(flattened)
-
-    return (df, tests_run, diagnostics)
-
-def generate_segment_means(series_segments, num_series, num_segments):
-    means = []
-    for j in range(num_segments):
-        C = [series_segments[i][j]['value'] for i in range(num_series)]
-        means.append([sum(x)/num_series for x in zip(*C)])
-    return means
-
-def diffstd(s1v, s2v):
-    # Find the differences between the two input segments.
-    dt = [x1 - x2 for (x1, x2) in zip(s1v, s2v)]
-    n = len(s1v)
-    mu = np.mean(dt)
-    # For each difference, square its distance from the mean.  This guarantees all numbers are positive.
-    diff2 = [(d-mu)**2 for d in dt]
+    # Scatter the per-segment results back onto each data point.
+    results = {
+        "sax_distance": sax_distances,
+        "segment_number": np.broadcast_to(np.repeat(np.arange(num_segments), segment_sizes), values.shape),
+        "diffstd_distance": np.repeat(distances, segment_sizes, axis=1)
+    }
+
+    return (results, tests_run, diagnostics)
+
+def build_output(df, results):
+    # df is sorted by series key and dt, the same order as each (series x time) result
+    # matrix flattened row by row.  df is already our own sorted copy, so we can add columns in place.
+    for (column, result) in results.items():
+        df[column] = result.reshape(-1)
+    return df
+
+def run_tests_stateful(values, series_keys, group_id, sax_mode="auto"):
+    # Same tests as run_tests(), for a group of series which the client re-posts as new time steps arrive.
+    # Anything computed over a window which is complete cannot change when data points are appended,
+    # so we cache per-segment DIFFSTD distances and per-word SAX distances and only compute the tail.
+    # To make that work, we fix a few things the first time we see the group:  DIFFSTD segments
+    # are a fixed width, and the SAX letter width and scaling (mean and standard deviation) are
+    # frozen.  This means results differ slightly from a one-off request with the same data.
+    tests_run = {
+        "DIFFSTD": 1,
+        "SAX": 1
+    }
+    (num_series, l) = values.shape
+    diagnostics = {
+        "Number of time series": num_series,
+        "Time series length": l
+    }
+
+    (previous, values_hash) = hash_group(group_id, values, series_keys, sax_mode)
+    if (previous is not None and previous["length"] == l):
+        diagnostics["Series transformation"] = "Reused cached results"
+    elif (previous is not None):
+        diagnostics["Series transformation"] = f"Incremental, {l - previous['length']} new data points"
+    else:
+        previous = start_group_state(values, series_keys, sax_mode)
+        diagnostics["Series transformation"] = "Stateful, computed full history"
+
+    (results, diag_group, state) = transform_group(values, previous, sax_mode)
+    diagnostics.update(diag_group)
+    cache_group(group_id, state, values_hash)
+    return (results, tests_run, diagnostics)
+
+def start_group_state(values, series_keys, sax_mode="auto"):
+    # Settings we freeze for the life of the group, with no cached results yet.
+    # Word distances from one SAX mode do not mix with those from another, so the mode is one of those settings.
+    l = values.shape[1]
+    sax = SymbolicAggregateApproximation(n_segments= l//get_sax_segment_split(l), alphabet_size_avg=4, scale=True)
+    sax.fit(values)
+    return {
+        "series_keys": series_keys,
+        "sax_mode": sax_mode,
+        "segment_split": get_sax_segment_split(l),
+        "mu": sax.mu_[0],
+        "std": sax.std_[0],
+        "breakpoints": sax.breakpoints_avg_,
+        "length": 0,
+        "segment_means": np.empty(0),
+        "diffstd": np.empty((values.shape[0], 0)),
+        "word_distances": np.empty((values.shape[0], 0))
+    }
+
+@timing.timed("Stateful SAX and DIFFSTD transform")
+def transform_group(values, state, sax_mode="auto"):
+    # state holds the frozen settings plus results for every segment and word which was complete
+    # as of the previous request.  Returns results for the whole history and the state to cache.
+    (num_series, l) = values.shape
+    segment_size = STATEFUL_SEGMENT_SIZE
+
+    # DIFFSTD:  every segment but the last is exactly segment_size data points wide, so every
+    # segment but the last stays the same no matter how many data points arrive later.
+    num_segments = l // segment_size
+    segment_sizes = np.full(num_segments, segment_size)
+    segment_sizes[-1] += l % segment_size
+    num_stable_segments = state["diffstd"].shape[1]
+    tail_start = num_stable_segments * segment_size
+    tail_means = generate_segment_means(values[:, tail_start:])
+    tail_sizes = segment_sizes[num_stable_segments:]
+    tail_starts = np.concatenate([[0], np.cumsum(tail_sizes)[:-1]])
+    distances = np.hstack([state["diffstd"], check_diffstd(values[:, tail_start:], tail_means, tail_starts, tail_sizes)])
+    segment_means = np.concatenate([state["segment_means"][:tail_start], tail_means])
+
+    # SAX:  a word covers word_size letters of segment_split data points apiece.  Whether one word
+    # is unusual depends only on the other series' words at the same position, so complete words stay
+    # the same as well.  Word distances also scale with the square root of the series length, so we
+    # cache them unscaled and apply the scale for the current length.
+    word_size = 4
+    segment_split = state["segment_split"]
+    num_words = (l // segment_split) // word_size
+    num_stable_words = state["word_distances"].shape[1]
+    num_new_letters = (num_words - num_stable_words) * word_size
+    word_start = num_stable_words * word_size * segment_split
+    new_letters = get_sax_letters(values[:, word_start:word_start + num_new_letters*segment_split], state["mu"], state["std"], num_new_letters, state["breakpoints"]) if num_new_letters > 0 else np.empty((num_series, 0), dtype=np.int64)
+    (new_word_distances, sax_mode) = get_sax_word_distances(new_letters.reshape((num_series, num_words - num_stable_words, word_size)), get_symbol_distance_table(state["breakpoints"]), 1.0, sax_mode)
+    word_distances = np.hstack([state["word_distances"], new_word_distances])
+    m = word_distances * (l / word_size)**0.5
+
+    # If we have "overflow" (e.g., 19 data points and segment_split=2, use the final word)
+    point_words = np.minimum(np.arange(l) // (word_size*segment_split), num_words-1)
+    results = {
+        "sax_distance": m[:, point_words],
+        "segment_number": np.broadcast_to(np.repeat(np.arange(num_segments), segment_sizes), values.shape),
+        "diffstd_distance": np.repeat(distances, segment_sizes, axis=1)
+    }
+    diagnostics = {
+        "SAX": {
+            "SAX mode": sax_mode,
+            "Segment size per letter": segment_split,
+            "Number of segments": l//segment_split,
+            "Word size": word_size,
+            "Number of words": num_words,
+            "Words computed": num_words - num_stable_words,
+            "SAX matrix": m.tolist()
+        },
+        "Number of records": values.size,
+        "Number of segments per time series": num_segments,
+        "Segments computed": num_segments - num_stable_segments,
+        "Segment means": [segment_means[start:start + size].tolist() for (start, size) in zip(np.concatenate([[0], np.cumsum(segment_sizes)[:-1]]), segment_sizes)]
+    }
+
+    state = {
+        **state,
+        "length": l,
+        "segment_means": segment_means,
+        # The last segment grows as data arrives, so it is never stable.
+        "diffstd": distances[:, :num_segments - 1],
+        "word_distances": word_distances
+    }
+    return (results, diagnostics, state)
+
+@timing.timed("Hash group")
+def hash_group(group_id, values, series_keys, sax_mode="auto"):
+    # A cache entry is only usable if the group has the same series and SAX mode and each series
+    # starts with exactly the data we saw before.  We hash the data one time step at a
+    # time, so the same pass checks the previous data and gives us the hash of the full
+    # data, which is what we cache for next time.  Returns the entry (or None) and that hash.
+    entry = group_cache.get(group_id)
+    hasher = hashlib.blake2b(digest_size=16)
+    hashed_length = 0
+    if (entry is not None
+        and np.array_equal(entry["series_keys"], series_keys)
+        and entry["sax_mode"] == sax_mode
+        and entry["length"] <= values.shape[1]):
+        hasher.update(np.ascontiguousarray(values[:, :entry["length"]].T).tobytes())
+        hashed_length = entry["length"]
+        if hasher.hexdigest() != entry["hash"]:
+            entry = None
+    else:
+        entry = None
+    hasher.update(np.ascontiguousarray(values[:, hashed_length:].T).tobytes())
+    return (entry, hasher.hexdigest())
+
+def cache_group(group_id, state, values_hash):
+    entry = { **state, "hash": values_hash }
+    size_bytes = 1024 + 100 * len(state["series_keys"]) + state["segment_means"].nbytes + state["diffstd"].nbytes + state["word_distances"].nbytes
+    group_cache.put(group_id, entry, size_bytes)
+
+@timing.timed("Summarize segments")
+def summarize_segments(df, include_keys=False):
+    # Compact output:  one record per (series, DIFFSTD segment) rather than one per data point.
+    # df is the output of detect_multi_timeseries(), which lists each series in dt order.
+    # DIFFSTD results are the same for every point in a segment, but SAX words do not line up
+    # with segments, so we report the largest SAX and anomaly scores in the segment.  A segment
+    # is anomalous if any of its points is.  With include_keys, anomalous segments also list
+    # the keys of their anomalous points.
+    columns = ["series_key", "segment_number", "start_dt", "end_dt", "num_points", "diffstd_distance", "diffstd_score", "sax_score", "anomaly_score", "is_anomaly"]
+    if include_keys:
+        columns.append("anomalous_keys")
+    # Validation failures come back without test results, so there are no segments to report.
+    if ("segment_number" not in df.columns or df.shape[0] == 0):
+        return pd.DataFrame(columns=columns)
+
+    series_keys = df["series_key"].to_numpy()
+    segment_numbers = df["segment_number"].to_numpy()
+    is_new_segment = np.concatenate([[True], (series_keys[1:] != series_keys[:-1]) | (segment_numbers[1:] != segment_numbers[:-1])])
+    starts = np.flatnonzero(is_new_segment)
+    ends = np.append(starts[1:], df.shape[0]) - 1
+    is_anomaly = df["is_anomaly"].to_numpy()
+
+    segments = pd.DataFrame({
+        "series_key": series_keys[starts],
+        "segment_number": segment_numbers[starts],
+        "start_dt": df["dt"].to_numpy()[starts],
+        "end_dt": df["dt"].to_numpy()[ends],
+        "num_points": ends - starts + 1,
+        "diffstd_distance": df["diffstd_distance"].to_numpy()[starts],
+        "diffstd_score": df["diffstd_score"].to_numpy()[starts],
+        "sax_score": np.maximum.reduceat(df["sax_score"].to_numpy(), starts),
+        "anomaly_score": np.maximum.reduceat(df["anomaly_score"].to_numpy(), starts),
+        "is_anomaly": np.logical_or.reduceat(is_anomaly, starts)
+    })
+    if include_keys:
+        anomalous_keys = [None] * len(starts)
+        anomalous_points = np.flatnonzero(is_anomaly)
+        point_segments = np.cumsum(is_new_segment)[anomalous_points] - 1
+        (segment_ids, first_points) = np.unique(point_segments, return_index=True)
+        for (segment_id, keys) in zip(segment_ids, np.split(df["key"].to_numpy()[anomalous_points], first_points[1:])):
+            anomalous_keys[segment_id] = keys.tolist()
+        segments["anomalous_keys"] = anomalous_keys
+    return segments
+
+def get_segment_bounds(l, num_segments):
+    # Same boundaries as np.array_split:  the first (l % num_segments) segments get one extra data point.
+    segment_sizes = np.full(num_segments, l // num_segments)
+    segment_sizes[:l % num_segments] += 1
+    segment_starts = np.concatenate([[0], np.cumsum(segment_sizes)[:-1]])
+    return (segment_starts, segment_sizes)
+
+def generate_segment_means(values):
+    # The "average" series is the mean across all series at each point in time.
+    return values.mean(axis=0)
+
+def diffstd(differences, segment_starts, segment_sizes):
+    # differences is a (series x time) matrix of each series minus the comparison series.
+    # For each segment, square each difference's distance from the segment's mean difference.
+    # This guarantees all numbers are positive.
+    segment_mu = np.add.reduceat(differences, segment_starts, axis=1) / segment_sizes
+    diff2 = (differences - np.repeat(segment_mu, segment_sizes, axis=1))**2
     # Sum the squared differences, divide by the number of data points (to get an average),
-    # and take the square root of the result.  This returns a single number, the DIFFSTD comparing
-    # these two segments.
-    return (np.sum(diff2)/n)**0.5
+    # and take the square root of the result.  This returns a (series x segment) matrix of
+    # DIFFSTD values comparing each segment of each series against the comparison series.
+    return (np.add.reduceat(diff2, segment_starts, axis=1) / segment_sizes)**0.5
 
-def check_diffstd(series_segments, segment_means, num_series, num_segments):
+def check_diffstd(values, segment_means, segment_starts, segment_sizes):
     # For each series, make a pairwise comparison against the average.
-    for i in range(num_series):
-        for j in range(num_segments):
-            series_segments[i][j]['segment_number'] = j
-            series_segments[i][j]['diffstd_distance'] = diffstd(series_segments[i][j]['value'], segment_means[j])
-    return series_segments
+    return diffstd(values - segment_means, segment_starts, segment_sizes)
 
-def check_sax(series, num_series, l):
+def get_sax_segment_split(l):
+    # We determine each alphabet character based on 2-5 data points (depending on total data length)
     if (l < 100):
-        segment_split = 2
+        return 2
     elif (l < 1000):
-        segment_split = 3
+        return 3
     else:
-        segment_split = 5
+        return 5
 
+@timing.timed("SAX and DIFFSTD transform")
+def transform_series(values, segment_split, segment_starts, segment_sizes):
     # The current recommendation for SAX is that you limit the alphabet size to 3-5, with 4 being
     # the typical sweet spot.  We also want to normalize our input data, so scale = True.
-    # We determine each alphabet character based on 2-5 data points (depending on total data length)
+    l = values.shape[1]
     sax = SymbolicAggregateApproximation(n_segments= l//segment_split, alphabet_size_avg=4, scale=True)
 
-    # slist is a list of lists:  one list per series, NOT per segment!
-    slist = [series[i]['value'].tolist() for i in range(num_series)]
-
-    # sax_data is an array containing a list (one per series) of lists (containing the "letter")
-    #    eg:  array([ [[1],[1],[1]], [[1],[0],[2]], [[2],[2],[1]] ])
+    # sax_data is an array containing a list (one per series) of "letters"
+    #    eg:  array([ [1,1,1], [1,0,2], [2,2,1] ])
     # Note that tslearn doesn't use a letter-based alphabet but instead a numeric one:  0, 1, 2, 3.
-    sax_data = sax.fit_transform(slist)
+    sax.fit(values)
+    sax_data = sax_transform(sax, values)
+
+    segment_means = generate_segment_means(values)
+    distances = check_diffstd(values, segment_means, segment_starts, segment_sizes)
+    return (sax_data, sax.breakpoints_avg_, segment_means, distances)
+
+def get_shard_bounds(num_series, num_shards):
+    (starts, sizes) = get_segment_bounds(num_series, min(num_shards, num_series))
+    return [(int(start), int(start + size)) for (start, size) in zip(starts, sizes)]
+
+def summarize_values(values):
+    # Everything the reduce step needs from one shard of series.
+    mean = values.mean()
+    return {
+        "count": values.size,
+        "mean": mean,
+        "m2": ((values - mean)**2).sum(),
+        "column_sums": values.sum(axis=0)
+    }
+
+def combine_summaries(summaries):
+    # Combine per-shard means and sums of squared deviations (Chan et al.'s parallel variance),
+    # which avoids the cancellation problems of summing squares directly.
+    count = 0
+    mean = 0.0
+    m2 = 0.0
+    for summary in summaries:
+        total = count + summary["count"]
+        delta = summary["mean"] - mean
+        mean = mean + delta * summary["count"] / total
+        m2 = m2 + summary["m2"] + delta**2 * count * summary["count"] / total
+        count = total
+    column_sums = np.sum([summary["column_sums"] for summary in summaries], axis=0)
+    return (count, mean, (m2 / count)**0.5, column_sums)
+
+def summarize_shard(descriptor, start, stop):
+    # Runs in a worker process over the series in rows [start, stop) of the shared matrix.
+    (shm, values) = parallel.attach_array(descriptor)
+    try:
+        summary = summarize_values(values[start:stop])
+    finally:
+        del values
+        shm.close()
+    return summary
+
+def transform_shard(descriptor, start, stop, mu, std, n_segments, breakpoints, segment_means, segment_starts, segment_sizes):
+    # Runs in a worker process.  Same work as transform_series() for one shard, using
+    # statistics gathered across every shard in the reduce step.
+    (shm, values) = parallel.attach_array(descriptor)
+    try:
+        shard = values[start:stop]
+        sax_data = get_sax_letters(shard, mu, std, n_segments, breakpoints)
+        distances = check_diffstd(shard, segment_means, segment_starts, segment_sizes)
+    finally:
+        del shard
+        del values
+        shm.close()
+    return (sax_data, distances)
+
+@timing.timed("SAX and DIFFSTD transform (parallel)")
+def transform_series_parallel(values, segment_split, segment_starts, segment_sizes, num_shards):
+    (num_series, l) = values.shape
+    shards = get_shard_bounds(num_series, num_shards)
+    (shm, descriptor) = parallel.share_array(values)
+    try:
+        executor = parallel.get_executor()
+        # Reduce step:  SAX scales every value by the mean and standard deviation across all series,
+        # and DIFFSTD compares each series against the mean across all series at each point in time.
+        summaries = [f.result() for f in [executor.submit(summarize_shard, descriptor, start, stop) for (start, stop) in shards]]
+        (count, mu, std, column_sums) = combine_summaries(summaries)
+        # Same handling of constant data and the same breakpoints as tslearn.
+        std = 1.0 if std == 0.0 else std
+        alphabet_size = 4
+        breakpoints = norm.ppf([float(a) / alphabet_size for a in range(1, alphabet_size)])
+        segment_means = column_sums / num_series
+        # Broadcast those statistics back out to the shards.
+        futures = [executor.submit(transform_shard, descriptor, start, stop, mu, std, l//segment_split, breakpoints, segment_means, segment_starts, segment_sizes) for (start, stop) in shards]
+        results = [f.result() for f in futures]
+    finally:
+        parallel.release_array(shm)
+    sax_data = np.vstack([r[0] for r in results])
+    distances = np.vstack([r[1] for r in results])
+    return (sax_data, breakpoints, segment_means, distances)
+
+@timing.timed("SAX distances")
+def check_sax(sax_data, breakpoints, l, segment_split, sax_mode="auto"):
+    num_series = sax_data.shape[0]
 
     # tslearn gives us the ability to perform pairwise comparisons of SAX results using a distance measure.
     # We will break things into fixed-size chunks of 4 letters, e.g. 1103 | 3111 | 2203
@@ -133,23 +551,26 @@ def check_sax(series, num_series, l):
     num_words = len(sax_data[0])//word_size
 
     # Create a matrix which will hold the mean score of these pairwise comparisons.
-    m = np.empty((num_series, num_words))
-    for i in range(num_series):
-        for j in range(num_words):
-            # Calculate pairwise distances for each word of SAX results
-            # For example, given three series:
-            #  1103 | 1111 | 2203
-            #  1100 | 2111 | 2202
-            #  1211 | 3111 | 2201
-            # We would find the distance between 1103 and each of 1100 and 1211 and average it out.
-            # That result would go into m[0][0].
-            # m[0][1] would be the average distance between 1111 and 2111 / 3111, etc.
-            # The calculation here technically also includes the distance between 1103 and 1103, which is always 0.
-            # Therefore, we subtract 1 from num_series and we still get a good average.
-            m[i][j] = sum(sax.distance_sax(sax_data[i][j*word_size:(1+j)*word_size],sax_data[k][j*word_size:(1+j)*word_size])
-                for k in range(num_series))/(num_series-1)
+    # Calculate pairwise distances for each word of SAX results
+    # For example, given three series:
+    #  1103 | 1111 | 2203
+    #  1100 | 2111 | 2202
+    #  1211 | 3111 | 2201
+    # We would find the distance between 1103 and each of 1100 and 1211 and average it out.
+    # That result would go into m[0][0].
+    # m[0][1] would be the average distance between 1111 and 2111 / 3111, etc.
+    # The calculation here technically also includes the distance between 1103 and 1103, which is always 0.
+    # Therefore, we subtract 1 from num_series and we still get a good average.
+    # Rather than call sax.distance_sax() once per pair of words, we look up the distance
+    # between each pair of letters in a table and compute every comparison with array operations.
+    # Comparing every series against every other series grows with the square of the number of series,
+    # so for larger numbers of series we switch to word histograms, which give the same answer.
+    words = sax_data[:, :num_words*word_size].reshape((num_series, num_words, word_size))
+    symbol_distances = get_symbol_distance_table(breakpoints)
+    (m, sax_mode) = get_sax_word_distances(words, symbol_distances, l / word_size, sax_mode)
 
     diagnostics = {
+        "SAX mode": sax_mode,
         "Segment size per letter": segment_split,
         "Number of segments":  l//segment_split,
         "Word size": word_size,
@@ -158,77 +579,185 @@ def check_sax(series, num_series, l):
     }
 
     # Set the SAX distance for each section of each series.
-    for i in range(num_series):
-        # If we have "overflow" (e.g., 19 data points and segment_split=2, use the final word)
-        series[i]['sax_distance'] = [m[i][min(j//(word_size*segment_split), num_words-1)] for j,val in enumerate(series[0].index)]
-
-    return (series, diagnostics)
-
-def score_results(df, tests_run, sensitivity_score):
+    # If we have "overflow" (e.g., 19 data points and segment_split=2, use the final word)
+    point_words = np.minimum(np.arange(l) // (word_size*segment_split), num_words-1)
+    return (m[:, point_words], diagnostics)
+
+def get_sax_word_distances(words, symbol_distances, scale, sax_mode="auto"):
+    # Returns the (series x word) matrix of mean distances along with the mode we actually used.
+    (num_series, num_words, word_size) = words.shape
+    alphabet_size = symbol_distances.shape[0]
+    if sax_mode == "auto":
+        sax_mode = "histogram" if num_series > alphabet_size**word_size else "pairwise"
+    if sax_mode not in ["pairwise", "histogram", "sampled"]:
+        raise ValueError(f"Unknown SAX mode {sax_mode}.  Valid modes are auto, pairwise, histogram, and sampled.")
+    # With a cached group, there may be no new words to compare.
+    if num_words == 0:
+        m = np.empty((num_series, 0))
+    elif sax_mode == "pairwise":
+        m = check_sax_distances(words, symbol_distances, scale)
+    elif sax_mode == "histogram":
+        m = check_sax_distances_histogram(words, symbol_distances, scale)
+    else:
+        m = check_sax_distances_sampled(words, symbol_distances, scale, SAX_SAMPLE_SIZE)
+    return (m, sax_mode)
+
+def sax_transform(sax, values):
+    # Equivalent to sax.transform() on a (series x time) matrix, but computed across all series
+    # at once rather than looping over each series and segment.  We use the scaling parameters
+    # and breakpoints from the fitted tslearn object, so the letters are identical.
+    return get_sax_letters(values, sax.mu_[0], sax.std_[0], sax.n_segments, sax.breakpoints_avg_)
+
+def get_sax_letters(values, mu, std, n_segments, breakpoints):
+    (num_series, l) = values.shape
+    scaled = (values - mu) / std
+    # Piecewise Aggregate Approximation:  the mean of each equal-sized segment.  As in tslearn,
+    # any leftover data points at the end of the series are not part of a segment.
+    segment_size = l // n_segments
+    paa = scaled[:, :n_segments*segment_size].reshape((num_series, n_segments, segment_size)).mean(axis=2)
+    # A letter is the number of breakpoints at or below the segment mean.
+    return np.searchsorted(breakpoints, paa, side="right")
+
+def get_symbol_distance_table(breakpoints):
+    # SAX distance between two letters is 0 if they are the same or adjacent.  Otherwise,
+    # it is the distance between the breakpoints separating them.  We store squared distances,
+    # as those are what we sum up across the letters of a word.
+    alphabet_size = len(breakpoints) + 1
+    table = np.zeros((alphabet_size, alphabet_size))
+    for r in range(alphabet_size):
+        for c in range(alphabet_size):
+            if abs(r - c) > 1:
+                table[r][c] = (breakpoints[max(r, c) - 1] - breakpoints[min(r, c)])**2
+    return table
+
+def check_sax_distances(words, symbol_distances, scale, max_block_bytes=64*1024*1024):
+    # words is a (series x word x letter) array of SAX symbols.  The SAX distance between two
+    # words is sqrt(scale * sum of squared letter distances), where scale is the original series
+    # length divided by the number of letters in the word.
+    # Returns a (series x word) matrix of each word's mean distance to the same word in every other series.
+    (num_series, num_words, word_size) = words.shape
+    m = np.empty((num_series, num_words))
+    # Comparing a block of series against all series takes (block x series x word x letter) floats,
+    # so we work through the series in blocks to keep memory bounded.
+    block_size = max(1, int(max_block_bytes // (8 * num_series * num_words * word_size)))
+    for start in range(0, num_series, block_size):
+        block = words[start:start + block_size]
+        squared = symbol_distances[block[:, np.newaxis, :, :], words[np.newaxis, :, :, :]].sum(axis=-1)
+        m[start:start + block_size] = np.sqrt(squared * scale).sum(axis=1) / (num_series - 1)
+    return m
+
+def get_word_ids(words, alphabet_size):
+    # Treat each word as a number in base alphabet_size, e.g. with 4 letters, 1103 becomes 83.
+    word_size = words.shape[-1]
+    return (words * (alphabet_size ** np.arange(word_size - 1, -1, -1))).sum(axis=-1)
+
+def get_word_distance_table(symbol_distances, word_size, scale):
+    # SAX distance between every possible pair of words.  With our alphabet of 4 letters
+    # and 4-letter words, this is a 256 x 256 table.
+    alphabet_size = symbol_distances.shape[0]
+    all_words = np.array(np.unravel_index(np.arange(alphabet_size**word_size), [alphabet_size] * word_size)).T
+    squared = symbol_distances[all_words[:, np.newaxis, :], all_words[np.newaxis, :, :]].sum(axis=-1)
+    return np.sqrt(squared * scale)
+
+def check_sax_distances_histogram(words, symbol_distances, scale):
+    # SAX distance depends only on the pair of words being compared, so the sum of a word's
+    # distances to every other series at a given position is the sum over all possible words
+    # of (distance to that word) x (number of series with that word at this position).
+    # This is linear in the number of series rather than quadratic and gives the same answer
+    # as comparing every pair of series.
+    (num_series, num_words, word_size) = words.shape
+    alphabet_size = symbol_distances.shape[0]
+    num_possible_words = alphabet_size**word_size
+    word_ids = get_word_ids(words, alphabet_size)
+    # counts is a (word position x possible word) histogram.
+    counts = np.zeros((num_words, num_possible_words))
+    np.add.at(counts, (np.broadcast_to(np.arange(num_words), word_ids.shape), word_ids), 1)
+    # totals[j][w] is the summed distance from word w to every series' word at position j.
+    totals = counts @ get_word_distance_table(symbol_distances, word_size, scale)
+    return totals[np.arange(num_words), word_ids] / (num_series - 1)
+
+def check_sax_distances_sampled(words, symbol_distances, scale, sample_size, seed=0):
+    # Approximate each word's mean distance to the other series by comparing it against
+    # a fixed random sample of reference series instead of against every series.
+    (num_series, num_words, word_size) = words.shape
+    if num_series <= sample_size:
+        return check_sax_distances(words, symbol_distances, scale)
+    reference_idx = np.sort(np.random.default_rng(seed).choice(num_series, size=sample_size, replace=False))
+    alphabet_size = symbol_distances.shape[0]
+    word_distances = get_word_distance_table(symbol_distances, word_size, scale)
+    word_ids = get_word_ids(words, alphabet_size)
+    reference_ids = word_ids[reference_idx]
+    m = np.empty((num_series, num_words))
+    for j in range(num_words):
+        m[:, j] = word_distances[word_ids[:, j][:, np.newaxis], reference_ids[:, j][np.newaxis, :]].sum(axis=1)
+    # A reference series compared against itself contributes a distance of 0, so leave it out of the count.
+    is_reference = np.isin(np.arange(num_series), reference_idx)
+    return m / (sample_size - is_reference)[:, np.newaxis]
+
+@timing.timed("Scoring")
+def score_results(results, tests_run, sensitivity_score):
     # Calculate anomaly score for each series independently.
     # This is because DIFFSTD distances are not normalized across series.
-    series = [y for x, y in df.groupby("series_key", as_index=False)]
-    num_series = len(series)
-    diagnostics = { }
-
-    for i in range(num_series):
-        # DIFFSTD doesn't have a hard cutoff point describing when something is (or is not) an outlier.
-        # Therefore, to reduce the number of results, we'll start with 1.5 * mean of diffstd distances as a max distance score.
-        diffstd_mean = series[i]['diffstd_distance'].mean()
-
-        # Subtract from 1.5 the sensitivity_score/100.0, so at 100 sensitivity, we use 0.5 * mean as a max distance from the mean.
-        # Ex:  if the mean is 10 and sensitivity_score is 0, we'll look for segments with DIFFSTD above (10 + 1.5*10) = 25
-        # With sensitivity_score 100, the cutoff score will be 15.
-        diffstd_sensitivity_threshold = diffstd_mean + ((1.5 - (sensitivity_score / 100.0)) * diffstd_mean)
-
-        # The diffstd_score is the percentage difference between the distance and the sensitivity threshold.
-        series[i]['diffstd_score'] = (series[i]['diffstd_distance'] - diffstd_sensitivity_threshold) / diffstd_sensitivity_threshold
-
-        # SAX also doesn't have a hard cutoff point so we will use a rule of thumb here as well.
-        # Some divergence is noticeable at approximately 2.5 and major divergence is notable at about 3-4.
-        # If we multiply by 15, we can calculate the percentage of this score versus (100 - sensitivity_score).
-        # This will not necessarily put us on the same scale as DIFFSTD but will ensure that for higher sensitivity
-        # scores, 1.5 will trigger with a SAX score > 0, indicating at least a small outlier.
-        # Also, cap the threshold at a floor value of 25.0 to prevent absurd results.
-        sax_sensitivity_threshold = max(100.0 - sensitivity_score, 25.0)
-        series[i]['sax_score'] = ((series[i]['sax_distance'] * 15.0) - sax_sensitivity_threshold) / sax_sensitivity_threshold
-
-        # Our anomaly score is the sum of diffstd_score and sax_score.  Because DIFFSTD and SAX
-        # split data different ways, this helps us at the margin with determining *which* data points in the series
-        # are the biggest outliers, as the intersection of high SAX + high DIFFSTD will be the most likely culprits.
-        series[i]['anomaly_score'] = series[i]['sax_score'] + series[i]['diffstd_score']
-
-        diagnostics["Series " + str(i)] = {
-            "Mean DIFFSTD distance": diffstd_mean,
-            "DIFFSTD sensitivity threshold": diffstd_sensitivity_threshold,
+    # Each row of the result matrices is one series, so we work across rows.
+    diffstd_distance = results["diffstd_distance"]
+
+    # DIFFSTD doesn't have a hard cutoff point describing when something is (or is not) an outlier.
+    # Therefore, to reduce the number of results, we'll start with 1.5 * mean of diffstd distances as a max distance score.
+    diffstd_mean = diffstd_distance.mean(axis=1)
+
+    # Subtract from 1.5 the sensitivity_score/100.0, so at 100 sensitivity, we use 0.5 * mean as a max distance from the mean.
+    # Ex:  if the mean is 10 and sensitivity_score is 0, we'll look for segments with DIFFSTD above (10 + 1.5*10) = 25
+    # With sensitivity_score 100, the cutoff score will be 15.
+    diffstd_sensitivity_threshold = diffstd_mean + ((1.5 - (sensitivity_score / 100.0)) * diffstd_mean)
+
+    # The diffstd_score is the percentage difference between the distance and the sensitivity threshold.
+    threshold = diffstd_sensitivity_threshold[:, np.newaxis]
+    results["diffstd_score"] = (diffstd_distance - threshold) / threshold
+
+    # SAX also doesn't have a hard cutoff point so we will use a rule of thumb here as well.
+    # Some divergence is noticeable at approximately 2.5 and major divergence is notable at about 3-4.
+    # If we multiply by 15, we can calculate the percentage of this score versus (100 - sensitivity_score).
+    # This will not necessarily put us on the same scale as DIFFSTD but will ensure that for higher sensitivity
+    # scores, 1.5 will trigger with a SAX score > 0, indicating at least a small outlier.
+    # Also, cap the threshold at a floor value of 25.0 to prevent absurd results.
+    sax_sensitivity_threshold = max(100.0 - sensitivity_score, 25.0)
+    results["sax_score"] = ((results["sax_distance"] * 15.0) - sax_sensitivity_threshold) / sax_sensitivity_threshold
+
+    # Our anomaly score is the sum of diffstd_score and sax_score.  Because DIFFSTD and SAX
+    # split data different ways, this helps us at the margin with determining *which* data points in the series
+    # are the biggest outliers, as the intersection of high SAX + high DIFFSTD will be the most likely culprits.
+    results["anomaly_score"] = results["sax_score"] + results["diffstd_score"]
+
+    diagnostics = {
+        "Series " + str(i): {
+            "Mean DIFFSTD distance": mean,
+            "DIFFSTD sensitivity threshold": threshold,
             "SAX sensitivity threshold": sax_sensitivity_threshold
-        }
+        } for (i, (mean, threshold)) in enumerate(zip(diffstd_mean.tolist(), diffstd_sensitivity_threshold.tolist()))
+    }
 
-    return (pd.concat(series), diagnostics)
+    return (results, diagnostics)
 
 def determine_outliers(
-    df,
+    results,
     max_fraction_anomalies
 ):
-    series = [y for x, y in df.groupby("series_key", as_index=False)]
-
-    # Get the 100-Nth percentile of anomaly score.
+    # Get the 100-Nth percentile of anomaly score for each series.
     # Ex:  if max_fraction_anomalies = 0.1, get the
     # 90th percentile anomaly score.
-    max_fraction_anomaly_scores = [np.quantile(s['anomaly_score'], 1.0 - max_fraction_anomalies) for s in series]
-    diagnostics = {"Max fraction anomaly scores":  max_fraction_anomaly_scores }
+    max_fraction_anomaly_scores = np.quantile(results["anomaly_score"], 1.0 - max_fraction_anomalies, axis=1)
+    diagnostics = {"Max fraction anomaly scores":  max_fraction_anomaly_scores.tolist() }
 
     # When scoring outliers, we made 0.01 the sensitivity threshold, as 0 means no differences.
     # If the max fraction anomaly score is greater than 0, it means that we have MORE outliers
     # than our max_fraction_anomalies supports, and therefore we
     # need to cut it off before we get down to our sensitivity score.
     # Otherwise, sensitivity score stays the same and we operate as normal.
-    sensitivity_thresholds = [max(0.01, mfa) for mfa in max_fraction_anomaly_scores]
-    diagnostics["Sensitivity scores"] = sensitivity_thresholds
+    sensitivity_thresholds = np.maximum(0.01, max_fraction_anomaly_scores)
+    diagnostics["Sensitivity scores"] = sensitivity_thresholds.tolist()
 
     # We treat segments as outliers, not individual data points.  Mark each segment with a sufficiently large
     # anomaly score as an outlier for subsequent review.
-    for i in range(len(series)):
-        series[i]['is_anomaly'] = [score >= sensitivity_thresholds[i] for score in series[i]['anomaly_score']]
+    results["is_anomaly"] = results["anomaly_score"] >= sensitivity_thresholds[:, np.newaxis]
 
-    return (pd.concat(series), diagnostics)
+    return (results, diagnostics)
@@ -11,12 +11,34 @@ from pyod.models.copod import COPOD
 from pyod.models.combination import aom, moa, average, median, maximization, majority_vote
 from pyod.utils.data import evaluate_print
 from sklearn.preprocessing import OrdinalEncoder
+from .. import timing
+
+# Sensitivity-dependent columns of the output.  See thresholds.py.
+# is_raw_anomaly_cof is missing when COF did not run.
+THRESHOLD_COLUMNS = ["is_anomaly", "is_raw_anomaly_cof"]
 
 def detect_multivariate_statistical(
     df,
     sensitivity_score,
     max_fraction_anomalies,
-    n_neighbors
+    n_neighbors,
+    disabled_tests=(),
+    cof_method="fast"
+):
+    # Scoring does not depend on the sensitivity settings, so we score first and apply the settings after.
+    (scored, weights, details) = score_multivariate_statistical(df, sensitivity_score, max_fraction_anomalies, n_neighbors, disabled_tests, cof_method)
+    if isinstance(details, str):
+        return (scored["df"], weights, details)
+    (df_out, threshold_details) = apply_threshold(scored, sensitivity_score, max_fraction_anomalies)
+    return (df_out, weights, { **details, **threshold_details })
+
+def score_multivariate_statistical(
+    df,
+    sensitivity_score,
+    max_fraction_anomalies,
+    n_neighbors,
+    disabled_tests=(),
+    cof_method="fast"
 ):
     # Unlike univariate ensembling, we don't weight any of
     # our multivariate ensemble specially.  We do need a
@@ -31,27 +53,49 @@ def detect_multivariate_statistical(
 
     num_data_points = df['vals'].count()
     if (num_data_points < 15):
-        return (df.assign(is_anomaly=False, anomaly_score=0.0), weights, f"Must have a minimum of at least fifteen data points for anomaly detection.  You sent {num_data_points}.")
+        return ({ "df": df.assign(is_anomaly=False, anomaly_score=0.0) }, weights, f"Must have a minimum of at least fifteen data points for anomaly detection.  You sent {num_data_points}.")
     elif (max_fraction_anomalies <= 0.0 or max_fraction_anomalies > 1.0):
-        return (df.assign(is_anomaly=False, anomaly_score=0.0), weights, "Must have a valid max fraction of anomalies, 0 < x <= 1.0.")
+        return ({ "df": df.assign(is_anomaly=False, anomaly_score=0.0) }, weights, "Must have a valid max fraction of anomalies, 0 < x <= 1.0.")
     elif (sensitivity_score <= 0 or sensitivity_score > 100 ):
-        return (df.assign(is_anomaly=False, anomaly_score=0.0), weights, "Must have a valid sensitivity score, 0 < x <= 100.")
+        return ({ "df": df.assign(is_anomaly=False, anomaly_score=0.0) }, weights, "Must have a valid sensitivity score, 0 < x <= 100.")
     elif (df['vals'].count() < (n_neighbors - 5)):
-        return (df.assign(is_anomaly=False, anomaly_score=0.0), weights, f"You sent in {num_data_points} data points, so n_neighbors should be no more than {num_data_points - 5}--that is, n_neighbors should be at least 5 less than the number of observations.")
+        return ({ "df": df.assign(is_anomaly=False, anomaly_score=0.0) }, weights, f"You sent in {num_data_points} data points, so n_neighbors should be no more than {num_data_points - 5}--that is, n_neighbors should be at least 5 less than the number of observations.")
     else:
-        # Max fraction of anomalies must be no more than 0.5 for COF.
-        if max_fraction_anomalies > 0.5:
-            max_fraction_anomalies = 0.5
         # Number of neighbors should be no more than 5 if we have fewer than 16 data points.
         # Once we have more data points, we can switch to larger counts.  This prevents an issue with 15 data points
         # where we look at an incomplete range.
         if num_data_points < 16:
             n_neighbors = min(n_neighbors, 5)
         (df_encoded, diagnostics) = encode_string_data(df)
-        (df_tested, tests_run, diagnostics) = run_tests(df_encoded, max_fraction_anomalies, n_neighbors)
-        (df_out, diag_outliers) = determine_outliers(df_tested, tests_run, sensitivity_factors, sensitivity_score, max_fraction_anomalies)
-        return (df_out, weights, { "message": "Result of multivariate statistical tests.", "Tests run": tests_run, "Test diagnostics": diagnostics, "Outlier determination": diag_outliers})
-
+        (df_tested, tests_run, diagnostics, cof_scores) = run_tests(df_encoded, n_neighbors, disabled_tests, cof_method)
+        scored = { "df": df_tested, "tests_run": tests_run, "sensitivity_factors": sensitivity_factors, "cof_scores": cof_scores }
+        return (scored, weights, { "message": "Result of multivariate statistical tests.", "Tests run": tests_run, "Test diagnostics": diagnostics })
+
+@timing.timed("Apply threshold")
+def apply_threshold(scored, sensitivity_score, max_fraction_anomalies):
+    # Max fraction of anomalies must be no more than 0.5, as COF uses it for contamination.
+    max_fraction_anomalies = min(max_fraction_anomalies, 0.5)
+    df = scored["df"]
+    details = {}
+    if scored.get("cof_scores") is not None:
+        (df, details["COF"]) = label_cof(df, scored["cof_scores"], max_fraction_anomalies)
+    (df_out, diag_outliers) = determine_outliers(df, scored["tests_run"], scored["sensitivity_factors"], sensitivity_score, max_fraction_anomalies)
+    return (df_out, { **details, "Outlier determination": diag_outliers })
+
+def label_cof(df, cof_scores, max_fraction_anomalies):
+    # COF's scores do not depend on its contamination, but its labels do:  for each number of neighbors,
+    # points scoring above the (1 - contamination) quantile are anomalies, as in PyOD.  The raw label is
+    # the majority vote across numbers of neighbors.
+    scores_cof = cof_scores["scores"]
+    thresholds = np.percentile(scores_cof, 100 * (1 - max_fraction_anomalies), axis=0)
+    labels_cof = (scores_cof > thresholds).astype(int)
+    df = df.copy()
+    df.insert(df.columns.get_loc("anomaly_score_cof"), "is_raw_anomaly_cof", majority_vote(labels_cof))
+    diagnostics = { "Neighbors_" + str(n): { "COF Contamination": max_fraction_anomalies, "COF Threshold": t }
+        for (n, t) in zip(cof_scores["neighbors"], thresholds) }
+    return (df, diagnostics)
+
+@timing.timed("Encode strings")
 def encode_string_data(df):
     # df comes in with two columns:  key and vals.
     # We want to break out the list in vals and turn it into a set of columns.
@@ -80,15 +124,16 @@ def encode_string_data(df):
 
     return (pd.concat([df, df2], axis=1), diagnostics)
 
-def run_tests(df, max_fraction_anomalies, n_neighbors):
+def run_tests(df, n_neighbors, disabled_tests=(), cof_method="fast"):
     num_records = df['key'].shape[0]
-    if (num_records > 1000):
+    if (num_records > 1000 or "loci" in disabled_tests):
         run_loci = 0
     else:
         run_loci = 1
+    run_cof = 0 if "cof" in disabled_tests else 1
 
     tests_run = {
-        "cof": 1,
+        "cof": run_cof,
         "loci": run_loci,
         "copod": 1
     }
@@ -99,25 +144,28 @@ def run_tests(df, max_fraction_anomalies, n_neighbors):
     # Bring them back in as an array, as that's what our tests will require.
     col_array = df.drop(["key", "vals"], axis=1).to_numpy()
 
-    # Determine numbers of neighbors
-    # Ensure we have n_neighbors at least 5 below the number of records.
-    # Ensure we have a boundary on number of tests.  100 above n_neighbors is a bit arbitrary
-    # if we have extremely large datasets but should be fine for 1k-10k.
-    n_neighbor_range = range(n_neighbors, min(num_records - 5, n_neighbors + 100), 5)
-    n_neighbor_range_len = len(n_neighbor_range)
+    anomaly_score = np.zeros([num_records])
+    cof_scores = None
 
     # COF
-    labels_cof = np.zeros([num_records, n_neighbor_range_len])
-    scores_cof = np.zeros([num_records, n_neighbor_range_len])
-    for idx,n in enumerate(n_neighbor_range):
-        (labels_cof[:, idx], scores_cof[:, idx], diag_idx) = check_cof(col_array, max_fraction_anomalies=max_fraction_anomalies, n_neighbors=n)
-        k = "Neighbors_" + str(n)
-        diagnostics[k] = diag_idx
-
-
-    df["is_raw_anomaly_cof"] = majority_vote(labels_cof)
-    anomaly_score = median(scores_cof)
-    df["anomaly_score_cof"] = anomaly_score
+    if (run_cof == 1):
+        # Determine numbers of neighbors
+        # Ensure we have n_neighbors at least 5 below the number of records.
+        # Ensure we have a boundary on number of tests.  100 above n_neighbors is a bit arbitrary
+        # if we have extremely large datasets but should be fine for 1k-10k.
+        n_neighbor_range = range(n_neighbors, min(num_records - 5, n_neighbors + 100), 5)
+        n_neighbor_range_len = len(n_neighbor_range)
+
+        scores_cof = np.zeros([num_records, n_neighbor_range_len])
+        for idx,n in enumerate(n_neighbor_range):
+            scores_cof[:, idx] = check_cof(col_array, n_neighbors=n, method=cof_method)
+
+        # We keep each run's scores so that we can label them for any max_fraction_anomalies (see label_cof).
+        cof_scores = { "neighbors": list(n_neighbor_range), "scores": scores_cof }
+        anomaly_score = median(scores_cof)
+        df["anomaly_score_cof"] = anomaly_score
+    else:
+        diagnostics["COF"] = "Did not run COF because it was disabled for this request."
 
     # LOCI
     if (run_loci == 1):
@@ -135,19 +183,20 @@ def run_tests(df, max_fraction_anomalies, n_neighbors):
     anomaly_score = anomaly_score + scores_copod
 
     df["anomaly_score"] = anomaly_score
-    return (df, tests_run, diagnostics)
+    return (df, tests_run, diagnostics, cof_scores)
 
 
-def check_cof(col_array, max_fraction_anomalies, n_neighbors):
-    clf = COF(n_neighbors=n_neighbors, contamination=max_fraction_anomalies)
+@timing.timed("COF")
+def check_cof(col_array, n_neighbors, method="fast"):
+    # The fast method holds the full pairwise distance matrix in memory.
+    # The memory method calculates distances as it needs them.
+    # Scores do not depend on contamination, so we label them later (see label_cof).
+    clf = COF(n_neighbors=n_neighbors, method=method)
     clf.fit(col_array)
-    diagnostics = {
-        "COF Contamination": clf.contamination,
-        "COF Threshold": clf.threshold_
-    }
-    return (clf.labels_, clf.decision_scores_, diagnostics)
+    return clf.decision_scores_
 
 # LOCI doesn't use contamination and has good defaults of k=3 and alpha=0.5.
+@timing.timed("LOCI")
 def check_loci(col_array):
     clf = LOCI()
     clf.fit(col_array)
@@ -156,6 +205,7 @@ def check_loci(col_array):
     }
     return (clf.labels_, clf.decision_scores_, diagnostics)
 
+@timing.timed("COPOD")
 def check_copod(col_array):
     clf = COPOD()
     clf.fit(col_array)
@@ -0,0 +1,52 @@
+# Finding Ghosts in Your Data
+# Process pool and shared memory helpers for the anomaly detection models
+
+import os
+import atexit
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+
+# Number of worker processes available to the models.  Set ANOMALY_MODEL_WORKERS
+# to 1 to keep all work in the calling process.  Within the API's worker processes
+# (see app/executor.py), this defaults to each worker's share of the CPUs instead,
+# which is two processes with four or more CPUs (one with two or three) unless ANOMALY_API_WORKERS is set.
+max_workers = int(os.environ.get("ANOMALY_MODEL_WORKERS", os.cpu_count() or 1))
+
+_executor = None
+
+def is_enabled():
+    return max_workers > 1
+
+def get_executor():
+    # The pool is created on first use and then kept around, as starting up
+    # worker processes (and importing ruptures, tslearn, etc.) is expensive.
+    # We use spawn rather than fork because the API process runs threads.
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+        atexit.register(_executor.shutdown)
+    return _executor
+
+def share_array(arr):
+    # Copy an array into a shared memory block once so that every worker can read
+    # it without pickling the data for each task.  The caller owns the block and
+    # must close and unlink it once all workers are done.
+    arr = np.ascontiguousarray(arr)
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    shared = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+    shared[...] = arr
+    return (shm, (shm.name, arr.shape, arr.dtype.str))
+
+def attach_array(descriptor):
+    # Workers call this to get a read-only view over a block created by share_array.
+    (name, shape, dtype) = descriptor
+    shm = shared_memory.SharedMemory(name=name)
+    arr = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    arr.flags.writeable = False
+    return (shm, arr)
+
+def release_array(shm):
+    shm.close()
+    shm.unlink()
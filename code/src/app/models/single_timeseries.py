@@ -2,15 +2,56 @@
 # Time series anomaly detection
 # For more information on this, review chapters 13-14
 
+import os
+import hashlib
 import pandas as pd
 import numpy as np
 from pandas.core import base
 import ruptures as rpt
+from scipy.spatial.distance import pdist
+from . import parallel
+from ..caching import SizedLRUCache
+from .. import timing
+
+# Below this many data points, the cost of handing work to other processes
+# outweighs the savings from fitting kernels in parallel.
+MIN_PARALLEL_RECORDS = 1000
+
+# When a client re-posts a series with new points appended and asks for incremental results, we keep
+# changepoints found at least this many points before the end of the previous request and only re-solve the tail.
+STABLE_BREAKPOINT_MARGIN = 20
+
+# Changepoint results by series id.  See run_tests() for how we use this.
+changepoint_cache = SizedLRUCache(
+    max_entries=int(os.environ.get("ANOMALY_CHANGEPOINT_CACHE_ENTRIES", 1000)),
+    max_bytes=int(os.environ.get("ANOMALY_CHANGEPOINT_CACHE_MB", 256)) * 1024 * 1024
+)
+
+# Sensitivity-dependent columns of the output.  See thresholds.py.
+THRESHOLD_COLUMNS = ["is_anomaly"]
 
 def detect_single_timeseries(
     df,
     sensitivity_score,
-    max_fraction_anomalies
+    max_fraction_anomalies,
+    kernels=None,
+    series_id=None,
+    incremental=False
+):
+    # Scoring does not depend on the sensitivity settings, so we score first and apply the settings after.
+    (scored, weights, details) = score_single_timeseries(df, sensitivity_score, max_fraction_anomalies, kernels, series_id, incremental)
+    if isinstance(details, str):
+        return (scored["df"], weights, details)
+    (df_out, threshold_details) = apply_threshold(scored, sensitivity_score, max_fraction_anomalies)
+    return (df_out, weights, { **details, **threshold_details })
+
+def score_single_timeseries(
+    df,
+    sensitivity_score,
+    max_fraction_anomalies,
+    kernels=None,
+    series_id=None,
+    incremental=False
 ):
     # Weights is here as a future-proofing measure.
     weights = { "time_series": 1.0 }
@@ -20,17 +61,25 @@ def detect_single_timeseries(
     
     num_data_points = df['value'].count()
     if (num_data_points < 15):
-        return (df.assign(is_anomaly=False, anomaly_score=0.0), weights, f"Must have a minimum of at least fifteen data points for anomaly detection.  You sent {num_data_points}.")
+        return ({ "df": df.assign(is_anomaly=False, anomaly_score=0.0) }, weights, f"Must have a minimum of at least fifteen data points for anomaly detection.  You sent {num_data_points}.")
     elif (max_fraction_anomalies <= 0.0 or max_fraction_anomalies > 1.0):
-        return (df.assign(is_anomaly=False, anomaly_score=0.0), weights, "Must have a valid max fraction of anomalies, 0 < x <= 1.0.")
+        return ({ "df": df.assign(is_anomaly=False, anomaly_score=0.0) }, weights, "Must have a valid max fraction of anomalies, 0 < x <= 1.0.")
     elif (sensitivity_score <= 0 or sensitivity_score > 100 ):
-        return (df.assign(is_anomaly=False, anomaly_score=0.0), weights, "Must have a valid sensitivity score, 0 < x <= 100.")
+        return ({ "df": df.assign(is_anomaly=False, anomaly_score=0.0) }, weights, "Must have a valid sensitivity score, 0 < x <= 100.")
     else:
-        (df_tested, tests_run, diagnostics) = run_tests(df)
-        (df_out, diag_outliers) = determine_outliers(df_tested, tests_run, diagnostics["num_iterations"], sensitivity_score, max_fraction_anomalies)
-        return (df_out, weights, { "message": "Result of single time series statistical tests.", "Tests run": tests_run, "Test diagnostics": diagnostics, "Outlier determination": diag_outliers})
+        (df_tested, tests_run, diagnostics) = run_tests(df, kernels, series_id, incremental)
+        scored = { "df": df_tested, "tests_run": tests_run, "num_iterations": diagnostics["num_iterations"] }
+        details = { "message": "Result of single time series statistical tests.", "Tests run": tests_run, "Test diagnostics": diagnostics }
+        if diagnostics["Approximate"]:
+            details["Approximate"] = True
+        return (scored, weights, details)
 
-def run_tests(df):
+@timing.timed("Apply threshold")
+def apply_threshold(scored, sensitivity_score, max_fraction_anomalies):
+    (df_out, diag_outliers) = determine_outliers(scored["df"], scored["tests_run"], scored["num_iterations"], sensitivity_score, max_fraction_anomalies)
+    return (df_out, { "Outlier determination": diag_outliers })
+
+def run_tests(df, kernels=None, series_id=None, incremental=False):
     tests_run = {
         "changepoint": 1
     }
@@ -44,24 +93,149 @@ def run_tests(df):
     # Not knowing the shape of the data, we will try each of the three kernels.
     # We will also try a variety of penalty values across 7 orders of magnitude.
     # The combination of results will allow us to develop a sensitivity score.
-    kernels = { "linear", "rbf", "cosine" }
-    penalties = { 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 20, 50, 80, 100, 200, 500, 800, 1000 }
+    # Kernels and penalties are kept in a fixed order so that diagnostics do not depend on set ordering.
+    # Callers may restrict the kernels, e.g. to avoid the memory cost of the rbf kernel's Gram matrix.
+    if kernels is None:
+        kernels = ["cosine", "linear", "rbf"]
+    else:
+        kernels = sorted(kernels)
+    penalties = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 20, 50, 80, 100, 200, 500, 800, 1000]
     diagnostics["kernels"] = kernels
     diagnostics["penalties"] = penalties
     diagnostics["num_iterations"] = len(kernels) * len(penalties)
 
+    # If the caller identifies the series and we have seen it before, we can reuse the changepoints
+    # we already found.  For exactly the same series, that is the same as solving it again.  For a series
+    # with new points appended, a full solve can move earlier changepoints (and the rbf kernel's gamma
+    # changes with the data), so only callers which ask for incremental results get a re-solved tail.
+    # Those results are approximate, and so is anything we later reuse from them.
+    previous = get_cached_changepoints(series_id, signal, kernels)
+    if (previous is not None and previous["approximate"] and not incremental):
+        previous = None
+    approximate = False
+    if (previous is not None and previous["length"] == num_records):
+        fits = previous["fits"]
+        approximate = previous["approximate"]
+        diagnostics["Kernel fitting"] = "Reused cached changepoints"
+    elif (previous is not None and incremental):
+        gamma = get_rbf_gamma(signal) if "rbf" in kernels else None
+        fits = { k: fit_kernel_incremental(signal, k, penalties, previous["fits"][k], previous["length"], gamma) for k in kernels }
+        approximate = True
+        diagnostics["Kernel fitting"] = f"Incremental, {num_records - previous['length']} new data points"
+        diagnostics["Points re-solved"] = { k: int(num_records - min(fits[k]["starts"])) for k in kernels }
+    # Each kernel is independent of the others, so for larger datasets we fit them in parallel.
+    elif (parallel.is_enabled() and num_records >= MIN_PARALLEL_RECORDS):
+        fits = dict(zip(kernels, fit_kernels_parallel(signal, kernels, penalties)))
+        diagnostics["Kernel fitting"] = "Parallel"
+    else:
+        fits = { k: fit_kernel(signal, k, penalties) for k in kernels }
+        diagnostics["Kernel fitting"] = "Serial"
+
+    diagnostics["Approximate"] = approximate
+
+    if series_id is not None:
+        cache_changepoints(series_id, signal, kernels, fits, approximate)
+
+    # Every changepoint found counts as one vote for that data point.
+    # Votes are counts, so the sum is the same regardless of the order in which kernels finish.
     scores = np.zeros([num_records])
-    for idx,k in enumerate(kernels):
-        algo = rpt.KernelCPD(kernel=k).fit(signal)
-        for idxp,p in enumerate(penalties):
-            # Get the set of results and add them to the scores array
-            result = algo.predict(pen=p)
-            for ix,r in enumerate(result[:-1]):
-                scores[r] += 1
+    for k in kernels:
+        for breakpoints in fits[k]["breakpoints"]:
+            scores[breakpoints] += 1
 
     df["anomaly_score"] = scores
     return (df, tests_run, diagnostics)
 
+@timing.timed("KernelCPD")
+def fit_kernel(signal, kernel, penalties, gamma=None):
+    # Fit the kernel once and then sweep across each penalty value.
+    # For the rbf kernel, ruptures picks gamma using a median heuristic unless we supply one.
+    params = { "gamma": gamma } if (kernel == "rbf" and gamma is not None) else None
+    algo = rpt.KernelCPD(kernel=kernel, params=params).fit(signal)
+    # The final result is always the length of the signal, so we skip it.
+    breakpoints = [algo.predict(pen=p)[:-1] for p in penalties]
+    return {
+        "breakpoints": breakpoints,
+        "gamma": algo.cost.gamma if kernel == "rbf" else None,
+        "starts": [0 for p in penalties]
+    }
+
+def fit_kernel_incremental(signal, kernel, penalties, previous_fit, previous_length, gamma=None):
+    # For each penalty, we keep the changepoints well before the end of the previous series
+    # and re-solve only the region after the last of them.  This is an approximation:  a full
+    # re-solve regularly moves or drops earlier changepoints, especially in noisy series, so the
+    # scores can differ from a full solve.  gamma is the rbf kernel's gamma for the whole signal
+    # (see get_rbf_gamma()), so that the tail is solved on the same scale as a full solve would use.
+    stable = [[b for b in bkps if b <= previous_length - STABLE_BREAKPOINT_MARGIN] for bkps in previous_fit["breakpoints"]]
+    starts = [int(bkps[-1]) if len(bkps) > 0 else 0 for bkps in stable]
+
+    # Penalties often agree on the last stable changepoint, so fit each distinct tail once.
+    breakpoints = [None for p in penalties]
+    for start in sorted(set(starts)):
+        idx = [i for i in range(len(penalties)) if starts[i] == start]
+        tail_fit = fit_kernel(signal[start:], kernel, [penalties[i] for i in idx], gamma)
+        for (i, tail_breakpoints) in zip(idx, tail_fit["breakpoints"]):
+            # The tail starts at a changepoint, which the tail fit cannot report on its own.
+            breakpoints[i] = stable[i] + [start + b for b in tail_breakpoints]
+    return {
+        "breakpoints": breakpoints,
+        "gamma": gamma if kernel == "rbf" else None,
+        "starts": starts
+    }
+
+def get_rbf_gamma(signal):
+    # The median heuristic ruptures uses for the rbf kernel when we do not supply gamma.
+    median = np.median(pdist(signal.astype(np.double).reshape(-1, 1), metric="sqeuclidean"))
+    return 1.0 / median if median != 0 else 1.0
+
+def fit_kernel_shared(descriptor, kernel, penalties):
+    # Runs in a worker process.  The signal lives in shared memory, so we only
+    # copy it out once here instead of pickling it for every kernel.
+    (shm, shared_signal) = parallel.attach_array(descriptor)
+    try:
+        signal = shared_signal.copy()
+    finally:
+        del shared_signal
+        shm.close()
+    return fit_kernel(signal, kernel, penalties)
+
+@timing.timed("KernelCPD (parallel)")
+def fit_kernels_parallel(signal, kernels, penalties):
+    (shm, descriptor) = parallel.share_array(signal)
+    try:
+        executor = parallel.get_executor()
+        futures = [executor.submit(fit_kernel_shared, descriptor, k, penalties) for k in kernels]
+        return [f.result() for f in futures]
+    finally:
+        parallel.release_array(shm)
+
+def hash_signal(signal):
+    return hashlib.blake2b(np.ascontiguousarray(signal).tobytes(), digest_size=16).hexdigest()
+
+def get_cached_changepoints(series_id, signal, kernels):
+    # A cache entry is only usable if the new signal starts with exactly the data we saw before.
+    if series_id is None:
+        return None
+    entry = changepoint_cache.get(series_id)
+    if (entry is None
+        or entry["kernels"] != kernels
+        or entry["length"] > signal.shape[0]
+        or entry["hash"] != hash_signal(signal[:entry["length"]])):
+        return None
+    return entry
+
+def cache_changepoints(series_id, signal, kernels, fits, approximate=False):
+    entry = {
+        "length": signal.shape[0],
+        "hash": hash_signal(signal),
+        "kernels": kernels,
+        "fits": fits,
+        "approximate": approximate
+    }
+    # Rough size:  breakpoints are Python ints held in lists.
+    num_breakpoints = sum([len(b) for k in kernels for b in fits[k]["breakpoints"]])
+    changepoint_cache.put(series_id, entry, 1024 + 40 * num_breakpoints)
+
 def determine_outliers(
     df,
     tests_run,
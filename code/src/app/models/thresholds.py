@@ -0,0 +1,61 @@
+# Finding Ghosts in Your Data
+# Score once, threshold many
+# Every detector scores its input first and applies sensitivity_score and max_fraction_anomalies
+# last.  Scoring is the expensive part, so to try several settings on the same data, we score
+# once and then apply each setting to the same scores.
+# Each detector module has, for each detect_ function, a score_ function which takes the same
+# arguments, plus apply_threshold(scored, sensitivity_score, max_fraction_anomalies) and a list
+# of THRESHOLD_COLUMNS, the output columns which depend on the settings (when the output has them).
+
+import importlib
+import pandas as pd
+from .. import timing
+
+def get_module(module_name):
+    return importlib.import_module("." + module_name, package=__package__)
+
+def detect_settings(module_name, function_name, args, kwargs, settings):
+    # settings is a list of (sensitivity_score, max_fraction_anomalies) pairs, and args should use the first of them.
+    (scored, weights, details) = score_input(module_name, function_name, args, kwargs)
+    if isinstance(details, str):
+        return (scored["df"], weights, details)
+    return apply_settings(module_name, scored, weights, details, settings)
+
+def detect_segments(module_name, function_name, args, kwargs, include_keys=False):
+    # output_mode = "segments":  summarize the results where we detect them, so that only the segment rows
+    # (rather than one row per data point) go back to the API process.
+    (df, weights, details) = getattr(get_module(module_name), function_name)(*args, **kwargs)
+    return (shape_output(module_name, df, "segments", include_keys), weights, details)
+
+def shape_output(module_name, df, output_mode, include_keys=False):
+    if output_mode != "segments":
+        return df
+    return get_module(module_name).summarize_segments(df, include_keys)
+
+def score_input(module_name, function_name, args, kwargs):
+    # Returns the scores without applying any settings, for callers which keep them (see scores.py).
+    score = getattr(get_module(module_name), function_name.replace("detect_", "score_", 1))
+    return score(*args, **kwargs)
+
+@timing.timed("Apply settings")
+def apply_settings(module_name, scored, weights, details, settings, output_mode="points", include_keys=False):
+    # apply_threshold leaves scored as it was, so we can apply settings to the same scores any number of times.
+    # output_mode = "segments", which takes a single setting, gives one row per series segment.
+    module = get_module(module_name)
+    if len(settings) == 1:
+        (df, threshold_details) = module.apply_threshold(scored, *settings[0])
+        return (shape_output(module_name, df, output_mode, include_keys), weights, { **details, **threshold_details })
+
+    # The output has one copy of each threshold column per setting, suffixed with the setting's
+    # position in settings:  is_anomaly_0, is_anomaly_1, and so on.
+    outputs = [module.apply_threshold(scored, s, m) for (s, m) in settings]
+    columns = [c for c in module.THRESHOLD_COLUMNS if c in outputs[0][0].columns]
+    df = pd.concat([outputs[0][0].drop(columns=columns)] +
+        [df_setting[columns].add_suffix(f"_{i}") for (i, (df_setting, threshold_details)) in enumerate(outputs)], axis=1)
+    details = { **details, "Settings": [{
+        "Sensitivity score": s,
+        "Max fraction anomalies": m,
+        "Number of anomalies": int(df_setting["is_anomaly"].sum()),
+        **threshold_details
+    } for ((s, m), (df_setting, threshold_details)) in zip(settings, outputs)] }
+    return (df, weights, details)
@@ -12,11 +12,29 @@ import scikit_posthocs as ph
 import math
 # Chapter 9
 from sklearn.mixture import GaussianMixture
+from .. import timing
+
+# Sensitivity-dependent columns of the output.  See thresholds.py.
+THRESHOLD_COLUMNS = ["is_anomaly"]
 
 def detect_univariate_statistical(
     df,
     sensitivity_score,
-    max_fraction_anomalies
+    max_fraction_anomalies,
+    disabled_tests=()
+):
+    # Scoring does not depend on the sensitivity settings, so we score first and apply the settings after.
+    (scored, weights, details) = score_univariate_statistical(df, sensitivity_score, max_fraction_anomalies, disabled_tests)
+    if isinstance(details, str):
+        return (scored["df"], weights, details)
+    (df_out, threshold_details) = apply_threshold(scored, sensitivity_score, max_fraction_anomalies)
+    return (df_out, weights, { **details, **threshold_details })
+
+def score_univariate_statistical(
+    df,
+    sensitivity_score,
+    max_fraction_anomalies,
+    disabled_tests=()
 ):
     # Standard deviation is not a very robust measure, so we weigh this lowest.
     # IQR is a reasonably good measure, so we give it the second-highest weight.
@@ -30,18 +48,22 @@ def detect_univariate_statistical(
                "gaussian_mixture": 1.5}
 
     if (df['value'].count() < 3):
-        return (df.assign(is_anomaly=False, anomaly_score=0.0), weights, "Must have a minimum of at least three data points for anomaly detection.")
+        return ({ "df": df.assign(is_anomaly=False, anomaly_score=0.0) }, weights, "Must have a minimum of at least three data points for anomaly detection.")
     elif (max_fraction_anomalies <= 0.0 or max_fraction_anomalies > 1.0):
-        return (df.assign(is_anomaly=False, anomaly_score=0.0), weights, "Must have a valid max fraction of anomalies, 0 < x <= 1.0.")
+        return ({ "df": df.assign(is_anomaly=False, anomaly_score=0.0) }, weights, "Must have a valid max fraction of anomalies, 0 < x <= 1.0.")
     elif (sensitivity_score <= 0 or sensitivity_score > 100 ):
-        return (df.assign(is_anomaly=False, anomaly_score=0.0), weights, "Must have a valid sensitivity score, 0 < x <= 100.")
+        return ({ "df": df.assign(is_anomaly=False, anomaly_score=0.0) }, weights, "Must have a valid sensitivity score, 0 < x <= 100.")
     else:
-        (df_tested, tests_run, diagnostics) = run_tests(df)
+        (df_tested, tests_run, diagnostics) = run_tests(df, disabled_tests)
         df_scored = score_results(df_tested, tests_run, weights)
-        df_out = determine_outliers(df_scored, sensitivity_score, max_fraction_anomalies)
-        return (df_out, weights, { "message": "Ensemble of univariate statistical tests.", "Test diagnostics": diagnostics})
+        return ({ "df": df_scored }, weights, { "message": "Ensemble of univariate statistical tests.", "Test diagnostics": diagnostics})
+
+@timing.timed("Apply threshold")
+def apply_threshold(scored, sensitivity_score, max_fraction_anomalies):
+    # Returns the output frame and any details from determining outliers, of which there are none here.
+    return (determine_outliers(scored["df"], sensitivity_score, max_fraction_anomalies), {})
 
-def run_tests(df):
+def run_tests(df, disabled_tests=()):
     # Get our baseline calculations, prior to any data transformations.
     base_calculations = perform_statistical_calculations(df['value'])
 
@@ -53,9 +75,10 @@ def run_tests(df):
     # for each test, execute and add a new score
     # Initial tests should NOT use the fitted calculations.
     b = base_calculations
-    df['sds'] = [check_sd(val, b["mean"], b["sd"], 3.0) for val in df['value']]
-    df['mads'] = [check_mad(val, b["median"], b["mad"], 3.0) for val in df['value']]
-    df['iqrs'] = [check_iqr(val, b["median"], b["p25"], b["p75"], b["iqr"], 1.5) for val in df['value']]
+    with timing.stage("SD, MAD, and IQR checks"):
+        df['sds'] = [check_sd(val, b["mean"], b["sd"], 3.0) for val in df['value']]
+        df['mads'] = [check_mad(val, b["median"], b["mad"], 3.0) for val in df['value']]
+        df['iqrs'] = [check_iqr(val, b["median"], b["p25"], b["p75"], b["iqr"], 1.5) for val in df['value']]
     tests_run = {
         "sds": 1,
         "mads": 1,
@@ -94,7 +117,9 @@ def run_tests(df):
         else:
             diagnostics["Dixon's Q Test"] = f"Did not run Dixon's Q test because we need between 3 and 25 observations but had {b['len']}."
 
-        if (b['len'] >= 15):
+        if (b['len'] >= 15 and "gesd" in disabled_tests):
+            diagnostics["GESD"] = "Did not run GESD because it was disabled for this request."
+        elif (b['len'] >= 15):
             # Ensure we have at least 1 outlier allowed and there are still enough
             # degrees of freedom to analyze the data.
             max_num_outliers = math.floor(b['len'] / 3)
@@ -153,6 +178,7 @@ def perform_normalization(base_calculations, df):
 
     return (use_fitted_results, fitted_data, diagnostics)
 
+@timing.timed("Basic statistics")
 def perform_statistical_calculations(col):
     mean = col.mean()
     sd = col.std()
@@ -218,6 +244,7 @@ def check_iqr(val, median, p25, p75, iqr, min_iqr_diff):
         else:
             return 1.0
 
+@timing.timed("Normality tests")
 def is_normally_distributed(col):
     alpha = 0.05
 
@@ -275,6 +302,7 @@ def check_anderson(col):
 
     return ( anderson_normal, return_str )
 
+@timing.timed("Box-Cox")
 def normalize(col):
     # Perform Box-Cox transformation.  We don't know the right lambda
     # to choose, so let the algorithm figure this out.
@@ -288,10 +316,12 @@ def normalize(col):
     fitted_data = boxcox(col, fitted_lambda)
     return (fitted_data, fitted_lambda)
 
+@timing.timed("Grubbs' test")
 def check_grubbs(col):
     out = ph.outliers_grubbs(col)
     return find_differences(col, out)
 
+@timing.timed("GESD")
 def check_gesd(col, max_num_outliers):
     out = ph.outliers_gesd(col, max_num_outliers)
     return find_differences(col, out)
@@ -312,6 +342,7 @@ def find_differences(col, out):
 
     return res
 
+@timing.timed("Dixon's Q test")
 def check_dixon(col):
     q95 = [0.97, 0.829, 0.71, 0.625, 0.568, 0.526, 0.493, 0.466,
         0.444, 0.426, 0.41, 0.396, 0.384, 0.374, 0.365, 0.356,
@@ -353,6 +384,7 @@ def check_dixon(col):
 
     return res
 
+@timing.timed("Gaussian mixture cluster count")
 def get_number_of_gaussian_mixture_clusters(col):
     X = np.array(col).reshape(-1,1)
     bic_vals = []
@@ -364,6 +396,7 @@ def get_number_of_gaussian_mixture_clusters(col):
         bic_vals.append(gm.bic(X))
     return np.argmin(bic_vals) + 1
 
+@timing.timed("Gaussian mixture test")
 def check_gaussian_mixture(col, best_fit_cluster_count):
     # Because this is univariate, we need to reshape the array using -1,1 as our parameters.
     # That will create a list per data point.
@@ -394,6 +427,7 @@ def check_gaussian_mixture(col, best_fit_cluster_count):
             xdf.loc[xdf['value']==xdf_g.iloc[r,0], "far_off"]=xdf_g.iloc[r,4]
     return [max(sc, fo) for (sc, fo) in zip(xdf["small_cluster"], xdf["far_off"])]
 
+@timing.timed("Scoring")
 def score_results(df, tests_run, weights):
     # Chapter 7:  add in normal distribution checks
     # Add in observation length tests (n <= 25 for Dixon, n >= 7 for Grubbs, n >= 15 for GESD)
@@ -0,0 +1,195 @@
+# Finding Ghosts in Your Data
+# Profiles of slow and sampled requests
+# Some requests take far longer than others of the same size, and they are hard to reproduce.
+# We cannot know ahead of time which requests will be slow, so while a threshold is set, a
+# sampling profiler runs during every detector call:  a thread which records the detector's
+# call stack every few milliseconds, which costs little next to the detector itself.  If the
+# request turns out to be slow, we keep the stacks; otherwise we throw them away.  Separately,
+# a fraction of requests may run under cProfile, which records every call at a much higher cost.
+# Profiles go to a local directory along with the request's parameters, input size, and stage
+# timings (see timing.py), and we delete the oldest once there are too many.
+
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import random
+import datetime
+import marshal
+import cProfile
+import tempfile
+import threading
+import contextlib
+import contextvars
+
+# Keep a sampling profile of requests which take at least this long.  0 turns this off.
+slow_seconds = float(os.environ.get("ANOMALY_PROFILE_SLOW_SECONDS", 0))
+# Fraction of requests to profile with cProfile, whether or not they are slow.  0 turns this off.
+sample_rate = float(os.environ.get("ANOMALY_PROFILE_SAMPLE_RATE", 0))
+# How often the sampling profiler records the call stack.
+interval_seconds = float(os.environ.get("ANOMALY_PROFILE_INTERVAL_SECONDS", 0.01))
+profile_path = os.environ.get("ANOMALY_PROFILE_DIR", os.path.join(tempfile.gettempdir(), "anomaly_profiles"))
+# Number of profiles to keep.  Past this, we delete the oldest.
+max_profiles = int(os.environ.get("ANOMALY_PROFILE_MAX_FILES", 100))
+# The admin endpoints which list and download profiles require this in the X-Admin-Token header.
+# Profiles include request parameters and input sizes, so without a token, those endpoints are turned off.
+admin_token = os.environ.get("ANOMALY_ADMIN_TOKEN", "")
+
+enabled = slow_seconds > 0 or sample_rate > 0
+
+# Profile files by profiler:  cProfile's output opens with pstats or snakeviz, and sampled stacks
+# are in the folded format which flamegraph.pl and speedscope read, one stack and its count per line.
+FILE_EXTENSIONS = { "cprofile": ".prof", "sampling": ".folded" }
+PROFILE_ID_PATTERN = re.compile(r"^[0-9]{8}T[0-9]{6}-[0-9a-f]{12}$")
+
+_request = contextvars.ContextVar("profile_request", default=None)
+_lock = threading.Lock()
+
+@contextlib.contextmanager
+def track_request():
+    # Decide up front how to profile this request.  Requests run at most one detector call, which
+    # leaves its profile in request["profile"].
+    if sample_rate > 0 and random.random() < sample_rate:
+        request = { "profiler": "cprofile", "reason": "sampled", "profile": None }
+    elif slow_seconds > 0:
+        request = { "profiler": "sampling", "reason": "slow", "profile": None }
+    else:
+        request = { "profiler": None, "reason": None, "profile": None }
+    token = _request.set(request)
+    try:
+        yield request
+    finally:
+        _request.reset(token)
+
+def current_profiler():
+    request = _request.get()
+    return request["profiler"] if request is not None else None
+
+def add_profile(profile):
+    request = _request.get()
+    if request is not None and profile:
+        request["profile"] = profile
+
+def should_keep(request, seconds):
+    return (request["reason"] == "sampled" and request["profile"] is not None) or (request["reason"] == "slow" and seconds >= slow_seconds)
+
+@contextlib.contextmanager
+def profile(profiler):
+    # Runs where the detector runs, usually a worker process.  profile ends up holding
+    # the profiler used and its data, or stays empty if profiler is None.
+    profile = {}
+    if profiler == "cprofile":
+        profiler_object = cProfile.Profile()
+        try:
+            profiler_object.enable()
+        except ValueError:
+            # Another profiler is already running in this process, so sample instead.
+            profiler = "sampling"
+        else:
+            try:
+                yield profile
+            finally:
+                profiler_object.disable()
+                profiler_object.create_stats()
+                profile.update({ "profiler": "cprofile", "data": marshal.dumps(profiler_object.stats) })
+            return
+    if profiler == "sampling":
+        stop = threading.Event()
+        stacks = {}
+        sampler = threading.Thread(target=sample_stacks, args=(threading.get_ident(), stop, stacks), daemon=True)
+        sampler.start()
+        try:
+            yield profile
+        finally:
+            stop.set()
+            sampler.join()
+            profile.update({ "profiler": "sampling", "data": stacks, "interval_seconds": interval_seconds })
+        return
+    yield profile
+
+def sample_stacks(thread_id, stop, stacks):
+    # Count how often we find the profiled thread in each call stack, outermost call first.
+    while not stop.wait(interval_seconds):
+        frame = sys._current_frames().get(thread_id)
+        calls = []
+        while frame is not None:
+            code = frame.f_code
+            calls.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        if len(calls) > 0:
+            stack = ";".join(reversed(calls))
+            stacks[stack] = stacks.get(stack, 0) + 1
+
+def write_profile(request, metadata):
+    # metadata describes the request:  endpoint, parameters, input size, status, time taken, and stage timings.
+    os.makedirs(profile_path, exist_ok=True)
+    profile_id = f"{time.strftime('%Y%m%dT%H%M%S', time.gmtime())}-{uuid.uuid4().hex[:12]}"
+    profile = request["profile"] or {}
+    file_name = None
+    if "data" in profile:
+        file_name = profile_id + FILE_EXTENSIONS[profile["profiler"]]
+        if profile["profiler"] == "cprofile":
+            content = profile["data"]
+        else:
+            content = "".join([f"{stack} {count}\n" for (stack, count) in profile["data"].items()]).encode("utf-8")
+        write_file(os.path.join(profile_path, file_name), content)
+    metadata = {
+        "profile_id": profile_id,
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "reason": request["reason"],
+        "profiler": profile.get("profiler"),
+        "profile_file": file_name,
+        "sampling_interval_seconds": profile.get("interval_seconds"),
+        **metadata
+    }
+    write_file(os.path.join(profile_path, profile_id + ".json"), json.dumps(metadata).encode("utf-8"))
+    remove_old_profiles()
+    return profile_id
+
+def write_file(file_name, content):
+    # Write to a temporary file and rename it, so that readers never see a partial profile.
+    temp_file_name = f"{file_name}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_file_name, "wb") as f:
+        f.write(content)
+    os.replace(temp_file_name, file_name)
+
+def list_profiles():
+    # Metadata for every profile we have, newest first.
+    profiles = []
+    try:
+        file_names = os.listdir(profile_path)
+    except OSError:
+        return []
+    for file_name in file_names:
+        if file_name.endswith(".json") and PROFILE_ID_PATTERN.match(file_name[:-5]):
+            metadata = get_profile(file_name[:-5])
+            if metadata is not None:
+                profiles.append(metadata)
+    return sorted(profiles, key=lambda p: p["created"], reverse=True)
+
+def get_profile(profile_id):
+    if not PROFILE_ID_PATTERN.match(profile_id):
+        return None
+    try:
+        with open(os.path.join(profile_path, profile_id + ".json"), "rb") as f:
+            return json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+def get_profile_file(profile_id):
+    # Returns the path of a profile's file, or None if there is no such profile or it has no profile data.
+    metadata = get_profile(profile_id)
+    if metadata is None or metadata["profile_file"] is None:
+        return None
+    return os.path.join(profile_path, metadata["profile_file"])
+
+def remove_old_profiles():
+    with _lock:
+        profiles = list_profiles()
+        for metadata in profiles[max_profiles:]:
+            for file_name in [metadata["profile_file"], metadata["profile_id"] + ".json"]:
+                if file_name is not None:
+                    with contextlib.suppress(OSError):
+                        os.remove(os.path.join(profile_path, file_name))
@@ -0,0 +1,195 @@
+# Finding Ghosts in Your Data
+# Cache of detection responses, keyed by a hash of the request
+# Detection is deterministic:  the same input, detector, settings, and output options always
+# produce the same response.  Clients such as dashboards re-send identical requests often,
+# so we keep encoded responses in memory (and optionally on disk) and send them back as-is.
+# The exception is a call with a series_id or group_id, which we never cache (see is_cacheable() in main.py).
+# The request hash doubles as the response's ETag.
+# That hash covers the prepared call, so that the same data gets the same response whether it came
+# in as records or as columns, but preparing the call means parsing the whole request first.  We also
+# remember which response each raw request (path, query string, and body) got, so that a byte-for-byte
+# repeat can skip straight to the cached response.
+# Responses on disk outlive the code which produced them, so every request hash also covers a cache
+# version:  RESULT_CACHE_VERSION and a hash of the service's own source.  After a deploy which changes
+# the detectors or the response format, old responses (and their ETags) no longer match any request.
+
+import os
+import hashlib
+import threading
+import contextlib
+import contextvars
+import pandas as pd
+from .caching import SizedLRUCache
+from .serialization import encode_value
+
+memory_cache = SizedLRUCache(
+    int(os.environ.get("ANOMALY_RESULT_CACHE_ENTRIES", 1024)),
+    float(os.environ.get("ANOMALY_RESULT_CACHE_MB", 256)) * 1024 * 1024
+)
+# Set ANOMALY_RESULT_CACHE_DIR to also keep responses on disk, where they survive restarts
+# and can outgrow the memory cache.  We delete the least recently used files past the disk budget.
+disk_path = os.environ.get("ANOMALY_RESULT_CACHE_DIR", "")
+disk_max_bytes = float(os.environ.get("ANOMALY_RESULT_CACHE_DISK_MB", 4096)) * 1024 * 1024
+
+# Raise this when responses change for a reason the source hash does not see, such as a new version of a model library.
+RESULT_CACHE_VERSION = 1
+
+# Raw request hash -> (request hash, whether the response holds a score_id).
+raw_keys = SizedLRUCache(memory_cache.max_entries, memory_cache.max_entries * 256)
+_raw_key = contextvars.ContextVar("raw_key", default=None)
+
+disk_hits = 0
+disk_bytes = None
+_disk_lock = threading.Lock()
+
+def hash_value(h, value):
+    # Data frames are hashed a column at a time, so that the same data gives the same hash
+    # whether it came in as records or as columns.
+    if isinstance(value, pd.DataFrame):
+        for c in value.columns:
+            h.update(f"{c}:{value[c].dtype}:".encode("utf-8"))
+            try:
+                h.update(pd.util.hash_pandas_object(value[c], index=False).to_numpy().tobytes())
+            except TypeError:
+                # Columns of lists, such as vals for multivariate detection.
+                h.update(encode_value(value[c].tolist()).encode("utf-8"))
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            hash_value(h, v)
+    else:
+        h.update(encode_value(value).encode("utf-8"))
+    h.update(b"|")
+
+def get_code_version():
+    # A hash of every module in the app package and its models.
+    h = hashlib.blake2b(digest_size=16)
+    app_path = os.path.dirname(os.path.abspath(__file__))
+    for directory in (app_path, os.path.join(app_path, "models")):
+        for file_name in sorted(os.listdir(directory)):
+            if file_name.endswith(".py"):
+                with open(os.path.join(directory, file_name), "rb") as f:
+                    h.update(file_name.encode("utf-8"))
+                    h.update(f.read())
+    return h.hexdigest()
+
+cache_version = f"{RESULT_CACHE_VERSION}:{get_code_version()}"
+
+def hash_request(call, options):
+    # options holds the output options, such as debug and orient, which change the response but not the call.
+    h = hashlib.blake2b(digest_size=16)
+    hash_value(h, cache_version)
+    hash_value(h, [call["method"], call["function"]])
+    for arg in call["args"]:
+        hash_value(h, arg)
+    hash_value(h, call["kwargs"])
+    hash_value(h, [call["output_mode"], call["include_keys"], options])
+    return h.hexdigest()
+
+def hash_raw_request(path, query_string, content_type, body):
+    h = hashlib.blake2b(digest_size=16)
+    for part in (path.encode("utf-8"), query_string, content_type.encode("latin-1"), body):
+        h.update(len(part).to_bytes(8, "little"))
+        h.update(part)
+    return h.hexdigest()
+
+@contextlib.contextmanager
+def track_raw_request(raw_key):
+    # Requests handled within this block remember their request hash under raw_key (see remember_raw_key).
+    token = _raw_key.set(raw_key)
+    try:
+        yield
+    finally:
+        _raw_key.reset(token)
+
+def remember_raw_key(key, keep_scores=False):
+    raw_key = _raw_key.get()
+    if raw_key is not None:
+        raw_keys.put(raw_key, (key, keep_scores), len(raw_key) + len(key))
+
+def get_raw(raw_key):
+    # Returns the request hash and its cached response, if we have one.
+    (key, keep_scores) = raw_keys.get(raw_key, (None, False))
+    if key is None:
+        return (None, None, False)
+    return (key, get(key), keep_scores)
+
+def get_disk_file(key):
+    return os.path.join(disk_path, key[:2], key)
+
+def get(key):
+    global disk_hits
+    body = memory_cache.get(key)
+    if body is not None or disk_path == "":
+        return body
+    try:
+        with open(get_disk_file(key), "rb") as f:
+            body = f.read()
+    except OSError:
+        return None
+    # Mark the file as recently used and bring it back into memory.
+    os.utime(get_disk_file(key))
+    with _disk_lock:
+        disk_hits += 1
+    memory_cache.put(key, body, len(body))
+    return body
+
+def put(key, body):
+    memory_cache.put(key, body, len(body))
+    if disk_path != "" and len(body) <= disk_max_bytes:
+        write_disk_file(key, body)
+
+def write_disk_file(key, body):
+    global disk_bytes
+    file_name = get_disk_file(key)
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    # Write to a temporary file and rename it, so that readers never see a partial response.
+    temp_file_name = f"{file_name}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_file_name, "wb") as f:
+        f.write(body)
+    with _disk_lock:
+        # A response we already had on disk replaces the old file rather than adding to it.
+        try:
+            old_size = os.stat(file_name).st_size
+        except OSError:
+            old_size = 0
+        os.replace(temp_file_name, file_name)
+        if disk_bytes is None:
+            disk_bytes = sum([size for (path, size, mtime) in list_disk_files()])
+        else:
+            disk_bytes += len(body) - old_size
+        if disk_bytes > disk_max_bytes:
+            trim_disk()
+
+def list_disk_files():
+    files = []
+    for (directory, subdirectories, file_names) in os.walk(disk_path):
+        for file_name in file_names:
+            if not file_name.endswith(".tmp"):
+                path = os.path.join(directory, file_name)
+                stat = os.stat(path)
+                files.append((path, stat.st_size, stat.st_mtime))
+    return files
+
+def trim_disk():
+    # Delete the least recently used files until we are back under 90% of the budget, so that
+    # we do not have to walk the cache directory on every write.  Callers hold _disk_lock.
+    global disk_bytes
+    files = sorted(list_disk_files(), key=lambda f: f[2])
+    disk_bytes = sum([size for (path, size, mtime) in files])
+    for (path, size, mtime) in files:
+        if disk_bytes <= disk_max_bytes * 0.9:
+            break
+        try:
+            os.remove(path)
+            disk_bytes -= size
+        except OSError:
+            pass
+
+def stats():
+    return {
+        "Memory": memory_cache.stats(),
+        "Raw requests": raw_keys.stats(),
+        "Disk enabled": disk_path != "",
+        "Disk hits": disk_hits,
+        "Disk bytes": disk_bytes
+    }
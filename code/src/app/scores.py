@@ -0,0 +1,50 @@
+# Finding Ghosts in Your Data
+# Score handles
+# A detection run can keep its scores, and the statistics it needs to apply sensitivity settings,
+# under a score_id.  Applying new settings to kept scores takes milliseconds instead of a full
+# detection run, which is what an interactive sensitivity slider needs.  We keep scores in the
+# API process, bounded by entries and memory, and drop them once they go unused for a while.
+
+import os
+import time
+import uuid
+import numpy as np
+import pandas as pd
+from .caching import SizedLRUCache
+
+score_cache = SizedLRUCache(
+    int(os.environ.get("ANOMALY_SCORE_CACHE_ENTRIES", 256)),
+    float(os.environ.get("ANOMALY_SCORE_CACHE_MB", 512)) * 1024 * 1024
+)
+# Scores expire this long after they were last used.
+score_ttl_seconds = float(os.environ.get("ANOMALY_SCORE_TTL_SECONDS", 15 * 60))
+
+def estimate_size(value):
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    elif isinstance(value, np.ndarray):
+        return value.nbytes
+    elif isinstance(value, dict):
+        return sum([estimate_size(v) for v in value.values()])
+    elif isinstance(value, (list, tuple)):
+        return sum([estimate_size(v) for v in value])
+    else:
+        return 64
+
+def put(entry, score_id=None):
+    # entry holds the scores along with what we need to shape a response from them.  Callers which
+    # can name the scores by their content pass in a score_id, so that the same input keeps the same one.
+    if score_id is None:
+        score_id = uuid.uuid4().hex
+    score_cache.put(score_id, [time.time() + score_ttl_seconds, entry], estimate_size(entry["scored"]))
+    return score_id
+
+def get(score_id):
+    item = score_cache.get(score_id)
+    if item is None:
+        return None
+    if item[0] < time.time():
+        score_cache.pop(score_id)
+        return None
+    item[0] = time.time() + score_ttl_seconds
+    return item[1]
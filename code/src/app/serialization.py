@@ -0,0 +1,81 @@
+# Finding Ghosts in Your Data
+# JSON responses for detection results
+# Result DataFrames are encoded to JSON text exactly once, by pandas, and spliced into
+# the response.  Everything else (weights, diagnostics) goes through orjson if it is
+# installed and the standard library json module if not.
+
+import json
+import datetime
+import numpy as np
+import pandas as pd
+from fastapi.responses import Response, StreamingResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+ORIENTS = ["records", "columns"]
+
+# Clients which send one of these in the Accept header get newline-delimited JSON instead.
+NDJSON_MEDIA_TYPES = ["application/x-ndjson", "application/ndjson"]
+# Rows to encode at a time when streaming NDJSON.
+NDJSON_CHUNK_ROWS = 10000
+
+def encode_default(o):
+    # Types which neither encoder handles on its own.
+    if isinstance(o, np.generic):
+        return o.item()
+    elif isinstance(o, np.ndarray):
+        return o.tolist()
+    elif isinstance(o, (datetime.datetime, datetime.date)):
+        return o.isoformat()
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable.")
+
+def encode_value(value):
+    if orjson is not None:
+        return orjson.dumps(value, default=encode_default, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS).decode("utf-8")
+    return json.dumps(value, default=encode_default, separators=(",", ":"))
+
+def encode_frame(df, orient="records"):
+    # records:  one object per row, e.g. [{ "key": "a", "value": 1.0 }, ...]
+    # columns:  one array per column, e.g. { "key": ["a", ...], "value": [1.0, ...] },
+    # which matches the columnar request format and is much smaller for long results.
+    if orient == "records":
+        return df.to_json(orient="records", date_format="iso")
+    elif orient == "columns":
+        return "{" + ",".join([encode_value(str(c)) + ":" + df[c].to_json(orient="values", date_format="iso") for c in df.columns]) + "}"
+    else:
+        raise ValueError(f"Unknown orient {orient}.  Valid orients are {', '.join(ORIENTS)}.")
+
+def encode(value, orient="records"):
+    # Walk through dictionaries so that we can find result frames at any level, such as
+    # per-series results in a batch.  Anything else is encoded in a single call.
+    if isinstance(value, pd.DataFrame):
+        return encode_frame(value, orient)
+    elif isinstance(value, dict):
+        return "{" + ",".join([encode_value(str(k)) + ":" + encode(v, orient) for (k, v) in value.items()]) + "}"
+    else:
+        return encode_value(value)
+
+def json_response(results, orient="records"):
+    return Response(content=encode(results, orient).encode("utf-8"), media_type="application/json")
+
+# Newline-delimited JSON:  one line per result row, then one trailing line with everything
+# else (weights, diagnostics), if there is anything else.  We encode and send a chunk of rows
+# at a time, so the client can start reading right away and we never hold the whole response.
+def wants_ndjson(accept):
+    return accept is not None and any([t in accept for t in NDJSON_MEDIA_TYPES])
+
+def ndjson_lines(results):
+    for df in [v for v in results.values() if isinstance(v, pd.DataFrame)]:
+        for i in range(0, df.shape[0], NDJSON_CHUNK_ROWS):
+            lines = df.iloc[i:i + NDJSON_CHUNK_ROWS].to_json(orient="records", lines=True, date_format="iso")
+            yield (lines if lines.endswith("\n") else lines + "\n").encode("utf-8")
+    rest = { k: v for (k, v) in results.items() if not isinstance(v, pd.DataFrame) }
+    if len(rest) > 0:
+        yield (encode(rest) + "\n").encode("utf-8")
+
+def ndjson_response(results):
+    # Starlette runs a plain generator in its threadpool, so encoding stays off the event loop.
+    return StreamingResponse(ndjson_lines(results), media_type=NDJSON_MEDIA_TYPES[0])
@@ -0,0 +1,85 @@
+# Finding Ghosts in Your Data
+# Arrow and Parquet uploads
+# Batch clients often have their data in Arrow or Parquet already.  Rather than convert it
+# to JSON for us to parse back, they can send the table as-is and get results back in the
+# same format.  Columns go straight into pandas, without a copy where the types allow it.
+# pyarrow is optional:  we only import it when an upload comes in.
+
+import io
+import pandas as pd
+from .serialization import encode_value
+
+# Content types we accept, and the format each one stands for.
+FORMATS = {
+    "application/vnd.apache.arrow.stream": "arrow_stream",
+    "application/vnd.apache.arrow.file": "arrow_file",
+    "application/vnd.apache.parquet": "parquet",
+    "application/x-parquet": "parquet"
+}
+# Content type for results in each format.
+MEDIA_TYPES = {
+    "arrow_stream": "application/vnd.apache.arrow.stream",
+    "arrow_file": "application/vnd.apache.arrow.file",
+    "parquet": "application/vnd.apache.parquet"
+}
+
+def load_pyarrow():
+    # Raises ImportError if pyarrow is not installed.
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+    return pyarrow
+
+def read_table(body, format):
+    pa = load_pyarrow()
+    if format == "arrow_stream":
+        return pa.ipc.open_stream(pa.py_buffer(body)).read_all()
+    elif format == "arrow_file":
+        return pa.ipc.open_file(pa.py_buffer(body)).read_all()
+    elif format == "parquet":
+        return pa.parquet.read_table(pa.BufferReader(body))
+    else:
+        raise ValueError(f"Unknown format {format}.")
+
+def read_frame(body, format, columns):
+    # Read the columns a detector needs and give them the types it expects:  string keys,
+    # float values, timestamps for dt, and lists of floats for vals.  Other columns are ignored.
+    pa = load_pyarrow()
+    table = read_table(body, format)
+    missing = [c for c in columns if c not in table.column_names]
+    if len(missing) > 0:
+        raise ValueError(f"The table is missing required columns:  {', '.join(missing)}.")
+    table = table.select(columns)
+    types = { "key": pa.string(), "series_key": pa.string(), "value": pa.float64(), "vals": pa.list_(pa.float64()) }
+    for (i, c) in enumerate(columns):
+        column = table.column(i)
+        if column.null_count > 0:
+            raise ValueError(f"Column {c} has missing values.")
+        if c in ("key", "series_key") and (pa.types.is_string(column.type) or pa.types.is_large_string(column.type)):
+            continue
+        if c in types and column.type != types[c]:
+            table = table.set_column(i, c, column.cast(types[c]))
+    # self_destruct releases each Arrow column as soon as pandas has it, so we do not hold two copies.
+    df = table.to_pandas(split_blocks=True, self_destruct=True)
+    if "dt" in columns and not pd.api.types.is_datetime64_any_dtype(df["dt"]):
+        df["dt"] = pd.to_datetime(df["dt"])
+    return df
+
+def write_frame(df, format, metadata=None):
+    # metadata holds weights and diagnostics, which go into the schema metadata as JSON text.
+    pa = load_pyarrow()
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if metadata:
+        table = table.replace_schema_metadata({ **(table.schema.metadata or {}), **{ k: encode_value(v) for (k, v) in metadata.items() } })
+    sink = pa.BufferOutputStream()
+    if format == "arrow_stream":
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+    elif format == "arrow_file":
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    elif format == "parquet":
+        pa.parquet.write_table(table, sink)
+    else:
+        raise ValueError(f"Unknown format {format}.")
+    return sink.getvalue().to_pybytes()
@@ -0,0 +1,98 @@
+# Finding Ghosts in Your Data
+# Per-stage timings
+# When a request is slow, we want to know where the time went:  parsing the request, building
+# the DataFrame, each test in the detector, applying settings, or encoding the response.
+# Stages record wall time and a call count into the current request's timings, which live in
+# a context variable.  Outside of a request which asked for timings (debug = true), there is
+# nothing to record into and each stage costs one context variable lookup.
+
+import re
+import time
+import functools
+import contextlib
+import contextvars
+
+_timings = contextvars.ContextVar("timings", default=None)
+_request_start = contextvars.ContextVar("request_start", default=None)
+
+def enabled():
+    return _timings.get() is not None
+
+@contextlib.contextmanager
+def collect(request_start=None):
+    # Record timings for everything run within this block (and in threads and tasks started from it).
+    # timings maps each stage name to [seconds, calls].
+    timings = {}
+    token = _timings.set(timings)
+    start_token = _request_start.set(request_start)
+    try:
+        yield timings
+    finally:
+        _request_start.reset(start_token)
+        _timings.reset(token)
+
+def current():
+    # The timings being collected, or None.
+    return _timings.get()
+
+def add(name, seconds, calls=1):
+    timings = _timings.get()
+    if timings is None:
+        return
+    if name in timings:
+        timings[name][0] += seconds
+        timings[name][1] += calls
+    else:
+        timings[name] = [seconds, calls]
+
+def merge(other):
+    # Adds timings recorded elsewhere, such as in a worker process.
+    for (name, (seconds, calls)) in other.items():
+        add(name, seconds, calls)
+
+def since_request_start(name):
+    # Records the time from when the request came in until now, once per request.  We use this for
+    # the time FastAPI and pydantic spend reading and validating the body before the endpoint runs.
+    timings = _timings.get()
+    request_start = _request_start.get()
+    if timings is not None and request_start is not None and name not in timings:
+        add(name, time.perf_counter() - request_start)
+
+@contextlib.contextmanager
+def stage(name):
+    if _timings.get() is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(name, time.perf_counter() - start)
+
+def timed(name):
+    # Decorator form of stage(), for functions which make up a whole stage.
+    def decorate(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if _timings.get() is None:
+                return f(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                add(name, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+def report(timings):
+    # Timings in the form we return with debug details.
+    return { name: { "Seconds": round(seconds, 6), "Calls": calls } for (name, (seconds, calls)) in timings.items() }
+
+def server_timing(timings):
+    # The same timings as a Server-Timing header, which browser developer tools display.
+    # Metric names are tokens, so "Box-Cox" becomes box-cox and "Normality tests" becomes normality-tests.
+    metrics = []
+    for (name, (seconds, calls)) in timings.items():
+        token = re.sub(r"[^a-z0-9]+", "-", name.lower()).strip("-")
+        metrics.append(f'{token};dur={seconds * 1000:.3f};desc="{name} ({calls})"')
+    return ", ".join(metrics)
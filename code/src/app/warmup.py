@@ -0,0 +1,53 @@
+# Finding Ghosts in Your Data
+# Detector loading and warmup
+# Each detector module pulls in its own set of libraries:  statsmodels and scikit_posthocs for
+# univariate, PyOD for multivariate, ruptures for single time series, and tslearn for multiple
+# time series.  We only load the detectors a server is configured to run, and only when we need
+# them.  The first call to a detector also costs more than later ones (LOCI, for one, compiles
+# code with numba), so at startup each worker runs every enabled detector once on a tiny
+# synthetic input.  GET /ready reports whether that has finished.
+
+import os
+import numpy as np
+import pandas as pd
+
+DETECTORS = ["univariate", "multivariate", "single_timeseries", "multi_timeseries"]
+
+def parse_detectors(setting):
+    detectors = [d.strip() for d in setting.split(",") if d.strip() != ""]
+    unknown = [d for d in detectors if d not in DETECTORS]
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown detectors in ANOMALY_DETECTORS:  {', '.join(unknown)}.  Valid detectors are {', '.join(DETECTORS)}.")
+    return detectors
+
+# Detectors this server runs, e.g. "univariate,single_timeseries".  Endpoints for any other detector return a 404.
+enabled_detectors = parse_detectors(os.environ.get("ANOMALY_DETECTORS", ",".join(DETECTORS)))
+# Set ANOMALY_WARMUP to false to skip warmup, in which case each detector loads on first use.
+warm_up_enabled = os.environ.get("ANOMALY_WARMUP", "true").lower() not in ("false", "0", "no", "off")
+
+# Readiness, as reported by GET /ready.  status is starting, warming up, ready, or failed.
+state = { "status": "starting", "seconds": None, "detectors": {}, "error": None }
+
+def make_call(module_name):
+    # A detector call on a small input which still runs each detector's tests:  enough points for
+    # GESD and the Gaussian mixture test, and one obvious outlier so that scoring has something to find.
+    rng = np.random.default_rng(0)
+    values = np.append(rng.normal(10.0, 1.0, 29).round(2), 40.0)
+    keys = [str(i) for i in range(len(values))]
+    dt = pd.date_range("2020-01-01", periods=len(values), freq="h")
+    if module_name == "univariate":
+        return ("detect_univariate_statistical", (pd.DataFrame({ "key": keys, "value": values }), 50, 1.0), {})
+    elif module_name == "multivariate":
+        vals = [[v, w] for (v, w) in zip(values, rng.normal(5.0, 1.0, len(values)).round(2))]
+        return ("detect_multivariate_statistical", (pd.DataFrame({ "key": keys, "vals": vals }), 50, 1.0, 10), {})
+    elif module_name == "single_timeseries":
+        return ("detect_single_timeseries", (pd.DataFrame({ "key": keys, "dt": dt, "value": values }), 50, 1.0), {})
+    elif module_name == "multi_timeseries":
+        df = pd.DataFrame({
+            "key": keys * 3,
+            "series_key": np.repeat(["a", "b", "c"], len(values)),
+            "dt": np.tile(dt, 3),
+            "value": np.concatenate([values, values[::-1], rng.normal(10.0, 1.0, len(values)).round(2)])
+        })
+        return ("detect_multi_timeseries", (df, 50, 1.0), {})
+    raise ValueError(f"Unknown detector {module_name}.")
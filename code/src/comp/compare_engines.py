@@ -11,6 +11,7 @@ from azure.ai.anomalydetector import AnomalyDetectorClient
 from azure.ai.anomalydetector.models import DetectRequest, TimeSeriesPoint, TimeGranularity, AnomalyDetectorError
 from azure.core.credentials import AzureKeyCredential
 import os
+import time
 import datetime as dt
 
 # Helper functions for processing our anomaly detection engine.
@@ -31,7 +32,38 @@ def detect_outliers_book(server_url, method, sensitivity_score, max_fraction_ano
     )
     res = json.loads(r.content)
     cutoff = res['debug_details']['Outlier determination']['Sensitivity score']
-    df = pd.DataFrame(res['anomalies'])
+    return scale_outliers_book(pd.DataFrame(res['anomalies']), cutoff)
+
+
+# NAB files can take a while to process, so rather than hold one request open for each
+# file, we can submit a detection job, poll until it finishes, and page through the results.
+def detect_outliers_book_job(server_url, method, sensitivity_score, max_fraction_anomalies, input_df, poll_seconds=1.0, page_size=5000):
+    input_data_set = input_df[['key', 'dt', 'value']].to_json(orient='records', date_format='iso')
+    r = requests.post(
+        f"{server_url}/jobs/{method}?sensitivity_score={sensitivity_score}&max_fraction_anomalies={max_fraction_anomalies}",
+        data=input_data_set,
+        headers={"Content-Type": "application/json"}
+    )
+    r.raise_for_status()
+    job_id = r.json()['job_id']
+    while True:
+        job = requests.get(f"{server_url}/jobs/{job_id}?debug=true").json()
+        if job['status'] == 'succeeded':
+            break
+        elif job['status'] == 'failed':
+            raise RuntimeError(f"Job {job_id} failed:  {job['error']}")
+        time.sleep(poll_seconds)
+    cutoff = job['debug_details']['Outlier determination']['Sensitivity score']
+    anomalies = []
+    offset = 0
+    while offset is not None:
+        page = requests.get(f"{server_url}/jobs/{job_id}/results?offset={offset}&limit={page_size}").json()
+        anomalies.extend(page['anomalies'])
+        offset = page['next_offset']
+    return scale_outliers_book(pd.DataFrame(anomalies), cutoff)
+
+
+def scale_outliers_book(df, cutoff):
     df = df.drop('key', axis=1)
     df['anomaly_score'] = 0.5 * df['anomaly_score'] / cutoff
     # If anomaly score is greater than 1, set it to 1.0.
@@ -48,7 +80,7 @@ def write_file_book(df, output_file):
 
 
 def process_book(data_folder, results_folder):
-    server_url = "http://localhost/detect"
+    server_url = "http://localhost"
     method = "timeseries/single"
     sensitivity_score = 55
     max_fraction_anomalies = 0.25
@@ -58,7 +90,7 @@ def process_book(data_folder, results_folder):
         file_location = input_file.replace(data_folder, "")
         file_name = Path(input_file).name
         input_data = read_file_book(input_file)
-        df = detect_outliers_book(server_url, method, sensitivity_score, max_fraction_anomalies, debug, input_data)
+        df = detect_outliers_book_job(server_url, method, sensitivity_score, max_fraction_anomalies, input_data)
         output_file = results_folder + "book\\" + file_location.replace(file_name, "book_" + file_name)
         write_file_book(df, output_file)
         print('Completed file ' + file_name)
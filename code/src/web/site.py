@@ -18,6 +18,28 @@ def process(server_url, method, sensitivity_score, max_fraction_anomalies, debug
     )
     return r
 
+# Detection keeps its scores on the server.  If only the sensitivity settings have changed since the
+# last run, we ask the server to apply the new settings to those scores instead of detecting again.
+def process_with_scores(server_url, method, sensitivity_score, max_fraction_anomalies, debug, input_data_set):
+    request_key = (server_url, method, debug, input_data_set)
+    if st.session_state.get("score_request") == request_key:
+        base_url = server_url.rsplit("/detect", 1)[0]
+        r = requests.get(f"{base_url}/rethreshold/{st.session_state['score_id']}?sensitivity_score={sensitivity_score}&max_fraction_anomalies={max_fraction_anomalies}&debug={debug}")
+        # The server drops scores after a while, in which case we run detection again.
+        if r.status_code == 200:
+            return r
+    full_server_url = f"{server_url}/{method}?sensitivity_score={sensitivity_score}&max_fraction_anomalies={max_fraction_anomalies}&debug={debug}&keep_scores=true"
+    r = requests.post(
+        full_server_url,
+        data=input_data_set,
+        headers={"Content-Type": "application/json"}
+    )
+    res = json.loads(r.content)
+    if r.status_code == 200 and "score_id" in res:
+        st.session_state["score_request"] = request_key
+        st.session_state["score_id"] = res["score_id"]
+    return r
+
 # Used as a helper method for creating lists from JSON.
 @st.cache_data
 def convert_univariate_list_to_json(univariate_str):
@@ -187,7 +209,7 @@ def main():
             input_data = convert_single_time_series_list_to_json(input_data)
         if method == "timeseries/multiple" and convert_to_json:
             input_data = convert_multi_time_series_list_to_json(input_data)
-        resp = process(server_url, method, sensitivity_score, max_fraction_anomalies, debug, input_data)
+        resp = process_with_scores(server_url, method, sensitivity_score, max_fraction_anomalies, debug, input_data)
         res = json.loads(resp.content)
         df = pd.DataFrame(res['anomalies'])
 
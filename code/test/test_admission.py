@@ -0,0 +1,42 @@
+from src.app.admission import *
+import pytest
+
+@pytest.mark.parametrize("method, num_records, num_dimensions, num_series", [
+    ("univariate", 100, 1, 1),
+    ("multivariate", 100, 5, 1),
+    ("single_timeseries", 100, 1, 1),
+    ("multi_timeseries", 100, 1, 2),
+])
+def test_admit_accepts_small_requests(method, num_records, num_dimensions, num_series):
+    # Act
+    decision = admit(method, num_records, num_dimensions, num_series)
+    # Assert
+    assert(decision["Decision"] == "accepted")
+    assert(decision["Settings"] == {})
+
+@pytest.mark.parametrize("method, num_records, num_dimensions, expected_settings", [
+    # LOCI on 900 rows is cubic and over any reasonable CPU budget.
+    ("multivariate", 900, 5, { "disabled_tests": ["loci"] }),
+    # 50k rows of COF would need a 20GB distance matrix, so there is no cheaper COF setting left.
+    ("multivariate", 50000, 5, { "disabled_tests": ["loci", "cof"] }),
+    # The rbf Gram matrix for 20k points is several GB.
+    ("single_timeseries", 20000, 1, { "kernels": ["cosine", "linear"] }),
+])
+def test_admit_downgrades_expensive_requests(method, num_records, num_dimensions, expected_settings):
+    # Act
+    decision = admit(method, num_records, num_dimensions, mode="downgrade")
+    # Assert
+    assert(decision["Decision"] == "downgraded")
+    assert(decision["Settings"] == expected_settings)
+    assert(decision["Estimate"]["Peak memory (MB)"] < decision["Original estimate"]["Peak memory (MB)"]
+        or decision["Estimate"]["CPU time (s)"] < decision["Original estimate"]["CPU time (s)"])
+
+@pytest.mark.parametrize("method, num_records, mode", [
+    ("single_timeseries", 20000, "reject"),
+    ("single_timeseries", 1000000, "downgrade"),
+])
+def test_admit_rejects_requests_over_budget(method, num_records, mode):
+    # Act
+    decision = admit(method, num_records, mode=mode)
+    # Assert
+    assert(decision["Decision"] == "rejected")
@@ -0,0 +1,430 @@
+import os
+import sys
+import time
+import threading
+import json
+# main.py imports the service as the app package, as it runs from src.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+from app.main import app
+from app import executor, jobs, warmup, profiling, result_cache, scores, metrics, tables
+from fastapi.testclient import TestClient
+import numpy as np
+import pytest
+
+@pytest.fixture
+def service(monkeypatch, tmp_path):
+    # Run detectors in this process, skip warmup, and keep jobs and profiles apart from other tests.
+    monkeypatch.setattr(executor, "max_workers", 1)
+    monkeypatch.setattr(warmup, "warm_up_enabled", False)
+    monkeypatch.setattr(warmup, "state", { "status": "starting", "seconds": None, "detectors": {}, "error": None })
+    monkeypatch.setattr(jobs, "database_path", str(tmp_path / "jobs.sqlite3"))
+    monkeypatch.setattr(profiling, "profile_path", str(tmp_path / "profiles"))
+    result_cache.memory_cache.clear()
+    result_cache.raw_keys.clear()
+    scores.score_cache.clear()
+    metrics.reset()
+
+@pytest.fixture
+def client(service):
+    with TestClient(app) as client:
+        yield client
+
+rng = np.random.default_rng(7)
+values = [float(v) for v in np.append(rng.normal(10.0, 1.0, 39).round(2), 40.0)]
+univariate_records = [{ "key": str(i), "value": v } for (i, v) in enumerate(values)]
+univariate_columns = { "key": [str(i) for i in range(len(values))], "value": values }
+multivariate_records = [{ "key": str(i), "vals": [v, round(float(rng.normal(5.0, 1.0)), 2)] } for (i, v) in enumerate(values)]
+multi_records = [{ "key": f"{k}{i}", "series_key": k, "dt": f"2022-01-{i+1:02d}T00:00:00", "value": round(float(rng.normal(10.0, 1.0)), 2) } for k in "abc" for i in range(20)]
+single_records = [{ "key": str(i), "dt": f"2022-01-01T{i // 60:02d}:{i % 60:02d}:00", "value": round(float(rng.normal(10.0 if i < 60 else 14.0, 1.0)), 2) } for i in range(120)]
+multi_wide = { "dt": [r["dt"] for r in multi_records[:20]], "series": { k: [r["value"] for r in multi_records if r["series_key"] == k] for k in "abc" } }
+
+def test_columnar_body_matches_records(client):
+    # Act
+    records = client.post("/detect/univariate", json=univariate_records)
+    columns = client.post("/detect/univariate", json=univariate_columns)
+    # Assert
+    assert(records.status_code == 200)
+    assert(columns.json() == records.json())
+
+def test_columnar_body_with_mismatched_lengths(client):
+    # Act
+    response = client.post("/detect/univariate", json={ "key": ["a", "b"], "value": [1.0] })
+    # Assert
+    assert(response.status_code == 422)
+
+def test_orient_columns(client):
+    # Act
+    records = client.post("/detect/univariate", json=univariate_records).json()
+    columns = client.post("/detect/univariate?orient=columns", json=univariate_records).json()
+    # Assert:  one array per column, with the same values as the records
+    assert(list(columns["anomalies"].keys()) == list(records["anomalies"][0].keys()))
+    assert(columns["anomalies"]["is_anomaly"] == [r["is_anomaly"] for r in records["anomalies"]])
+
+def test_invalid_orient(client):
+    # Act
+    response = client.post("/detect/univariate?orient=index", json=univariate_records)
+    # Assert
+    assert(response.status_code == 400)
+
+def test_pool_busy(client, monkeypatch):
+    # Arrange
+    monkeypatch.setattr(executor, "queued_requests", executor.max_workers + executor.max_queued)
+    # Act
+    response = client.post("/detect/univariate", json=univariate_records)
+    # Assert
+    assert(response.status_code == 503)
+    assert(response.headers["Retry-After"] == str(executor.retry_after_seconds))
+
+def test_worker_failed(client, monkeypatch):
+    # Arrange
+    async def run_detector(*args, **kwargs):
+        raise executor.WorkerFailed(7)
+    monkeypatch.setattr(executor, "run_detector", run_detector)
+    # Act
+    response = client.post("/detect/univariate", json=univariate_records)
+    # Assert
+    assert(response.status_code == 503)
+    assert(response.headers["Retry-After"] == "7")
+    assert(executor.queued_requests == 0)
+
+def wait_for_job(client, status_url):
+    deadline = time.time() + 60
+    job = client.get(status_url).json()
+    while job["status"] in ("queued", "running") and time.time() < deadline:
+        time.sleep(0.1)
+        job = client.get(status_url).json()
+    return job
+
+def test_job(client):
+    # Act
+    submitted = client.post("/jobs/univariate", json=univariate_records)
+    job = wait_for_job(client, submitted.json()["status_url"])
+    first_page = client.get(submitted.json()["results_url"] + "?offset=0&limit=25").json()
+    last_page = client.get(submitted.json()["results_url"] + f"?offset={first_page['next_offset']}&limit=25").json()
+    # Assert
+    assert(submitted.status_code == 202)
+    assert(job["status"] == "succeeded")
+    assert(job["num_results"] == len(values))
+    assert([r["key"] for r in first_page["anomalies"] + last_page["anomalies"]] == univariate_columns["key"])
+    assert(last_page["next_offset"] is None)
+
+def test_job_not_found(client):
+    # Act and assert
+    assert(client.get("/jobs/no-such-job").status_code == 404)
+    assert(client.get("/jobs/no-such-job/results").status_code == 404)
+
+def test_upload(client):
+    # Arrange
+    pa = pytest.importorskip("pyarrow")
+    import pyarrow.parquet
+    sink = pa.BufferOutputStream()
+    pa.parquet.write_table(pa.table(univariate_columns), sink)
+    # Act
+    response = client.post("/detect/univariate/upload", content=sink.getvalue().to_pybytes(), headers={ "Content-Type": "application/vnd.apache.parquet" })
+    df = pa.parquet.read_table(pa.BufferReader(response.content)).to_pandas()
+    # Assert:  results come back in the format sent
+    assert(response.headers["Content-Type"] == "application/vnd.apache.parquet")
+    assert(list(df["key"]) == univariate_columns["key"])
+    assert(df["is_anomaly"].iloc[-1])
+
+def test_upload_unsupported_content_type(client):
+    # Act
+    response = client.post("/detect/univariate/upload", content=b"key,value\na,1.0\n", headers={ "Content-Type": "text/csv" })
+    # Assert
+    assert(response.status_code == 415)
+
+def test_upload_without_pyarrow(client, monkeypatch):
+    # Arrange
+    def read_frame(body, format, columns):
+        raise ImportError("No module named 'pyarrow'")
+    monkeypatch.setattr(tables, "read_frame", read_frame)
+    # Act
+    response = client.post("/detect/univariate/upload", content=b"", headers={ "Content-Type": "application/vnd.apache.parquet" })
+    # Assert
+    assert(response.status_code == 501)
+
+def test_ndjson(client):
+    # Act
+    response = client.post("/detect/univariate?debug=true", json=univariate_records, headers={ "Accept": "application/x-ndjson" })
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    # Assert:  one line per data point, then one line with everything else
+    assert(response.headers["Content-Type"].startswith("application/x-ndjson"))
+    assert([line["key"] for line in lines[:-1]] == univariate_columns["key"])
+    assert("debug_details" in lines[-1])
+
+def test_response_cache(client):
+    # Act
+    first = client.post("/detect/univariate", json=univariate_records)
+    second = client.post("/detect/univariate", json=univariate_columns)
+    not_modified = client.post("/detect/univariate", json=univariate_records, headers={ "If-None-Match": first.headers["ETag"] })
+    other_settings = client.post("/detect/univariate?sensitivity_score=90", json=univariate_records)
+    # Assert:  the same data as records or columns is the same request
+    assert(first.headers["X-Cache"] == "miss")
+    assert(second.headers["X-Cache"] == "hit")
+    assert(second.headers["ETag"] == first.headers["ETag"])
+    assert(second.content == first.content)
+    assert(not_modified.status_code == 304)
+    assert(not_modified.content == b"")
+    assert(other_settings.headers["ETag"] != first.headers["ETag"])
+
+def refuse_to_prepare(*args):
+    raise AssertionError("A repeated request should not be parsed again.")
+
+def test_repeated_request_skips_parsing(client, monkeypatch):
+    # Arrange
+    first = client.post("/detect/univariate?debug=true", json=univariate_records)
+    monkeypatch.setattr("app.main.prepare_univariate", refuse_to_prepare)
+    # Act
+    second = client.post("/detect/univariate?debug=true", json=univariate_records)
+    not_modified = client.post("/detect/univariate?debug=true", json=univariate_records, headers={ "If-None-Match": first.headers["ETag"] })
+    # Assert
+    assert(second.headers["X-Cache"] == "hit")
+    assert(second.headers["ETag"] == first.headers["ETag"])
+    assert(second.content == first.content)
+    assert(not_modified.status_code == 304)
+
+def test_several_settings(client):
+    # Act
+    response = client.post("/detect/univariate?sensitivity_score=40&sensitivity_score=95", json=univariate_records).json()
+    # Assert:  one set of threshold columns per setting, and a summary of each setting
+    assert([(s["sensitivity_score"], s["max_fraction_anomalies"]) for s in response["settings"]] == [(40, 1.0), (95, 1.0)])
+    for (i, s) in enumerate(response["settings"]):
+        assert(s["num_anomalies"] == sum([r[f"is_anomaly_{i}"] for r in response["anomalies"]]))
+    assert(response["settings"][0]["num_anomalies"] <= response["settings"][1]["num_anomalies"])
+
+def test_several_settings_multivariate(client):
+    # Act
+    response = client.post("/detect/multivariate?max_fraction_anomalies=0.05&max_fraction_anomalies=0.4", json=multivariate_records).json()
+    # Assert:  COF's raw labels follow each setting's max_fraction_anomalies
+    assert(sum([r["is_raw_anomaly_cof_0"] for r in response["anomalies"]]) <= sum([r["is_raw_anomaly_cof_1"] for r in response["anomalies"]]))
+
+@pytest.mark.parametrize("query", [
+    "sensitivity_score=50&sensitivity_score=150",
+    "max_fraction_anomalies=0.5&max_fraction_anomalies=-1",
+])
+def test_several_settings_out_of_range(client, query):
+    # Act and assert
+    assert(client.post("/detect/univariate?" + query, json=univariate_records).status_code == 400)
+
+@pytest.mark.parametrize("query", [
+    "sensitivity_score=500",
+    "sensitivity_score=50&max_fraction_anomalies=0",
+])
+def test_out_of_range_setting(client, query):
+    # Act
+    response = client.post("/detect/univariate?debug=true&" + query, json=univariate_records)
+    # Assert:  a single setting goes to the detector, which reports the problem instead of detecting
+    assert(response.status_code == 200)
+    assert(isinstance(response.json()["debug_details"], str))
+    assert(not any([r["is_anomaly"] for r in response.json()["anomalies"]]))
+
+def test_rethreshold_matches_detection(client):
+    # Arrange
+    kept = client.post("/detect/multivariate?keep_scores=true&max_fraction_anomalies=0.4", json=multivariate_records).json()
+    # Act
+    rethresholded = client.get(f"/rethreshold/{kept['score_id']}?sensitivity_score=70&max_fraction_anomalies=0.05").json()
+    detected = client.post("/detect/multivariate?sensitivity_score=70&max_fraction_anomalies=0.05", json=multivariate_records).json()
+    # Assert
+    assert(rethresholded["score_id"] == kept["score_id"])
+    assert(rethresholded["anomalies"] == detected["anomalies"])
+
+def test_repeated_keep_scores_is_cached(client):
+    # Arrange
+    first = client.post("/detect/univariate?keep_scores=true", json=univariate_records)
+    # Act
+    second = client.post("/detect/univariate?keep_scores=true", json=univariate_records)
+    # Assert:  the same input keeps the same score_id, which still rethresholds
+    assert(first.headers["X-Cache"] == "miss")
+    assert(second.headers["X-Cache"] == "hit")
+    assert(second.json()["score_id"] == first.json()["score_id"])
+    assert(client.get(f"/rethreshold/{second.json()['score_id']}?sensitivity_score=70").status_code == 200)
+
+def test_keep_scores_after_scores_expire(client):
+    # Arrange
+    first = client.post("/detect/univariate?keep_scores=true", json=univariate_records)
+    scores.score_cache.clear()
+    # Act
+    second = client.post("/detect/univariate?keep_scores=true", json=univariate_records)
+    # Assert:  a cached response never hands out a score_id we no longer have
+    assert(second.headers["X-Cache"] == "miss")
+    assert(client.get(f"/rethreshold/{second.json()['score_id']}?sensitivity_score=70").status_code == 200)
+
+def test_rethreshold_unknown_scores(client):
+    # Act and assert
+    assert(client.get("/rethreshold/no-such-scores?sensitivity_score=70").status_code == 404)
+
+def test_rethreshold_out_of_range_setting(client):
+    # Act and assert:  rethresholding has no detector to check its settings
+    assert(client.get("/rethreshold/no-such-scores?sensitivity_score=500").status_code == 400)
+
+def test_metrics(client, monkeypatch):
+    # Arrange
+    monkeypatch.setattr(metrics, "enabled", True)
+    monkeypatch.setattr(metrics, "stage_timings", True)
+    client.post("/detect/univariate", json=univariate_records)
+    client.get("/no-such-path")
+    # Act
+    response = client.get("/metrics")
+    lines = response.text.split("\n")
+    # Assert
+    assert(response.headers["Content-Type"].startswith("text/plain; version=0.0.4"))
+    assert('anomaly_requests_total{endpoint="/detect/univariate",http_method="POST",status="200"} 1' in lines)
+    assert('anomaly_requests_total{endpoint="unmatched",http_method="GET",status="404"} 1' in lines)
+    assert('anomaly_input_records_count{method="univariate"} 1' in lines)
+    assert('anomaly_stage_duration_seconds_count{method="univariate",stage="Run detector"} 1' in lines)
+    assert('anomaly_tests_total{method="univariate",test="grubbs",status="run"} 1' in lines)
+    assert(any([line.startswith('anomaly_cache_misses_total{cache="response"} ') for line in lines]))
+
+def test_admin_endpoints_off_without_token(client, monkeypatch):
+    # Arrange
+    monkeypatch.setattr(profiling, "admin_token", "")
+    # Act and assert
+    assert(client.get("/admin/profiles").status_code == 404)
+    assert(client.get("/admin/profiles", headers={ "X-Admin-Token": "" }).status_code == 404)
+
+def test_admin_endpoints_require_token(client, monkeypatch):
+    # Arrange
+    monkeypatch.setattr(profiling, "admin_token", "secret")
+    monkeypatch.setattr(profiling, "sample_rate", 1.0)
+    client.post("/detect/univariate", json=univariate_records)
+    # Act
+    without_token = client.get("/admin/profiles")
+    wrong_token = client.get("/admin/profiles", headers={ "X-Admin-Token": "guess" })
+    profiles = client.get("/admin/profiles", headers={ "X-Admin-Token": "secret" })
+    profile_id = profiles.json()["profiles"][0]["profile_id"]
+    download = client.get(f"/admin/profiles/{profile_id}/download", headers={ "X-Admin-Token": "secret" })
+    download_without_token = client.get(f"/admin/profiles/{profile_id}/download")
+    # Assert
+    assert(without_token.status_code == 403)
+    assert(wrong_token.status_code == 403)
+    assert(profiles.json()["profiles"][0]["endpoint"] == "/detect/univariate")
+    assert(download.status_code == 200)
+    assert(len(download.content) > 0)
+    assert(download_without_token.status_code == 403)
+
+def wait_for_ready(client):
+    deadline = time.time() + 60
+    response = client.get("/ready")
+    while response.json()["status"] in ("starting", "warming up") and time.time() < deadline:
+        time.sleep(0.05)
+        response = client.get("/ready")
+    return response
+
+def test_ready_after_warmup(service, monkeypatch):
+    # Arrange:  hold warmup until we have checked readiness
+    monkeypatch.setattr(warmup, "warm_up_enabled", True)
+    monkeypatch.setattr(warmup, "enabled_detectors", ["univariate"])
+    release = threading.Event()
+    def warm_up(module_names):
+        release.wait(10)
+        return [executor.warm_up_worker(module_names)]
+    monkeypatch.setattr(executor, "warm_up", warm_up)
+    with TestClient(app) as client:
+        # Act
+        warming_up = client.get("/ready")
+        release.set()
+        ready = wait_for_ready(client)
+    # Assert
+    assert(warming_up.status_code == 503)
+    assert(warming_up.json()["status"] == "warming up")
+    assert(ready.status_code == 200)
+    assert(list(ready.json()["detectors"].keys()) == ["univariate"])
+
+def test_ready_after_failed_warmup(service, monkeypatch):
+    # Arrange
+    monkeypatch.setattr(warmup, "warm_up_enabled", True)
+    def warm_up(module_names):
+        raise RuntimeError("No memory for the workers")
+    monkeypatch.setattr(executor, "warm_up", warm_up)
+    with TestClient(app) as client:
+        # Act
+        response = wait_for_ready(client)
+    # Assert
+    assert(response.status_code == 503)
+    assert(response.json()["error"] == "No memory for the workers")
+
+@pytest.mark.parametrize("path", ["/detect/multivariate", "/jobs/multivariate", "/detect/multivariate/upload"])
+def test_disabled_detector(client, monkeypatch, path):
+    # Arrange
+    monkeypatch.setattr(warmup, "enabled_detectors", ["univariate"])
+    # Act
+    response = client.post(path, json=multivariate_records)
+    # Assert
+    assert(response.status_code == 404)
+    assert(client.post("/detect/univariate", json=univariate_records).status_code == 200)
+
+@pytest.mark.parametrize("path", [
+    "/detect/timeseries/multiple?sax_mode=bogus",
+    "/jobs/timeseries/multiple?sax_mode=bogus",
+    "/detect/timeseries/multiple/upload?sax_mode=bogus",
+])
+def test_invalid_sax_mode(client, path):
+    # Act and assert:  rejected before the call is admitted, rather than failing in the worker
+    assert(client.post(path, json=multi_records).status_code == 400)
+
+@pytest.mark.parametrize("path", ["/detect/timeseries/multiple/wide?sax_mode=bogus", "/jobs/timeseries/multiple/wide?sax_mode=bogus"])
+def test_invalid_sax_mode_wide(client, path):
+    # Act and assert
+    assert(client.post(path, json=multi_wide).status_code == 400)
+
+@pytest.mark.parametrize("query", ["group_id=g1", "group_id=g1&keep_scores=true"])
+def test_group_is_not_cached(client, query):
+    # Act
+    first = client.post("/detect/timeseries/multiple?" + query, json=multi_records)
+    second = client.post("/detect/timeseries/multiple?" + query, json=multi_records)
+    # Assert:  results for a group depend on what its worker has seen before, not on the request alone
+    assert(first.status_code == 200)
+    assert("X-Cache" not in second.headers)
+    assert("ETag" not in second.headers)
+    assert(result_cache.memory_cache.stats()["Entries"] == 0)
+
+def test_segments_summarized_in_worker(client, monkeypatch):
+    # Arrange
+    returned = []
+    run_detector = executor.run_detector
+    async def record_detector(*args, **kwargs):
+        result = await run_detector(*args, **kwargs)
+        returned.append(result[0].shape[0])
+        return result
+    monkeypatch.setattr(executor, "run_detector", record_detector)
+    # Act
+    response = client.post("/detect/timeseries/multiple?output_mode=segments", json=multi_records)
+    # Assert:  only the segment rows come back from the worker
+    assert(response.status_code == 200)
+    assert(returned == [len(response.json()["segments"])])
+    assert(returned[0] < len(multi_records))
+
+@pytest.mark.parametrize("query", ["", "&keep_scores=true"])
+def test_segments(client, query):
+    # Act
+    points = client.post("/detect/timeseries/multiple?sensitivity_score=80&include_keys=true", json=multi_records).json()
+    segments = client.post("/detect/timeseries/multiple?sensitivity_score=80&include_keys=true&output_mode=segments" + query, json=multi_records).json()
+    # Assert:  segments cover every data point, and list the keys of the anomalous ones
+    assert(sum([s["num_points"] for s in segments["segments"]]) == len(multi_records))
+    assert(sorted([k for s in segments["segments"] if s["is_anomaly"] for k in s["anomalous_keys"]]) == sorted([r["key"] for r in points["anomalies"] if r["is_anomaly"]]))
+
+def test_incremental_is_approximate(client):
+    # Arrange
+    client.post("/detect/timeseries/single?series_id=s1", json=single_records[:100])
+    client.post("/detect/timeseries/single?series_id=s2&incremental=true", json=single_records[:100])
+    # Act
+    exact = client.post("/detect/timeseries/single?series_id=s1", json=single_records).json()
+    incremental = client.post("/detect/timeseries/single?series_id=s2&incremental=true", json=single_records).json()
+    # Assert:  only incremental results say they may differ from a full solve
+    assert("approximate" not in exact)
+    assert(incremental["approximate"])
+
+def test_metrics_without_stage_timings(client, monkeypatch):
+    # Arrange
+    monkeypatch.setattr(metrics, "enabled", True)
+    monkeypatch.setattr(metrics, "stage_timings", False)
+    def refuse_to_instrument(*args, **kwargs):
+        raise AssertionError("Detectors should not collect timings unless asked to.")
+    monkeypatch.setattr(executor, "run_detector_instrumented", refuse_to_instrument)
+    client.post("/detect/univariate", json=univariate_records)
+    # Act
+    lines = client.get("/metrics").text.split("\n")
+    # Assert:  requests are still counted and timed as a whole
+    assert('anomaly_requests_total{endpoint="/detect/univariate",http_method="POST",status="200"} 1' in lines)
+    assert('anomaly_request_duration_seconds_count{endpoint="/detect/univariate"} 1' in lines)
+    assert(not any([line.startswith("anomaly_stage_duration_seconds") for line in lines]))
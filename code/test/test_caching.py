@@ -0,0 +1,37 @@
+from src.app.caching import *
+import pytest
+
+def test_sized_lru_cache_evicts_least_recently_used():
+    # Arrange
+    cache = SizedLRUCache(max_entries=2, max_bytes=1000)
+    cache.put("a", 1, 10)
+    cache.put("b", 2, 10)
+    # Act:  touch a so that b is the least recently used entry
+    cache.get("a")
+    cache.put("c", 3, 10)
+    # Assert
+    assert("a" in cache and "c" in cache and "b" not in cache)
+    assert(cache.stats()["Evictions"] == 1)
+
+def test_sized_lru_cache_evicts_by_size():
+    # Arrange
+    cache = SizedLRUCache(max_entries=100, max_bytes=100)
+    # Act
+    cache.put("a", 1, 60)
+    cache.put("b", 2, 60)
+    too_large = cache.put("c", 3, 101)
+    # Assert
+    assert(list(cache._entries.keys()) == ["b"])
+    assert(cache.total_bytes == 60)
+    assert(too_large == False)
+
+def test_sized_lru_cache_counts_hits_and_misses():
+    # Arrange
+    cache = SizedLRUCache(max_entries=10, max_bytes=100)
+    cache.put("a", 1, 1)
+    # Act
+    cache.get("a")
+    cache.get("b")
+    # Assert
+    assert(cache.stats()["Hits"] == 1)
+    assert(cache.stats()["Misses"] == 1)
@@ -0,0 +1,167 @@
+import os
+import time
+import asyncio
+from src.app import executor
+from src.app.executor import *
+from src.app.models import parallel
+import pandas as pd
+import pytest
+
+def make_series(n, offset):
+    return pd.DataFrame({"key": [str(i) for i in range(n)], "value": [float(i % 5 + offset) for i in range(n)]})
+
+@pytest.mark.parametrize("workers, chunk_size, max_in_flight", [
+    (1, None, None),
+    (2, 1, 1),
+    (2, 3, 2),
+])
+def test_map_detector_preserves_order(monkeypatch, workers, chunk_size, max_in_flight):
+    # Arrange
+    monkeypatch.setattr(executor, "max_workers", workers)
+    calls = [((make_series(10 + i, i * 100), 50, 1.0), {}) for i in range(7)]
+    # Act
+    outputs = map_detector("univariate", "detect_univariate_statistical", calls, chunk_size, max_in_flight)
+    # Assert:  each result lines up with the call which produced it
+    assert(len(outputs) == len(calls))
+    for (((df_in, s, m), kwargs), (df_out, weights, details)) in zip(calls, outputs):
+        assert(df_out.shape[0] == df_in.shape[0])
+        assert(df_out['value'].min() == df_in['value'].min())
+
+def test_parse_method_limits():
+    assert(parse_method_limits("multivariate=1, single_timeseries=2") == { "multivariate": 1, "single_timeseries": 2 })
+    assert(parse_method_limits("") == {})
+
+def test_choose_worker_routes_affinity_to_same_worker(monkeypatch):
+    # Arrange
+    monkeypatch.setattr(executor, "max_workers", 4)
+    # Act
+    workers = [choose_worker("series-" + str(i)) for i in range(20)]
+    # Assert
+    assert(workers == [choose_worker("series-" + str(i)) for i in range(20)])
+    assert(all([0 <= w < 4 for w in workers]))
+
+def test_reserve_rejects_when_queue_is_full(monkeypatch):
+    # Arrange
+    monkeypatch.setattr(executor, "max_workers", 2)
+    monkeypatch.setattr(executor, "max_queued", 3)
+    monkeypatch.setattr(executor, "queued_requests", 5)
+    async def request():
+        async with reserve("univariate"):
+            pass
+    # Act and assert
+    with pytest.raises(PoolBusy):
+        asyncio.run(request())
+
+def test_reserve_applies_method_limits(monkeypatch):
+    # Arrange
+    monkeypatch.setattr(executor, "max_workers", 2)
+    monkeypatch.setattr(executor, "method_limits", { "multivariate": 1 })
+    entered = []
+    async def request(method, name, release):
+        async with reserve(method):
+            entered.append(name)
+            await release.wait()
+    async def scenario():
+        release = asyncio.Event()
+        tasks = [asyncio.create_task(request(m, n, release)) for (m, n) in [("multivariate", "mv1"), ("multivariate", "mv2"), ("univariate", "uni")]]
+        await asyncio.sleep(0.05)
+        # Act:  the second multivariate request waits behind the first; the univariate request does not.
+        waiting = list(entered)
+        release.set()
+        await asyncio.gather(*tasks)
+        return waiting
+    # Assert
+    assert(asyncio.run(scenario()) == ["mv1", "uni"])
+    assert(executor.queued_requests == 0)
+
+def test_reserve_several_slots(monkeypatch):
+    # Arrange
+    monkeypatch.setattr(executor, "max_workers", 2)
+    monkeypatch.setattr(executor, "method_limits", {})
+    entered = []
+    async def request(name, count, release):
+        async with reserve("single_timeseries", count) as num_slots:
+            entered.append((name, num_slots, executor.queued_requests))
+            await release.wait()
+    async def scenario():
+        release = asyncio.Event()
+        batch = asyncio.create_task(request("batch", 5, release))
+        await asyncio.sleep(0.05)
+        single = asyncio.create_task(request("single", 1, release))
+        await asyncio.sleep(0.05)
+        # Act:  the batch holds every worker, so the single request waits its turn.
+        waiting = list(entered)
+        release.set()
+        await asyncio.gather(batch, single)
+        return waiting
+    # Assert
+    assert(asyncio.run(scenario()) == [("batch", 2, 2)])
+    assert(executor.queued_requests == 0)
+
+def test_run_detector_without_pool(monkeypatch):
+    # Arrange
+    monkeypatch.setattr(executor, "max_workers", 1)
+    df = make_series(20, 0)
+    # Act
+    (df_out, weights, details) = asyncio.run(run_detector("univariate", "detect_univariate_statistical", (df, 50, 1.0)))
+    # Assert
+    assert(df_out.shape[0] == 20)
+
+@pytest.fixture
+def new_workers(monkeypatch):
+    monkeypatch.setattr(executor, "max_workers", 2)
+    monkeypatch.setattr(executor, "_workers", None)
+    monkeypatch.setattr(executor, "_in_flight", None)
+    yield
+    for w in executor._workers or []:
+        w.shutdown()
+
+def test_worker_which_dies_is_replaced(new_workers):
+    # Arrange
+    future = submit(os._exit, 1, affinity="series-1")
+    index = choose_worker("series-1")
+    old_worker = executor._workers[index]
+    # Act:  the task which killed its worker fails with a 503 rather than a 500
+    with pytest.raises(WorkerFailed):
+        asyncio.run(wait_for_result(future))
+    # Assert:  later tasks for the same affinity key go to a new worker
+    assert(submit(os.getpid, affinity="series-1").result() > 0)
+    assert(executor._workers[index] is not old_worker)
+    # Done callbacks run just after result() returns.
+    deadline = time.time() + 5
+    while executor._in_flight != [0, 0] and time.time() < deadline:
+        time.sleep(0.01)
+    assert(executor._in_flight == [0, 0])
+
+def get_model_workers():
+    return parallel.max_workers
+
+@pytest.mark.parametrize("cpu_count, api_workers, model_workers", [
+    (1, 1, 1),
+    (2, 2, 1),
+    (3, 2, 1),
+    (4, 2, 2),
+    (6, 3, 2),
+    (16, 8, 2),
+])
+def test_default_pool_sizes(cpu_count, api_workers, model_workers):
+    # Act and assert
+    assert(default_pool_sizes(cpu_count) == (api_workers, model_workers))
+
+def test_default_model_pool_runs_in_parallel(new_workers, monkeypatch):
+    # Arrange:  the defaults on an 8 CPU machine
+    (api_workers, model_workers) = default_pool_sizes(8)
+    monkeypatch.setattr(executor, "model_workers", model_workers)
+    # Act
+    worker_model_workers = submit(get_model_workers).result()
+    # Assert:  workers share the CPUs without losing parallel kernel fits and SAX
+    assert(api_workers * worker_model_workers <= 8)
+    assert(worker_model_workers > 1)
+
+def test_workers_share_model_pool(new_workers, monkeypatch):
+    # Arrange
+    monkeypatch.setattr(executor, "model_workers", 3)
+    # Act
+    model_workers = submit(get_model_workers).result()
+    # Assert
+    assert(model_workers == 3)
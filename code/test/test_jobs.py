@@ -0,0 +1,116 @@
+from src.app import jobs
+from src.app.jobs import *
+import pandas as pd
+import sqlite3
+import pytest
+
+@pytest.fixture(autouse=True)
+def job_database(monkeypatch, tmp_path):
+    monkeypatch.setattr(jobs, "database_path", str(tmp_path / "jobs.sqlite3"))
+
+def make_results(n):
+    return pd.DataFrame({"key": [str(i) for i in range(n)], "anomaly_score": [i / n for i in range(n)]})
+
+def test_create_job_starts_queued():
+    # Arrange
+    job_id = create_job("univariate")
+    # Act
+    job = get_job(job_id)
+    # Assert
+    assert(job["status"] == "queued")
+    assert(job["method"] == "univariate")
+    assert(job["num_results"] is None)
+
+def test_get_job_unknown():
+    assert(get_job("no-such-job") is None)
+
+@pytest.mark.parametrize("offset, limit", [
+    (0, 10),
+    (995, 10),
+    (1990, 100),
+    (0, 2500),
+    (3000, 10),
+])
+def test_get_results_pages_across_chunks(offset, limit):
+    # Arrange
+    df = make_results(2500)
+    job_id = create_job("univariate")
+    store_results(job_id, "anomalies", df, { "w": 1 }, { "Message": "done" })
+    # Act
+    rows = get_results(job_id, offset, limit)
+    # Assert:  the page matches the same slice of the original results
+    expected = df.iloc[offset:offset + limit]
+    assert(len(rows) == expected.shape[0])
+    assert([r["key"] for r in rows] == list(expected["key"]))
+
+def test_store_results_completes_job():
+    # Arrange
+    job_id = create_job("multi_timeseries")
+    # Act
+    store_results(job_id, "segments", make_results(5), { "w": 1 }, { "Message": "done" })
+    job = get_job(job_id)
+    # Assert
+    assert(job["status"] == "succeeded")
+    assert(job["result_key"] == "segments")
+    assert(job["num_results"] == 5)
+    assert(job["details"] == { "Message": "done" })
+
+def test_delete_expired(monkeypatch):
+    # Arrange
+    monkeypatch.setattr(jobs, "job_ttl_seconds", -1)
+    expired_id = create_job("univariate")
+    store_results(expired_id, "anomalies", make_results(5), {}, {})
+    monkeypatch.setattr(jobs, "job_ttl_seconds", 3600)
+    current_id = create_job("univariate")
+    # Act
+    num_deleted = delete_expired()
+    # Assert
+    assert(num_deleted == 1)
+    assert(get_job(expired_id) is None)
+    assert(get_results(expired_id, 0, 10) == [])
+    assert(get_job(current_id) is not None)
+
+def test_fail_unfinished_jobs(monkeypatch):
+    # Arrange:  a job taken by this process before it restarted
+    monkeypatch.setattr(jobs, "instance_id", "host-100-before")
+    job_id = create_job("univariate")
+    set_status(job_id, "running", "Detecting anomalies")
+    monkeypatch.setattr(jobs, "instance_id", "host-100-after")
+    # Act
+    num_failed = fail_unfinished_jobs()
+    # Assert
+    assert(num_failed == 1)
+    assert(get_job(job_id)["status"] == "failed")
+
+def test_second_process_keeps_running_jobs(monkeypatch):
+    # Arrange:  the first process takes a job and is still running
+    monkeypatch.setattr(jobs, "instance_id", "host-100-first")
+    fail_unfinished_jobs()
+    job_id = create_job("univariate")
+    set_status(job_id, "running", "Detecting anomalies")
+    # Act:  a second process sharing the database starts up
+    monkeypatch.setattr(jobs, "instance_id", "host-200-second")
+    num_failed = fail_unfinished_jobs()
+    # Assert
+    assert(num_failed == 0)
+    assert(get_job(job_id)["status"] == "running")
+    # Act:  the first process stops sending heartbeats
+    monkeypatch.setattr(jobs, "heartbeat_seconds", 0)
+    num_failed = fail_unfinished_jobs()
+    # Assert
+    assert(num_failed == 1)
+    assert(get_job(job_id)["status"] == "failed")
+
+def test_database_without_owners(monkeypatch, tmp_path):
+    # Arrange:  a database created before jobs had owners
+    database_path = str(tmp_path / "old_jobs.sqlite3")
+    with sqlite3.connect(database_path) as connection:
+        connection.execute("CREATE TABLE jobs (job_id TEXT PRIMARY KEY, method TEXT NOT NULL, status TEXT NOT NULL, stage TEXT, error TEXT, " +
+            "created REAL NOT NULL, updated REAL NOT NULL, expires REAL NOT NULL, result_key TEXT, num_results INTEGER, weights TEXT, details TEXT)")
+        connection.execute("INSERT INTO jobs (job_id, method, status, created, updated, expires) VALUES ('old', 'univariate', 'running', 0, 0, 1e12)")
+    monkeypatch.setattr(jobs, "database_path", database_path)
+    # Act
+    num_failed = fail_unfinished_jobs()
+    # Assert
+    assert(num_failed == 1)
+    assert(get_job(create_job("univariate"))["owner"] == jobs.instance_id)
@@ -0,0 +1,62 @@
+from src.app import metrics
+from src.app.metrics import *
+import pytest
+
+@pytest.fixture(autouse=True)
+def empty_metrics():
+    reset()
+    yield
+    reset()
+
+def test_counter():
+    # Act
+    inc("anomaly_requests_total", { "endpoint": "/detect/univariate", "http_method": "POST", "status": "200" })
+    inc("anomaly_requests_total", { "endpoint": "/detect/univariate", "http_method": "POST", "status": "200" })
+    text = render()
+    # Assert
+    assert("# TYPE anomaly_requests_total counter" in text)
+    assert('anomaly_requests_total{endpoint="/detect/univariate",http_method="POST",status="200"} 2' in text)
+
+def test_histogram():
+    # Act
+    observe("anomaly_input_records", { "method": "univariate" }, 10)
+    observe("anomaly_input_records", { "method": "univariate" }, 500)
+    observe("anomaly_input_records", { "method": "univariate" }, 50000000)
+    lines = render().split("\n")
+    # Assert
+    # A value equal to a bucket's upper bound falls in that bucket, and buckets are cumulative.
+    assert('anomaly_input_records_bucket{method="univariate",le="10.0"} 1' in lines)
+    assert('anomaly_input_records_bucket{method="univariate",le="100.0"} 1' in lines)
+    assert('anomaly_input_records_bucket{method="univariate",le="1000.0"} 2' in lines)
+    assert('anomaly_input_records_bucket{method="univariate",le="+Inf"} 3' in lines)
+    assert('anomaly_input_records_count{method="univariate"} 3' in lines)
+    assert('anomaly_input_records_sum{method="univariate"} 50000510.0' in lines)
+
+def test_label_escaping():
+    # Act
+    observe_stages("univariate", { "Grubbs' \"test\"": [0.5, 1] })
+    # Assert
+    assert('anomaly_stage_duration_seconds_count{method="univariate",stage="Grubbs\' \\"test\\""} 1' in render())
+
+def test_count_tests():
+    # Arrange
+    univariate_details = { "Test diagnostics": { "Tests Run": { "sds": 1, "dixon": 0 } } }
+    multivariate_details = { "Tests run": { "cof": 1, "loci": 0, "copod": 1 } }
+    # Act
+    count_tests("univariate", univariate_details)
+    count_tests("multivariate", multivariate_details)
+    count_tests("multivariate", "Must have a minimum of at least fifteen data points for anomaly detection.")
+    text = render()
+    # Assert
+    assert('anomaly_tests_total{method="univariate",test="dixon",status="skipped"} 1' in text)
+    assert('anomaly_tests_total{method="multivariate",test="loci",status="skipped"} 1' in text)
+    assert('anomaly_tests_total{method="multivariate",test="cof",status="run"} 1' in text)
+
+def test_track_request():
+    # Act
+    describe_request("univariate", 10)
+    with track_request() as request:
+        describe_request("multivariate", 20)
+    # Assert
+    assert(request == { "method": "multivariate", "num_records": 20 })
+    assert(render() == "\n")
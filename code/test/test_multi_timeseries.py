@@ -1,4 +1,5 @@
 from numpy import number
+import numpy as np
 from src.app.models.multi_timeseries import *
 import pandas as pd
 import pytest
@@ -83,3 +84,206 @@ def test_detect_single_timeseries_sample_fraction(df_input, max_fraction_anomali
     print(df_out.sort_values(by=['dt']))
     # Assert
     assert(number_of_anomalies == df_out[df_out['is_anomaly'] == True].shape[0])
+
+# DIFFSTD on the (series x time) matrix should match computing each segment by hand.
+def test_check_diffstd_matches_per_segment_calculation():
+    # Arrange
+    values = np.random.default_rng(0).normal(0, 1, (4, 23))
+    num_segments = 23 // 7
+    (segment_starts, segment_sizes) = get_segment_bounds(23, num_segments)
+    segment_means = generate_segment_means(values)
+    # Act
+    distances = check_diffstd(values, segment_means, segment_starts, segment_sizes)
+    # Assert
+    for i in range(values.shape[0]):
+        for (j, (s_i, m_j)) in enumerate(zip(np.array_split(values[i], num_segments), np.array_split(segment_means, num_segments))):
+            assert(distances[i][j] == pytest.approx(np.std(s_i - m_j)))
+
+def test_detect_multi_timeseries_requires_equal_length_series():
+    # Arrange
+    df = pd.DataFrame(sample_input[:-1], columns=["key", "series_key", "dt", "value"])
+    # Act
+    (df_out, weights, diagnostics) = detect_multi_timeseries(df, 50, 1.0)
+    # Assert
+    assert(diagnostics == "All time series must have the same number of data points.")
+    assert(df_out[df_out['is_anomaly'] == True].shape[0] == 0)
+
+# The vectorized transform should produce exactly the same letters as tslearn.
+@pytest.mark.parametrize("num_series, l, n_segments", [
+    (3, 17, 8),
+    (10, 150, 50),
+    (5, 1003, 200),
+])
+def test_sax_transform_matches_tslearn(num_series, l, n_segments):
+    # Arrange
+    values = np.random.default_rng(4).normal(5, 3, (num_series, l))
+    sax = SymbolicAggregateApproximation(n_segments=n_segments, alphabet_size_avg=4, scale=True)
+    expected = sax.fit_transform(values)[:, :, 0]
+    # Act
+    result = sax_transform(sax, values)
+    # Assert
+    assert((result == expected).all())
+
+# The lookup table approach should produce the same SAX distances as tslearn.
+def test_check_sax_distances_matches_tslearn():
+    # Arrange
+    num_series = 6
+    l = 40
+    values = np.random.default_rng(1).normal(0, 1, (num_series, l))
+    sax = SymbolicAggregateApproximation(n_segments=l//2, alphabet_size_avg=4, scale=True)
+    sax_data = sax.fit_transform(values)
+    word_size = 4
+    num_words = len(sax_data[0])//word_size
+    words = sax_data[:, :num_words*word_size, 0].reshape((num_series, num_words, word_size))
+    # Act:  use a tiny block size to exercise blocking as well
+    m = check_sax_distances(words, get_symbol_distance_table(sax.breakpoints_avg_), l / word_size, max_block_bytes=1)
+    # Assert
+    for i in range(num_series):
+        for j in range(num_words):
+            expected = sum(sax.distance_sax(sax_data[i][j*word_size:(1+j)*word_size], sax_data[k][j*word_size:(1+j)*word_size])
+                for k in range(num_series))/(num_series-1)
+            assert(m[i][j] == pytest.approx(expected))
+
+@pytest.mark.parametrize("num_series, sample_size, tolerance", [
+    (40, 100, 0.0),
+    (300, 200, 0.1),
+])
+def test_check_sax_distances_histogram_and_sampled_match_pairwise(num_series, sample_size, tolerance):
+    # Arrange
+    l = 60
+    values = np.random.default_rng(2).normal(0, 1, (num_series, l))
+    sax = SymbolicAggregateApproximation(n_segments=l//2, alphabet_size_avg=4, scale=True)
+    sax_data = sax.fit_transform(values)
+    word_size = 4
+    num_words = len(sax_data[0])//word_size
+    words = sax_data[:, :num_words*word_size, 0].reshape((num_series, num_words, word_size))
+    symbol_distances = get_symbol_distance_table(sax.breakpoints_avg_)
+    # Act
+    pairwise = check_sax_distances(words, symbol_distances, l / word_size)
+    histogram = check_sax_distances_histogram(words, symbol_distances, l / word_size)
+    sampled = check_sax_distances_sampled(words, symbol_distances, l / word_size, sample_size)
+    # Assert:  histograms are exact, sampling is close on average
+    assert(histogram == pytest.approx(pairwise))
+    assert(np.abs(sampled - pairwise).mean() <= tolerance * pairwise.mean() + 1e-9)
+
+def test_detect_multi_timeseries_ignores_input_order():
+    # Arrange
+    df = pd.DataFrame(sample_input, columns=["key", "series_key", "dt", "value"])
+    df_shuffled = df.sample(frac=1, random_state=0)
+    # Act
+    (df_out, weights, diagnostics) = detect_multi_timeseries(df, 90, 1.0)
+    (df_shuffled_out, weights, diagnostics) = detect_multi_timeseries(df_shuffled, 90, 1.0)
+    # Assert
+    pd.testing.assert_frame_equal(df_out, df_shuffled_out)
+    assert(list(df_out['series_key']) == ["s1"] * 17 + ["s2"] * 17)
+
+@pytest.mark.parametrize("num_series, l, num_shards", [
+    (7, 40, 3),
+    (50, 150, 4),
+    (2, 17, 5),
+])
+def test_transform_series_parallel_matches_serial(num_series, l, num_shards):
+    # Arrange
+    values = np.random.default_rng(num_series).normal(20, 5, (num_series, l))
+    segment_split = get_sax_segment_split(l)
+    (segment_starts, segment_sizes) = get_segment_bounds(l, l // 7)
+    # Act
+    serial = transform_series(values, segment_split, segment_starts, segment_sizes)
+    sharded = transform_series_parallel(values, segment_split, segment_starts, segment_sizes, num_shards)
+    # Assert
+    assert((serial[0] == sharded[0]).all())
+    assert(np.array_equal(serial[1], sharded[1]))
+    assert(np.allclose(serial[2], sharded[2]))
+    assert(np.allclose(serial[3], sharded[3]))
+
+# Appending data points to a group should only compute the new segments and words
+# and give the same results as computing the group's full history with the same frozen settings.
+def test_transform_group_incremental_matches_full():
+    # Arrange
+    values = np.random.default_rng(5).normal(20, 5, (6, 90))
+    state = start_group_state(values[:, :60], np.array(["s" + str(i) for i in range(6)], dtype=object))
+    # Act
+    (results_prefix, diag_prefix, state_prefix) = transform_group(values[:, :60], state)
+    (results_incremental, diag_incremental, state_incremental) = transform_group(values, state_prefix)
+    (results_full, diag_full, state_full) = transform_group(values, state)
+    # Assert
+    assert(diag_incremental["Segments computed"] == 5)
+    assert(diag_incremental["SAX"]["Words computed"] == 4)
+    for column in results_full:
+        assert(np.allclose(results_incremental[column], results_full[column]))
+    assert(np.allclose(state_incremental["diffstd"], state_full["diffstd"]))
+
+def test_detect_multi_timeseries_group_reuses_cached_results():
+    # Arrange
+    df = pd.DataFrame(sample_input, columns=["key", "series_key", "dt", "value"])
+    group_cache.clear()
+    # Act
+    (df_first, weights, diag_first) = detect_multi_timeseries(df, 90, 1.0, group_id="g1")
+    (df_repeat, weights, diag_repeat) = detect_multi_timeseries(df, 90, 1.0, group_id="g1")
+    (df_changed, weights, diag_changed) = detect_multi_timeseries(df.assign(value=df['value'] + 1.0), 90, 1.0, group_id="g1")
+    # Assert
+    assert(diag_first["Test diagnostics"]["Series transformation"] == "Stateful, computed full history")
+    assert(diag_repeat["Test diagnostics"]["Series transformation"] == "Reused cached results")
+    assert(diag_changed["Test diagnostics"]["Series transformation"] == "Stateful, computed full history")
+    pd.testing.assert_frame_equal(df_first, df_repeat)
+
+def test_detect_multi_timeseries_group_changes_sax_mode():
+    # Arrange
+    df = pd.DataFrame(sample_input, columns=["key", "series_key", "dt", "value"])
+    group_cache.clear()
+    # Act
+    detect_multi_timeseries(df, 90, 1.0, sax_mode="pairwise", group_id="g1")
+    (df_sampled, weights, diag_sampled) = detect_multi_timeseries(df, 90, 1.0, sax_mode="sampled", group_id="g1")
+    # Assert:  words from one mode are not reused under another
+    assert(diag_sampled["Test diagnostics"]["Series transformation"] == "Stateful, computed full history")
+    assert(diag_sampled["Test diagnostics"]["SAX"]["SAX mode"] == "sampled")
+
+def test_summarize_segments_matches_points():
+    # Arrange
+    df = pd.DataFrame(sample_input, columns=["key", "series_key", "dt", "value"])
+    (df_out, weights, diagnostics) = detect_multi_timeseries(df, 90, 1.0)
+    # Act
+    segments = summarize_segments(df_out, include_keys=True)
+    # Assert
+    expected = df_out.groupby(["series_key", "segment_number"]).agg(num_points=("key", "count"), anomaly_score=("anomaly_score", "max"), is_anomaly=("is_anomaly", "any")).reset_index()
+    assert(segments.shape[0] == expected.shape[0])
+    assert((segments["num_points"].to_numpy() == expected["num_points"].to_numpy()).all())
+    assert(np.allclose(segments["anomaly_score"], expected["anomaly_score"]))
+    assert((segments["is_anomaly"].to_numpy() == expected["is_anomaly"].to_numpy()).all())
+    anomalous_keys = [k for keys in segments["anomalous_keys"] if keys is not None for k in keys]
+    assert(sorted(anomalous_keys) == sorted(df_out[df_out["is_anomaly"]]["key"].tolist()))
+
+def test_summarize_segments_without_test_results():
+    # Arrange
+    df = pd.DataFrame(sample_input[:20], columns=["key", "series_key", "dt", "value"])
+    (df_out, weights, diagnostics) = detect_multi_timeseries(df, 90, 1.0)
+    # Act
+    segments = summarize_segments(df_out)
+    # Assert
+    assert(segments.shape[0] == 0)
+
+def test_detect_multi_timeseries_wide_matches_long():
+    # Arrange
+    df = pd.DataFrame(sample_input, columns=["key", "series_key", "dt", "value"])
+    df["dt"] = pd.to_datetime(df["dt"])
+    # Send the timestamps out of order to make sure we sort them.
+    dt = df[df["series_key"] == "s1"]["dt"].tolist()[::-1]
+    series = { s: df[df["series_key"] == s]["value"].tolist()[::-1] for s in ["s2", "s1"] }
+    # Act
+    (df_long, weights, diag_long) = detect_multi_timeseries(df, 90, 1.0)
+    (df_wide, weights, diag_wide) = detect_multi_timeseries_wide(dt, series, 90, 1.0)
+    # Assert
+    assert(list(df_wide["series_key"]) == list(df_long["series_key"]))
+    assert((df_wide["dt"].to_numpy() == df_long["dt"].to_numpy()).all())
+    assert(np.allclose(df_wide["anomaly_score"], df_long["anomaly_score"]))
+    assert((df_wide["is_anomaly"].to_numpy() == df_long["is_anomaly"].to_numpy()).all())
+    assert(list(df_wide["key"][:3]) == [16, 15, 14])
+
+def test_detect_multi_timeseries_wide_requires_one_value_per_timestamp():
+    # Arrange
+    dt = pd.date_range("2021-12-11", periods=20, freq="h").tolist()
+    series = { "s1": [1.0] * 20, "s2": [1.0] * 19 }
+    # Act
+    (df_out, weights, diagnostics) = detect_multi_timeseries_wide(dt, series, 50, 1.0)
+    # Assert
+    assert(diagnostics == "All time series must have one value per timestamp.")
@@ -142,6 +142,23 @@ def test_detect_multivariate_runs_cof(df_input, should_run_cof):
         did_run_cof = 0
     assert(should_run_cof == did_run_cof)
 
+@pytest.mark.parametrize("df_input, disabled_tests, cof_method, expected_tests_run", [
+    (sample_input, [], "memory", {"cof": 1, "loci": 1, "copod": 1}),
+    (sample_input, ["loci"], "fast", {"cof": 1, "loci": 0, "copod": 1}),
+    (sample_input, ["loci", "cof"], "fast", {"cof": 0, "loci": 0, "copod": 1}),
+])
+def test_detect_multivariate_disabled_tests(df_input, disabled_tests, cof_method, expected_tests_run):
+    # Arrange
+    df = pd.DataFrame(df_input, columns=["key", "vals"])
+    sensitivity_score = 50
+    max_fraction_anomalies = 1.0
+    n_neighbors = 10
+    # Act
+    (df_out, weights, diagnostics) = detect_multivariate_statistical(df, sensitivity_score, max_fraction_anomalies, n_neighbors, disabled_tests, cof_method)
+    # Assert
+    assert(expected_tests_run == diagnostics["Tests run"])
+    assert(df_out.shape[0] == df.shape[0])
+
 @pytest.mark.parametrize("df_input, sensitivity_score, number_of_anomalies", [
     (sample_input, 100, 6),     # Was 11 in chapter 10, 8 in chapter 11
     (sample_input, 50, 6),      # Was 11 in chapter 10, 8 in chapter 11
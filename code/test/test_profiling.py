@@ -0,0 +1,74 @@
+from src.app import profiling
+from src.app.profiling import *
+import os
+import time
+import marshal
+import pytest
+
+@pytest.fixture(autouse=True)
+def profile_directory(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, "profile_path", str(tmp_path))
+    monkeypatch.setattr(profiling, "interval_seconds", 0.001)
+    return tmp_path
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+def test_sampling_profile():
+    # Act
+    with profile("sampling") as p:
+        busy(0.1)
+    # Assert
+    assert(p["profiler"] == "sampling")
+    assert(sum(p["data"].values()) > 0)
+    assert(any(["busy (test_profiling.py" in stack for stack in p["data"]]))
+
+def test_cprofile_profile():
+    # Act
+    with profile("cprofile") as p:
+        busy(0.01)
+    # Assert
+    assert(p["profiler"] == "cprofile")
+    assert(any([function == "busy" for (file_name, line, function) in marshal.loads(p["data"])]))
+
+def test_no_profile():
+    # Act
+    with profile(None) as p:
+        busy(0.01)
+    # Assert
+    assert(p == {})
+
+@pytest.mark.parametrize("reason, has_profile, seconds, expected", [
+    ("slow", True, 2.0, True),
+    ("slow", True, 0.5, False),
+    ("sampled", True, 0.5, True),
+    ("sampled", False, 0.5, False),
+    (None, False, 2.0, False),
+])
+def test_should_keep(monkeypatch, reason, has_profile, seconds, expected):
+    # Arrange
+    monkeypatch.setattr(profiling, "slow_seconds", 1.0)
+    request = { "profiler": None, "reason": reason, "profile": { "profiler": "sampling", "data": {} } if has_profile else None }
+    # Act and assert
+    assert(should_keep(request, seconds) == expected)
+
+def test_write_and_rotate_profiles(monkeypatch, profile_directory):
+    # Arrange
+    monkeypatch.setattr(profiling, "max_profiles", 2)
+    request = { "profiler": "sampling", "reason": "slow", "profile": { "profiler": "sampling", "data": { "main;detect": 3 }, "interval_seconds": 0.01 } }
+    # Act
+    profile_ids = [write_profile(request, { "endpoint": "/detect/univariate", "num_records": i }) for i in range(3)]
+    profiles = list_profiles()
+    # Assert
+    assert([p["profile_id"] for p in profiles] == profile_ids[:0:-1])
+    assert(get_profile(profile_ids[0]) is None)
+    assert(len(os.listdir(profile_directory)) == 4)
+    with open(get_profile_file(profile_ids[2]), "r") as f:
+        assert(f.read() == "main;detect 3\n")
+
+def test_get_profile_invalid_id():
+    # Act and assert
+    assert(get_profile("../../etc/passwd") is None)
+    assert(get_profile_file("20260101T000000-000000000000") is None)
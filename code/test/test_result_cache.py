@@ -0,0 +1,92 @@
+from src.app import result_cache
+from src.app.result_cache import *
+import pandas as pd
+import pytest
+
+def make_call(df, **kwargs):
+    return { "method": "univariate", "function": "detect_univariate_statistical", "args": (df, 50, 1.0), "kwargs": kwargs,
+        "decision": {}, "affinity": None, "output_mode": "points", "include_keys": False }
+
+df_sample = pd.DataFrame({ "key": ["a", "b", "c"], "value": [1.0, 2.0, 3.0] })
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch):
+    monkeypatch.setattr(result_cache, "memory_cache", SizedLRUCache(10, 1024 * 1024))
+    monkeypatch.setattr(result_cache, "disk_path", "")
+    monkeypatch.setattr(result_cache, "disk_bytes", None)
+
+def test_hash_request_same_input():
+    # Arrange:  the same data built two different ways
+    df_records = pd.DataFrame([{ "key": "a", "value": 1.0 }, { "key": "b", "value": 2.0 }, { "key": "c", "value": 3.0 }])
+    # Act
+    h1 = hash_request(make_call(df_sample), { "debug": False })
+    h2 = hash_request(make_call(df_records), { "debug": False })
+    # Assert
+    assert(h1 == h2)
+
+@pytest.mark.parametrize("call, options", [
+    (make_call(df_sample.assign(value=[1.0, 2.0, 3.5])), { "debug": False }),
+    (make_call(df_sample), { "debug": True }),
+    (make_call(df_sample, max_fraction_anomalies=0.5), { "debug": False }),
+])
+def test_hash_request_changes(call, options):
+    assert(hash_request(call, options) != hash_request(make_call(df_sample), { "debug": False }))
+
+def test_hash_request_changes_with_cache_version(monkeypatch):
+    # Arrange
+    h1 = hash_request(make_call(df_sample), { "debug": False })
+    # Act:  a deploy with different code
+    monkeypatch.setattr(result_cache, "cache_version", "1:other")
+    h2 = hash_request(make_call(df_sample), { "debug": False })
+    # Assert
+    assert(h1 != h2)
+
+def test_hash_request_list_columns():
+    # Arrange
+    df = pd.DataFrame({ "key": ["a", "b"], "vals": [[1.0, 2.0], [3.0, 4.0]] })
+    # Act
+    h1 = hash_request(make_call(df), {})
+    h2 = hash_request(make_call(df.assign(vals=[[1.0, 2.0], [3.0, 5.0]])), {})
+    # Assert
+    assert(h1 != h2)
+
+def test_get_put_memory():
+    # Arrange
+    put("abc123", b"{}")
+    # Act and assert
+    assert(get("abc123") == b"{}")
+    assert(get("def456") is None)
+
+def test_get_put_disk(monkeypatch, tmp_path):
+    # Arrange
+    monkeypatch.setattr(result_cache, "disk_path", str(tmp_path))
+    put("abc123", b"{}")
+    result_cache.memory_cache.clear()
+    # Act
+    body = get("abc123")
+    # Assert:  found on disk and brought back into memory
+    assert(body == b"{}")
+    assert(result_cache.disk_hits >= 1)
+    assert("abc123" in result_cache.memory_cache)
+
+def test_trim_disk(monkeypatch, tmp_path):
+    # Arrange
+    monkeypatch.setattr(result_cache, "disk_path", str(tmp_path))
+    monkeypatch.setattr(result_cache, "disk_max_bytes", 250)
+    # Act
+    for i in range(5):
+        put(f"key{i:03d}", b"x" * 100)
+    # Assert
+    assert(sum([size for (path, size, mtime) in list_disk_files()]) <= 250)
+
+def test_overwrite_disk_file(monkeypatch, tmp_path):
+    # Arrange
+    monkeypatch.setattr(result_cache, "disk_path", str(tmp_path))
+    put("key000", b"x" * 100)
+    put("key001", b"x" * 100)
+    # Act
+    for i in range(3):
+        put("key001", b"x" * 50)
+    # Assert
+    assert(result_cache.disk_bytes == 150)
+    assert(result_cache.disk_bytes == sum([size for (path, size, mtime) in list_disk_files()]))
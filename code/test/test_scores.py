@@ -0,0 +1,36 @@
+from src.app import scores
+from src.app.scores import *
+import numpy as np
+import pandas as pd
+import pytest
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch):
+    monkeypatch.setattr(scores, "score_cache", SizedLRUCache(10, 1024 * 1024))
+
+def make_entry():
+    return { "module": "univariate", "scored": { "df": pd.DataFrame({ "anomaly_score": [0.1, 0.9] }) }, "weights": {}, "details": {} }
+
+def test_put_get():
+    # Arrange
+    entry = make_entry()
+    # Act
+    score_id = put(entry)
+    # Assert
+    assert(get(score_id) is entry)
+    assert(get("no-such-scores") is None)
+
+def test_get_expired(monkeypatch):
+    # Arrange
+    monkeypatch.setattr(scores, "score_ttl_seconds", -1)
+    score_id = put(make_entry())
+    # Act and assert
+    assert(get(score_id) is None)
+    assert(score_id not in scores.score_cache)
+
+@pytest.mark.parametrize("value, expected", [
+    (np.zeros(100), 800),
+    ({ "a": np.zeros(10), "b": [np.zeros(10), np.zeros(5)] }, 200),
+])
+def test_estimate_size(value, expected):
+    assert(estimate_size(value) == expected)
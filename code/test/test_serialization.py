@@ -0,0 +1,82 @@
+from src.app.serialization import *
+import json
+import numpy as np
+import pandas as pd
+import pytest
+
+df_sample = pd.DataFrame({
+    "key": ["a", "b", "c"],
+    "dt": pd.to_datetime(["2021-12-11T08:00:00Z", "2021-12-11T09:00:00Z", "2021-12-11T10:00:00Z"]),
+    "value": [1.5, np.nan, 3.0],
+    "is_anomaly": [False, True, False]
+})
+
+def test_encode_records_matches_pandas():
+    # Arrange
+    results = { "anomalies": df_sample, "debug_weights": { "a": 1.0 } }
+    # Act
+    encoded = json.loads(encode(results))
+    # Assert
+    assert(encoded["anomalies"] == json.loads(df_sample.to_json(orient="records", date_format="iso")))
+    assert(encoded["debug_weights"] == { "a": 1.0 })
+
+def test_encode_columns():
+    # Arrange
+    results = { "anomalies": df_sample }
+    # Act
+    encoded = json.loads(encode(results, "columns"))
+    # Assert
+    assert(list(encoded["anomalies"].keys()) == ["key", "dt", "value", "is_anomaly"])
+    assert(encoded["anomalies"]["value"] == [1.5, None, 3.0])
+    assert(encoded["anomalies"]["is_anomaly"] == [False, True, False])
+
+def test_encode_nested_frames_and_numpy_values():
+    # Arrange
+    results = { "series": { "s1": { "anomalies": df_sample[["key"]] }, "s2": { "error": "Too large" } }, "debug_details": { "count": np.int64(3), "means": np.array([1.0, 2.0]) } }
+    # Act
+    encoded = json.loads(encode(results))
+    # Assert
+    assert(encoded["series"]["s1"]["anomalies"] == [{ "key": "a" }, { "key": "b" }, { "key": "c" }])
+    assert(encoded["series"]["s2"] == { "error": "Too large" })
+    assert(encoded["debug_details"] == { "count": 3, "means": [1.0, 2.0] })
+
+def test_encode_frame_rejects_unknown_orient():
+    with pytest.raises(ValueError):
+        encode_frame(df_sample, "index")
+
+def test_encode_without_orjson(monkeypatch):
+    # Arrange
+    import src.app.serialization as serialization
+    monkeypatch.setattr(serialization, "orjson", None)
+    results = { "anomalies": df_sample, "debug_details": { "count": np.int64(3), "score": np.float32(0.5) } }
+    # Act
+    encoded = json.loads(serialization.encode(results))
+    # Assert
+    assert(encoded["debug_details"] == { "count": 3, "score": 0.5 })
+
+@pytest.mark.parametrize("chunk_rows", [1, 2, 10])
+def test_ndjson_lines_one_row_per_line(monkeypatch, chunk_rows):
+    # Arrange
+    import src.app.serialization as serialization
+    monkeypatch.setattr(serialization, "NDJSON_CHUNK_ROWS", chunk_rows)
+    results = { "anomalies": df_sample, "debug_weights": { "a": 1.0 } }
+    # Act
+    lines = b"".join(ndjson_lines(results)).decode("utf-8").splitlines()
+    # Assert:  rows first, then a trailing record with the debug details
+    assert(len(lines) == 4)
+    assert([json.loads(l) for l in lines[:3]] == json.loads(df_sample.to_json(orient="records", date_format="iso")))
+    assert(json.loads(lines[3]) == { "debug_weights": { "a": 1.0 } })
+
+def test_ndjson_lines_without_debug():
+    # Arrange
+    results = { "anomalies": df_sample }
+    # Act
+    lines = b"".join(ndjson_lines(results)).decode("utf-8").splitlines()
+    # Assert
+    assert(len(lines) == 3)
+
+def test_wants_ndjson():
+    assert(wants_ndjson("application/x-ndjson"))
+    assert(wants_ndjson("application/ndjson, application/json;q=0.5"))
+    assert(not wants_ndjson("application/json"))
+    assert(not wants_ndjson(None))
@@ -1,4 +1,5 @@
 from numpy import number
+import numpy as np
 from src.app.models.single_timeseries import *
 import pandas as pd
 import pytest
@@ -90,3 +91,80 @@ def test_detect_single_timeseries_sample_fraction(df_input, max_fraction_anomali
     print(df_out.sort_values(by=['dt']))
     # Assert
     assert(number_of_anomalies == df_out[df_out['is_anomaly'] == True].shape[0])
+
+# Kernel fits run in separate processes for larger inputs.  The votes must match a serial run exactly.
+def test_fit_kernels_parallel_matches_serial():
+    # Arrange
+    signal, bkps = rpt.pw_constant(1200, 1, 4, noise_std=2, seed=1)
+    signal = signal.flatten()
+    kernels = ["cosine", "linear", "rbf"]
+    penalties = [0.1, 1, 10, 100]
+    # Act
+    serial = [fit_kernel(signal, k, penalties)["breakpoints"] for k in kernels]
+    parallel_fits = [f["breakpoints"] for f in fit_kernels_parallel(signal, kernels, penalties)]
+    # Assert
+    assert(serial == parallel_fits)
+
+# Re-posting a series with points appended should only re-solve the tail and still find the same changepoints.
+# The rbf kernel keeps its gamma from the first fit, so we compare using the other two kernels.
+def test_detect_single_timeseries_incremental_append():
+    # Arrange
+    signal = np.concatenate([np.full(60, 10.0), np.full(60, 50.0), np.full(60, 20.0)]) + np.random.default_rng(3).normal(0, 1, 180)
+    df = pd.DataFrame({"key": [str(i) for i in range(180)], "dt": pd.date_range("2021-12-11", periods=180, freq="h"), "value": signal})
+    changepoint_cache.clear()
+    # Act
+    kernels = ["cosine", "linear"]
+    (df_full, weights, diag_full) = detect_single_timeseries(df.copy(), 70, 1.0, kernels)
+    detect_single_timeseries(df.iloc[:150].copy(), 70, 1.0, kernels, series_id="s1")
+    (df_incremental, weights, diag_incremental) = detect_single_timeseries(df.copy(), 70, 1.0, kernels, series_id="s1", incremental=True)
+    (df_repeat, weights, diag_repeat) = detect_single_timeseries(df.copy(), 70, 1.0, kernels, series_id="s1", incremental=True)
+    # Assert
+    assert(diag_incremental["Test diagnostics"]["Kernel fitting"] == "Incremental, 30 new data points")
+    assert(diag_incremental["Approximate"] and diag_repeat["Approximate"])
+    assert(diag_repeat["Test diagnostics"]["Kernel fitting"] == "Reused cached changepoints")
+    assert((df_incremental['anomaly_score'] == df_full['anomaly_score']).all())
+    assert((df_repeat['anomaly_score'] == df_incremental['anomaly_score']).all())
+
+def make_noisy_series(seed, n):
+    # Three regimes with a good deal of noise, where a full solve does move earlier changepoints as points arrive.
+    rng = np.random.default_rng(seed)
+    means = rng.normal(0, 3, 3)
+    signal = np.repeat(means, [n // 3, n // 3, n - 2 * (n // 3)]) + rng.normal(0, 2, n)
+    return pd.DataFrame({"key": [str(i) for i in range(n)], "dt": pd.date_range("2021-12-11", periods=n, freq="h"), "value": signal})
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_detect_single_timeseries_append_matches_full_solve(seed):
+    # Arrange
+    df = make_noisy_series(seed, 450)
+    changepoint_cache.clear()
+    detect_single_timeseries(df.iloc[:400].copy(), 50, 1.0, series_id="s1")
+    for n in range(410, 451, 10):
+        # Act
+        (df_appended, weights, diag_appended) = detect_single_timeseries(df.iloc[:n].copy(), 50, 1.0, series_id="s1")
+        (df_full, weights, diag_full) = detect_single_timeseries(df.iloc[:n].copy(), 50, 1.0)
+        # Assert:  without incremental, a series_id never changes the results
+        assert(diag_appended["Test diagnostics"]["Kernel fitting"] != "Incremental, 10 new data points")
+        assert("Approximate" not in diag_appended)
+        assert((df_appended['anomaly_score'] == df_full['anomaly_score']).all())
+
+def test_detect_single_timeseries_exact_request_skips_approximate_cache():
+    # Arrange
+    df = make_noisy_series(2, 450)
+    changepoint_cache.clear()
+    detect_single_timeseries(df.iloc[:400].copy(), 50, 1.0, series_id="s1")
+    (df_incremental, weights, diag_incremental) = detect_single_timeseries(df.copy(), 50, 1.0, series_id="s1", incremental=True)
+    # Act
+    (df_exact, weights, diag_exact) = detect_single_timeseries(df.copy(), 50, 1.0, series_id="s1")
+    (df_full, weights, diag_full) = detect_single_timeseries(df.copy(), 50, 1.0)
+    # Assert
+    assert(diag_incremental["Approximate"])
+    assert(diag_exact["Test diagnostics"]["Kernel fitting"] == "Serial")
+    assert((df_exact['anomaly_score'] == df_full['anomaly_score']).all())
+
+def test_get_rbf_gamma_matches_ruptures():
+    # Arrange
+    signal = make_noisy_series(3, 200)['value'].to_numpy()
+    # Act
+    algo = rpt.KernelCPD(kernel="rbf").fit(signal)
+    # Assert
+    assert(np.isclose(get_rbf_gamma(signal), algo.cost.gamma))
@@ -0,0 +1,62 @@
+from src.app.tables import *
+import json
+import pandas as pd
+import pytest
+
+# pyarrow is optional; see requirements.txt.
+pa = pytest.importorskip("pyarrow")
+import pyarrow.ipc
+import pyarrow.parquet
+
+def to_bytes(table, format):
+    sink = pa.BufferOutputStream()
+    if format == "parquet":
+        pa.parquet.write_table(table, sink)
+    else:
+        with (pa.ipc.new_stream if format == "arrow_stream" else pa.ipc.new_file)(sink, table.schema) as writer:
+            writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+@pytest.mark.parametrize("format", ["arrow_stream", "arrow_file", "parquet"])
+def test_read_frame_casts_columns(format):
+    # Arrange:  integer keys and values, timestamps as strings, and a column we do not need
+    table = pa.table({
+        "key": [1, 2, 3],
+        "dt": ["2020-01-01T00:00:00", "2020-01-01T01:00:00", "2020-01-01T02:00:00"],
+        "value": [1, 2, 3],
+        "extra": ["a", "b", "c"]
+    })
+    # Act
+    df = read_frame(to_bytes(table, format), format, ["key", "dt", "value"])
+    # Assert
+    assert(list(df.columns) == ["key", "dt", "value"])
+    assert(list(df["key"]) == ["1", "2", "3"])
+    assert(df["value"].dtype == "float64")
+    assert(pd.api.types.is_datetime64_any_dtype(df["dt"]))
+
+def test_read_frame_vals():
+    # Arrange
+    table = pa.table({ "key": ["a", "b"], "vals": [[1, 2], [3, 4]] })
+    # Act
+    df = read_frame(to_bytes(table, "arrow_stream"), "arrow_stream", ["key", "vals"])
+    # Assert
+    assert([list(v) for v in df["vals"]] == [[1.0, 2.0], [3.0, 4.0]])
+
+@pytest.mark.parametrize("table, message", [
+    (pa.table({ "key": ["a"] }), "missing required columns"),
+    (pa.table({ "key": ["a", None], "value": [1.0, 2.0] }), "missing values"),
+])
+def test_read_frame_rejects_bad_tables(table, message):
+    with pytest.raises(ValueError, match=message):
+        read_frame(to_bytes(table, "parquet"), "parquet", ["key", "value"])
+
+@pytest.mark.parametrize("format", ["arrow_stream", "arrow_file", "parquet"])
+def test_write_frame_round_trip(format):
+    # Arrange
+    df = pd.DataFrame({ "key": ["a", "b"], "anomaly_score": [0.5, 2.0], "is_anomaly": [False, True] })
+    # Act
+    body = write_frame(df, format, { "debug_details": { "Message": "done" } })
+    table = read_table(body, format)
+    # Assert
+    assert(table.to_pandas().equals(df))
+    assert(json.loads(table.schema.metadata[b"debug_details"]) == { "Message": "done" })
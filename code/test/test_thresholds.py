@@ -0,0 +1,77 @@
+from src.app.models.thresholds import *
+from src.app.models import univariate, multivariate, single_timeseries, multi_timeseries
+import numpy as np
+import pandas as pd
+import pytest
+
+rng = np.random.default_rng(5)
+df_univariate = pd.DataFrame({"key": [str(i) for i in range(60)], "value": np.r_[rng.normal(size=58), 9, -7]})
+df_multivariate = pd.DataFrame({"key": [str(i) for i in range(40)], "vals": [[float(x), float(y)] for (x, y) in rng.normal(size=(40, 2))]})
+df_single = pd.DataFrame({"key": [str(i) for i in range(120)], "dt": pd.date_range("2020-01-01", periods=120, freq="h"), "value": np.r_[rng.normal(size=60), rng.normal(5, 1, size=60)]})
+df_multi = pd.DataFrame({"key": [str(i) for i in range(300)], "series_key": [str(i % 5) for i in range(300)], "dt": np.repeat(pd.date_range("2020-01-01", periods=60, freq="h"), 5), "value": rng.normal(size=300)})
+
+settings = [(50, 1.0), (80, 0.1), (20, 0.6)]
+
+@pytest.mark.parametrize("module, function_name, df, extra_args", [
+    (univariate, "detect_univariate_statistical", df_univariate, ()),
+    (multivariate, "detect_multivariate_statistical", df_multivariate, (10,)),
+    (single_timeseries, "detect_single_timeseries", df_single, ()),
+    (multi_timeseries, "detect_multi_timeseries", df_multi, ()),
+])
+def test_detect_settings_matches_separate_detection(module, function_name, df, extra_args):
+    # Arrange
+    (s0, m0) = settings[0]
+    # Act
+    (df_out, weights, details) = detect_settings(module.__name__.split(".")[-1], function_name, (df.copy(), s0, m0, *extra_args), {}, settings)
+    # Assert:  each setting's columns match a full detection with that setting
+    assert(len(details["Settings"]) == len(settings))
+    for (i, (s, m)) in enumerate(settings):
+        (df_expected, weights_expected, details_expected) = getattr(module, function_name)(df.copy(), s, m, *extra_args)
+        for c in module.THRESHOLD_COLUMNS:
+            assert(np.allclose(df_out[f"{c}_{i}"].to_numpy(dtype=float), df_expected[c].to_numpy(dtype=float)))
+        assert(details["Settings"][i]["Number of anomalies"] == df_expected["is_anomaly"].sum())
+        assert(details["Settings"][i].get("Outlier determination") == details_expected.get("Outlier determination"))
+
+def test_detect_settings_invalid_input():
+    # Arrange
+    df = df_univariate.head(2)
+    # Act
+    (df_out, weights, details) = detect_settings("univariate", "detect_univariate_statistical", (df, 50, 1.0), {}, settings)
+    # Assert
+    assert(isinstance(details, str))
+    assert("is_anomaly" in df_out.columns)
+
+@pytest.mark.parametrize("sensitivity_score, max_fraction_anomalies", [(50, 0.1), (80, 0.3), (60, 1.0)])
+def test_rethreshold_multivariate_matches_detection(sensitivity_score, max_fraction_anomalies):
+    # Arrange:  scores kept from a request with a different max_fraction_anomalies
+    (scored, weights, details) = score_input("multivariate", "detect_multivariate_statistical", (df_multivariate.copy(), 50, 0.2, 10), {})
+    # Act
+    (df_out, weights_out, details_out) = apply_settings("multivariate", scored, weights, details, [(sensitivity_score, max_fraction_anomalies)])
+    (df_expected, weights_expected, details_expected) = multivariate.detect_multivariate_statistical(df_multivariate.copy(), sensitivity_score, max_fraction_anomalies, 10)
+    # Assert
+    assert(df_out.drop(columns=["vals"]).equals(df_expected.drop(columns=["vals"])))
+    assert(details_out["COF"] == details_expected["COF"])
+
+def test_detect_settings_without_cof():
+    # Act
+    (df_out, weights, details) = detect_settings("multivariate", "detect_multivariate_statistical", (df_multivariate.copy(), 50, 1.0, 10), { "disabled_tests": ("cof",) }, settings)
+    # Assert
+    assert([c for c in df_out.columns if str(c).startswith("is_")] == ["is_raw_anomaly_loci", "is_raw_anomaly_copod", "is_anomaly_0", "is_anomaly_1", "is_anomaly_2"])
+
+@pytest.mark.parametrize("include_keys", [False, True])
+def test_detect_segments_matches_summarized_detection(include_keys):
+    # Act
+    (segments, weights, details) = detect_segments("multi_timeseries", "detect_multi_timeseries", (df_multi.copy(), 80, 1.0), {}, include_keys)
+    (df_expected, weights_expected, details_expected) = multi_timeseries.detect_multi_timeseries(df_multi.copy(), 80, 1.0)
+    # Assert:  only the segment rows come back
+    assert(segments.shape[0] < df_multi.shape[0])
+    assert(segments.equals(multi_timeseries.summarize_segments(df_expected, include_keys)))
+
+def test_apply_settings_segments_matches_detect_segments():
+    # Arrange
+    (scored, weights, details) = score_input("multi_timeseries", "detect_multi_timeseries", (df_multi.copy(), 80, 1.0), {})
+    # Act
+    (df_out, weights_out, details_out) = apply_settings("multi_timeseries", scored, weights, details, [(80, 1.0)], "segments", True)
+    (segments, weights_expected, details_expected) = detect_segments("multi_timeseries", "detect_multi_timeseries", (df_multi.copy(), 80, 1.0), {}, True)
+    # Assert
+    assert(df_out.equals(segments))
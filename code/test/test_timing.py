@@ -0,0 +1,69 @@
+from src.app import timing
+from src.app.timing import *
+from src.app.models import univariate
+import pandas as pd
+import pytest
+
+@timed("Double")
+def double(x):
+    return x * 2
+
+def test_stages_without_collect():
+    # Act
+    with stage("Nothing"):
+        result = double(2)
+    # Assert
+    assert(result == 4)
+    assert(current() is None)
+
+def test_collect_stages():
+    # Act
+    with collect() as timings:
+        double(1)
+        double(2)
+        with stage("Block"):
+            pass
+        add("Elsewhere", 0.5, 3)
+    # Assert
+    assert(list(timings.keys()) == ["Double", "Block", "Elsewhere"])
+    assert(timings["Double"][1] == 2)
+    assert(timings["Elsewhere"] == [0.5, 3])
+    assert(current() is None)
+
+def test_stage_records_on_exception():
+    # Act
+    with collect() as timings:
+        with pytest.raises(ValueError):
+            with stage("Failing"):
+                raise ValueError("Failed")
+    # Assert
+    assert(timings["Failing"][1] == 1)
+
+def test_merge_and_report():
+    # Arrange
+    with collect() as timings:
+        add("Box-Cox", 0.25)
+        # Act
+        merge({ "Box-Cox": [0.5, 2], "GESD": [0.125, 1] })
+    # Assert
+    assert(report(timings) == { "Box-Cox": { "Seconds": 0.75, "Calls": 3 }, "GESD": { "Seconds": 0.125, "Calls": 1 } })
+    assert(server_timing(timings) == 'box-cox;dur=750.000;desc="Box-Cox (3)", gesd;dur=125.000;desc="GESD (1)"')
+
+def test_since_request_start_once():
+    # Act
+    with collect(request_start=0.0) as timings:
+        since_request_start("Parse request")
+        since_request_start("Parse request")
+    # Assert
+    assert(timings["Parse request"][1] == 1)
+
+def test_univariate_stages():
+    # Arrange
+    df = pd.DataFrame({ "key": [str(i) for i in range(20)], "value": [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 200] })
+    # Act
+    with collect() as timings:
+        (df_out, weights, details) = univariate.detect_univariate_statistical(df, 50, 1.0)
+    # Assert
+    assert(timings["Normality tests"][1] >= 1)
+    assert(timings["Apply threshold"][1] == 1)
+    assert("Timings" not in details)
@@ -0,0 +1,30 @@
+from src.app import executor
+from src.app.executor import get_detector, warm_up_worker
+from src.app.warmup import *
+import os
+import pytest
+
+@pytest.mark.parametrize("module_name", DETECTORS)
+def test_warmup_call_runs_detector(module_name):
+    # Arrange
+    (function_name, args, kwargs) = make_call(module_name)
+    # Act
+    (df, weights, details) = get_detector(module_name, function_name)(*args, **kwargs)
+    # Assert:  the input passes validation, so warmup runs the same tests as a real request
+    assert(isinstance(details, dict))
+    assert(df.shape[0] == args[0].shape[0])
+
+def test_warm_up_worker():
+    # Act
+    result = warm_up_worker(["univariate", "single_timeseries"])
+    # Assert
+    assert(result["pid"] == os.getpid())
+    assert(list(result["seconds"].keys()) == ["univariate", "single_timeseries"])
+    assert(all([s > 0 for s in result["seconds"].values()]))
+
+def test_parse_detectors():
+    # Act and assert
+    assert(parse_detectors("univariate, multi_timeseries") == ["univariate", "multi_timeseries"])
+    assert(parse_detectors("") == [])
+    with pytest.raises(ValueError):
+        parse_detectors("univariate,bivariate")